@@ -1,8 +1,12 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 import os
 from .constantes import CONFIG
+from .database import Database
+from .img_extractors.derivative_cache import DerivativeCache
+from .img_extractors.http_cache import HttpCache
+from .modeles.json_export import ApiJSONEncoder
+from .modeles.response_cache import ResponseCache
 
 # On stocke le chemin vers le fichier courant dans chemin_actuel.
 chemin_actuel = os.path.dirname(os.path.abspath(__file__))
@@ -12,11 +16,21 @@ templates = os.path.join(chemin_actuel, "templates")
 statics = os.path.join(chemin_actuel, "static")
 
 # On initie l'objet SQLAlchemy en le stockant dans la variable db.
-db = SQLAlchemy()
+# Database ajoute à Flask-SQLAlchemy les réglages de connexion de production (voir database.py).
+db = Database()
 
 # On met en place la gestion d'utilisateur-rice-s.
 login = LoginManager()
 
+# On met en place le cache des réponses HTTP des sources d'images (manifests IIIF, albums Flickr).
+http_cache = HttpCache()
+
+# On met en place le cache local des dérivés des images (vignettes, images de la visionneuse).
+derivative_cache = DerivativeCache()
+
+# On met en place le cache des réponses de l'API (données des collections et des images, déjà sérialisées).
+response_cache = ResponseCache()
+
 # On crée notre application.
 app = Flask(
     # Nom de l'application.
@@ -28,7 +42,19 @@ app = Flask(
 )
 
 # On importe les routes.
-from .routes import generic, collections, errors, api
+from .routes import generic, collections, errors, api, images
+from .modeles.migrations import upgrade_database
+from .modeles.search import init_search_index
+from .modeles.regions import init_region_index
+from .modeles.jobs import reconcile_import_jobs
+# On enregistre la mise à jour des versions des collections et des images à chaque écriture.
+from .modeles import versions
+# On enregistre au journal les créations, modifications et suppressions d'annotations.
+from .modeles import changes
+# On tient à jour les statistiques des images et des collections (nombre d'annotations, d'annotateur-ices).
+from .modeles import counters
+# On enregistre les commandes de l'application (flask export-annotations).
+from . import cli
 
 
 def config_app(config_name="dev"):
@@ -49,10 +75,35 @@ def config_app(config_name="dev"):
     # Le cas inverse, le JSON est inversé dans le navigateur.
     app.config['JSON_SORT_KEYS'] = False
 
+    # On utilise un encodeur JSON qui accepte les fragments de JSON déjà encodés (RawJSON), comme les annotations.
+    app.json_encoder = ApiJSONEncoder
+
     # On initialise l'application avec les paramètres préalablement définis.
     db.init_app(app)
 
     # On configure la gestion des logins
     login.init_app(app)
 
+    # On configure le cache des réponses HTTP des sources d'images.
+    http_cache.init_app(app)
+
+    # On configure le cache des dérivés des images.
+    derivative_cache.init_app(app)
+
+    # On configure le cache des réponses de l'API.
+    response_cache.init_app(app)
+
+    # On crée les tables absentes de la base de données (par exemple import_job, ajoutée après la création
+    # des bases existantes). Les tables existantes ne sont pas modifiées par create_all() :
+    # elles sont mises à jour par les migrations (voir modeles/migrations.py).
+    with app.app_context():
+        db.create_all()
+        upgrade_database(app)
+        # On crée l'index de recherche plein texte des collections, s'il n'existe pas (SQLite uniquement).
+        init_search_index()
+        # On crée l'index spatial des régions annotées, s'il n'existe pas (SQLite uniquement).
+        init_region_index()
+        # On termine les imports en arrière-plan interrompus par l'arrêt de l'application.
+        reconcile_import_jobs()
+
     return app
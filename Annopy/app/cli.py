@@ -0,0 +1,176 @@
+import os
+import sys
+import time
+
+import click
+
+from .app import app, db
+from .modeles.image_metadata import prefetch_image_metadata
+from .modeles.export import EXPORT_COMPRESSIONS, EXPORT_FORMATS, check_compression, export_corpus, \
+    export_partitions, throughput
+from .modeles.annotation_import import IMPORT_FORMATS, format_from_path, import_annotations, iter_units, \
+    open_input, read_checkpoint, write_checkpoint
+from .modeles.json_export import api_json_backend
+from .modeles.users import User
+
+"""
+Commandes de l'application, à lancer depuis le dossier Annopy avec la configuration choisie, par exemple :
+FLASK_APP="app.app:config_app('production')" flask export-annotations corpus.jsonl.gz
+FLASK_APP="app.app:config_app('production')" flask import-annotations annotations.jsonl --user login
+FLASK_APP="app.app:config_app('production')" flask prefetch-images
+"""
+
+
+def _compression_from_path(path):
+    """ Déduit la compression d'un export de l'extension du fichier (.gz, .zst).
+
+    :param path: chemin du fichier
+    :type path: str
+    :return: None, "gzip" ou "zstd"
+    :rtype: str
+    """
+
+    for compression, extension in EXPORT_COMPRESSIONS.items():
+        if extension and path.endswith(extension):
+            return compression
+    return None
+
+
+@app.cli.command("export-annotations")
+@click.argument("output")
+@click.option("--format", "export_format", type=click.Choice(EXPORT_FORMATS), default="jsonl",
+              help="jsonl : une annotation par ligne ; w3c : une AnnotationPage par ligne.")
+@click.option("--compression", type=click.Choice(["none", "gzip", "zstd"]), default=None,
+              help="Compression du fichier (par défaut, selon l'extension : .gz, .zst).")
+@click.option("--from", "first_collection_id", type=int, default=None, help="ID de la première collection exportée.")
+@click.option("--to", "last_collection_id", type=int, default=None, help="ID de la dernière collection exportée.")
+@click.option("--partitions", type=int, default=1,
+              help="Nombre de fichiers (par intervalle d'ID de collections) ; OUTPUT est alors un dossier.")
+@click.option("--workers", type=int, default=None, help="Nombre de processus qui écrivent les fichiers.")
+@click.option("--base-url", default="http://localhost:5000", help="URL de l'application, pour les identifiants.")
+def export_annotations(output, export_format, compression, first_collection_id, last_collection_id, partitions,
+                       workers, base_url):
+    """ Exporte toutes les annotations du corpus en JSON-Lines dans OUTPUT ("-" pour la sortie standard). """
+
+    if compression is None:
+        compression = _compression_from_path(output)
+    elif compression == "none":
+        compression = None
+    erreur = check_compression(compression)
+    if erreur:
+        raise click.UsageError(erreur)
+
+    options = {
+        "chunk_size": app.config["EXPORT_CHUNK_SIZE"],
+        "page_size": app.config["EXPORT_PAGE_SIZE"],
+        "base_url": base_url.rstrip("/"),
+        "backend": api_json_backend()
+    }
+    start = time.perf_counter()
+    invalid = []
+
+    if partitions > 1:
+        def on_done(path, result):
+            status, count = result
+            if status:
+                click.echo("{0} : {1} annotations".format(path, count), err=True)
+
+        status, result = export_partitions(
+            db.engine, output, partitions, workers or app.config["EXPORT_WORKERS"], export_format, compression,
+            first_collection_id, last_collection_id, on_done=on_done, invalid=invalid, **options
+        )
+    else:
+        if output == "-":
+            output = sys.stdout.buffer
+        elif os.path.dirname(output):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+        status, result = export_corpus(
+            db.engine, output, export_format, compression, first_collection_id, last_collection_id,
+            invalid=invalid, **options
+        )
+
+    if status is False:
+        raise click.ClickException(" ".join(result))
+    click.echo("{0} annotations exportées ({1} annotations/s)".format(result, throughput(result, start)), err=True)
+    if invalid:
+        click.echo("{0} annotations non exportées (JSON invalide) : {1}".format(
+            len(invalid), ", ".join(str(annotation_id) for annotation_id in sorted(invalid))
+        ), err=True)
+
+
+@app.cli.command("import-annotations")
+@click.argument("input_path", metavar="INPUT")
+@click.option("--user", "login", required=True, help="Login de l'utilisateur-ice auteur-ice des annotations.")
+@click.option("--collection", "collection_id", type=int, default=None,
+              help="ID de la collection dont les images sont annotées (par défaut, toutes les images).")
+@click.option("--format", "import_format", type=click.Choice(IMPORT_FORMATS), default=None,
+              help="jsonl : une annotation ou une AnnotationPage par ligne ; w3c : un document AnnotationPage "
+                   "ou AnnotationCollection (par défaut, selon l'extension : .json, .jsonl).")
+@click.option("--batch-size", type=int, default=None, help="Nombre d'annotations enregistrées par transaction.")
+@click.option("--checkpoint", "checkpoint_path", default=None,
+              help="Fichier du point de reprise (par défaut, INPUT.checkpoint).")
+@click.option("--restart", is_flag=True, help="Ignore le point de reprise et recommence l'import depuis le début.")
+def import_annotations_command(input_path, login, collection_id, import_format, batch_size, checkpoint_path, restart):
+    """ Importe les annotations W3C Web Annotation du fichier INPUT (compressé avec gzip s'il finit par .gz) sur les
+    images dont l'URL est la cible des annotations. Un import interrompu reprend après le dernier lot enregistré.
+    """
+
+    user = User.query.filter(User.user_login == login).first()
+    if user is None:
+        raise click.UsageError("L'utilisateur-ice {0} n'existe pas.".format(login))
+
+    import_format = import_format or format_from_path(input_path)
+    checkpoint_path = checkpoint_path or input_path + ".checkpoint"
+    state = None if restart else read_checkpoint(checkpoint_path)
+    if state is not None:
+        click.echo("Reprise de l'import après {0} annotations enregistrées.".format(state["imported"]), err=True)
+
+    def on_batch(current):
+        write_checkpoint(checkpoint_path, current)
+        click.echo("{0} annotations enregistrées, {1} sans image, {2} illisibles ({3} annotations/s)".format(
+            current["imported"], current["unmatched"], current["invalid"], current["rate"]
+        ), err=True)
+
+    with open_input(input_path) as stream:
+        status, result = import_annotations(
+            iter_units(stream, import_format, start=state["position"] if state else 0), user, collection_id,
+            batch_size=batch_size or app.config["ANNOTATION_IMPORT_BATCH_SIZE"], state=state, on_batch=on_batch
+        )
+
+    if status is False:
+        raise click.ClickException("{0} (le point de reprise est dans {1})".format(" ".join(result), checkpoint_path))
+    # L'import est terminé : le point de reprise n'est plus utile.
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    click.echo("Import terminé : {0} annotations enregistrées, {1} sans image, {2} illisibles.".format(
+        result["imported"], result["unmatched"], result["invalid"]
+    ), err=True)
+
+
+@app.cli.command("prefetch-images")
+@click.option("--collection", "collection_id", type=int, default=None,
+              help="ID de la collection dont les images sont traitées (par défaut, toutes les images).")
+@click.option("--refresh", is_flag=True, help="Récupère aussi les métadonnées des images déjà traitées.")
+@click.option("--workers", type=int, default=None, help="Nombre de requêtes lancées en même temps.")
+def prefetch_images(collection_id, refresh, workers):
+    """ Récupère les dimensions, le format et le service IIIF des images qui ne les ont pas encore
+    (images importées avant l'ajout de ces métadonnées, ou dont la source était injoignable).
+    """
+
+    def on_batch(state):
+        click.echo("{0} images traitées, {1} avec leurs métadonnées".format(state["processed"], state["found"]), err=True)
+
+    status, result = prefetch_image_metadata(
+        collection_id=collection_id,
+        refresh=refresh,
+        batch_size=app.config["IMAGE_METADATA_BATCH_SIZE"],
+        max_workers=workers or app.config["IMAGE_METADATA_WORKERS"],
+        timeout=app.config["IMAGE_METADATA_TIMEOUT"],
+        max_bytes=app.config["IMAGE_METADATA_SNIFF_SIZE"],
+        on_batch=on_batch
+    )
+    if status is False:
+        raise click.ClickException(" ".join(result))
+    click.echo("Terminé : {0} images traitées, {1} avec leurs métadonnées.".format(
+        result["processed"], result["found"]
+    ), err=True)
@@ -0,0 +1,169 @@
+from threading import Lock
+from weakref import WeakSet
+
+import sqlalchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import Select
+
+
+class RoutingSession(SignallingSession):
+    """ Session qui envoie les lectures vers la base de lecture (SQLALCHEMY_READ_DATABASE_URI), si elle est
+    configurée, et les écritures vers la base principale.
+    Dès qu'une transaction a écrit (flush, requête SQL brute), toutes ses requêtes suivantes sont envoyées
+    à la base principale jusqu'au commit ou au rollback : la transaction lit ainsi ses propres écritures.
+    """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self._db = db
+        self._writing = False
+
+    def get_bind(self, mapper=None, clause=None):
+        # Les tables associées à une autre base (bind_key) gardent le fonctionnement de Flask-SQLAlchemy.
+        if mapper is not None and getattr(mapper.mapped_table, "info", {}).get("bind_key") is not None:
+            return super().get_bind(mapper, clause)
+
+        if not self._writing and not self._flushing and isinstance(clause, Select):
+            engine = self._db.get_read_engine(self.app)
+            if engine is not None:
+                return engine
+
+        self._writing = True
+        return super().get_bind(mapper, clause)
+
+    def commit(self):
+        try:
+            super().commit()
+        finally:
+            self._writing = False
+
+    def rollback(self):
+        try:
+            super().rollback()
+        finally:
+            self._writing = False
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._writing = False
+
+
+class Database(SQLAlchemy):
+    """ Extension SQLAlchemy de l'application. En plus de Flask-SQLAlchemy, elle gère :
+    - les PRAGMA appliqués à chaque connexion SQLite (SQLITE_PRAGMAS : WAL, synchronous, busy_timeout, etc.) ;
+    - la taille des pools de connexions (DATABASE_WRITE_POOL_SIZE, DATABASE_READ_POOL_SIZE) ;
+    - une base de lecture (SQLALCHEMY_READ_DATABASE_URI), utilisée par les requêtes SELECT hors transaction
+      d'écriture. Avec SQLite, il s'agit du même fichier, ouvert par des connexions en lecture seule.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._read_engines = {}
+        self._read_lock = Lock()
+        self._prepared = WeakSet()
+        self._prepared_lock = Lock()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_engine(self, app=None, bind=None):
+        engine = super().get_engine(app, bind)
+        # Les PRAGMA sont appliqués par un événement "connect", enregistré une fois par moteur,
+        # avant que celui-ci n'ouvre sa première connexion.
+        with self._prepared_lock:
+            if engine not in self._prepared:
+                self._prepare_engine(self.get_app(app), engine, read_only=False)
+                self._prepared.add(engine)
+        return engine
+
+    def get_read_engine(self, app):
+        """ Retourne le moteur de la base de lecture, en le créant si besoin.
+
+        :param app: application Flask
+        :return: moteur de la base de lecture, ou None si elle n'est pas configurée
+        :rtype: Engine
+        """
+
+        uri = app.config.get("SQLALCHEMY_READ_DATABASE_URI")
+        if not uri:
+            return None
+
+        with self._read_lock:
+            cached = self._read_engines.get(app)
+            if cached is not None and cached[0] == uri:
+                return cached[1]
+
+            info = make_url(uri)
+            options = {"convert_unicode": True}
+            self._apply_pool_size(app, info, options, app.config.get("DATABASE_READ_POOL_SIZE"))
+            self.apply_driver_hacks(app, info, options)
+            engine = sqlalchemy.create_engine(info, **options)
+            self._prepare_engine(app, engine, read_only=True)
+            self._read_engines[app] = (uri, engine)
+            return engine
+
+    def apply_driver_hacks(self, app, info, options):
+        # La taille du pool doit être fixée avant l'appel à Flask-SQLAlchemy, qui choisit le type de pool
+        # des bases SQLite en fonction de celle-ci.
+        if "pool_size" not in options:
+            self._apply_pool_size(app, info, options, app.config.get("DATABASE_WRITE_POOL_SIZE"))
+        super().apply_driver_hacks(app, info, options)
+
+    @staticmethod
+    def _apply_pool_size(app, info, options, pool_size):
+        """ Configure le pool de connexions d'un moteur.
+
+        :param app: application Flask
+        :param info: URL de la base de données
+        :type info: URL
+        :param options: options passées à sqlalchemy.create_engine()
+        :type options: dict
+        :param pool_size: nombre de connexions gardées ouvertes (None pour garder les valeurs par défaut)
+        :type pool_size: int
+        """
+
+        if pool_size is None:
+            return
+        options["pool_size"] = pool_size
+        options["max_overflow"] = app.config.get("DATABASE_MAX_OVERFLOW", 0)
+        options["pool_timeout"] = app.config.get("DATABASE_POOL_TIMEOUT", 30)
+
+        if info.drivername == "sqlite" and info.database not in (None, "", ":memory:"):
+            # Par défaut, SQLAlchemy n'utilise pas de pool pour SQLite. Les connexions d'un QueuePool
+            # passent d'un thread à l'autre : il faut désactiver la vérification du thread de pysqlite.
+            options["poolclass"] = QueuePool
+            options.setdefault("connect_args", {})["check_same_thread"] = False
+
+    @staticmethod
+    def _prepare_engine(app, engine, read_only):
+        """ Enregistre l'application des PRAGMA SQLite à l'ouverture de chaque connexion d'un moteur.
+
+        :param app: application Flask
+        :param engine: moteur SQLAlchemy
+        :type engine: Engine
+        :param read_only: True pour les connexions de la base de lecture (PRAGMA query_only)
+        :type read_only: bool
+        """
+
+        if engine.dialect.name != "sqlite":
+            return
+
+        pragmas = list((app.config.get("SQLITE_PRAGMAS") or {}).items())
+        if read_only:
+            # Le mode du journal est fixé par les connexions d'écriture ; il est conservé dans le fichier.
+            pragmas = [(name, value) for name, value in pragmas if name != "journal_mode"]
+            pragmas.append(("query_only", "ON"))
+        if not pragmas:
+            return
+
+        @event.listens_for(engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas:
+                cursor.execute("PRAGMA {0} = {1}".format(name, value))
+            cursor.close()
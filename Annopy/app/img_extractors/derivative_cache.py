@@ -0,0 +1,251 @@
+import hashlib
+import os
+import re
+import sqlite3
+import tempfile
+import time
+
+import requests
+
+from .url_validator import create_session
+
+# Taille (en octets) des morceaux lus successivement dans la réponse HTTP.
+DERIVATIVE_CHUNK_SIZE = 64 * 1024
+
+# Délai (en secondes) pendant lequel la date d'accès d'un dérivé n'est pas remise à jour : un dérivé très demandé
+# n'entraîne pas une écriture dans l'index à chaque requête.
+ACCESS_UPDATE_INTERVAL = 60
+
+# Délai (en secondes) pendant lequel un dérivé qui n'a pas pu être récupéré n'est pas redemandé à sa source :
+# une source injoignable ne ralentit pas chaque affichage d'une page de collection.
+FAILURE_TTL = 600
+
+# URL d'une image Flickr : https://live.staticflickr.com/{server}/{id}_{secret}[_{suffixe}].jpg
+FLICKR_IMAGE_URL = re.compile(r"^(?P<base>https?://live\.staticflickr\.com/\d+/\d+_[0-9a-f]+)(?:_[a-z0-9])?\.jpg$")
+
+# Suffixes des tailles d'images Flickr (côté le plus long, en pixels), du plus petit au plus grand.
+# Les tailles carrées (s, q) et les tailles dont le secret est différent (h, k, o) ne sont pas utilisées.
+FLICKR_SIZES = [("_m", 240), ("_n", 320), ("_w", 400), ("", 500), ("_z", 640), ("_c", 800), ("_b", 1024)]
+
+
+def derivative_url(image_url, width=None, service=None, image_width=None):
+    """ Retourne l'URL d'une version réduite d'une image, demandée à la source : taille réduite de l'Image API
+    pour une image IIIF, suffixe de taille pour une image Flickr. Sans width, ou pour une autre source,
+    l'image d'origine est utilisée.
+
+    :param image_url: URL de l'image
+    :type image_url: str
+    :param width: largeur souhaitée (en pixels), ou None pour l'image d'origine
+    :type width: int
+    :param service: URL du service IIIF de l'image, si elle est connue
+    :type service: str
+    :param image_width: largeur de l'image d'origine, si elle est connue
+    :type image_width: int
+    :return: URL du dérivé
+    :rtype: str
+    """
+
+    # L'image d'origine est déjà assez petite.
+    if width is None or (image_width and image_width <= width):
+        return image_url
+
+    if service:
+        return "{0}/full/{1},/0/default.jpg".format(service.rstrip("/"), width)
+
+    match = FLICKR_IMAGE_URL.match(image_url)
+    if match:
+        for suffix, size in FLICKR_SIZES:
+            if size >= width:
+                return "{0}{1}.jpg".format(match.group("base"), suffix)
+
+    return image_url
+
+
+class DerivativeCache:
+    """ Cache local des dérivés des images (vignettes, images de la visionneuse), récupérés une seule fois depuis
+    leur source. Les fichiers sont stockés dans le dossier path, nommés d'après l'empreinte SHA-256 de leur contenu :
+    un même contenu n'est stocké qu'une fois. Un index SQLite (index.sqlite), partagé par tous les processus
+    de l'application, associe l'URL de chaque dérivé à son fichier.
+    Quand la taille totale des fichiers dépasse max_size, les dérivés les moins récemment utilisés sont supprimés.
+    Si path est None, le cache est désactivé.
+    """
+
+    def __init__(self, path=None, max_size=1024 * 1024 * 1024, max_entry_size=32 * 1024 * 1024, timeout=10,
+                 pool_size=8):
+        self.path = path
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.timeout = timeout
+        self.session = create_session(pool_size=pool_size) if path else None
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._create_table()
+
+    def init_app(self, app):
+        """ Configure le cache à partir de la configuration de l'application.
+        Un chemin relatif est résolu depuis la racine de l'application, comme pour la base de données.
+
+        :param app: application Flask
+        """
+
+        path = app.config.get("DERIVATIVE_CACHE_PATH")
+        if path and not os.path.isabs(path):
+            path = os.path.join(app.root_path, path)
+        self.__init__(
+            path=path,
+            max_size=app.config.get("DERIVATIVE_CACHE_MAX_SIZE", self.max_size),
+            max_entry_size=app.config.get("DERIVATIVE_CACHE_MAX_ENTRY_SIZE", self.max_entry_size),
+            timeout=app.config.get("DERIVATIVE_CACHE_TIMEOUT", self.timeout)
+        )
+
+    def _connect(self):
+        # Une connexion par appel : les connexions SQLite ne se partagent pas entre threads.
+        # timeout laisse le temps aux autres processus de terminer leur écriture.
+        connection = sqlite3.connect(os.path.join(self.path, "index.sqlite"), timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _create_table(self):
+        with self._connect() as connection:
+            # Un fichier (blob) peut être partagé par plusieurs dérivés (derivative) de même contenu.
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS derivative ("
+                "url TEXT PRIMARY KEY, digest TEXT NOT NULL, content_type TEXT, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_derivative_accessed_at ON derivative (accessed_at)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_derivative_digest ON derivative (digest)")
+            connection.execute("CREATE TABLE IF NOT EXISTS blob (digest TEXT PRIMARY KEY, size INTEGER NOT NULL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS failure (url TEXT PRIMARY KEY, failed_at REAL NOT NULL)")
+        connection.close()
+
+    def file_path(self, digest):
+        """ Retourne le chemin du fichier d'un contenu, dans un sous-dossier nommé d'après le début de son empreinte
+        (pour ne pas avoir trop de fichiers dans un même dossier).
+
+        :param digest: empreinte SHA-256 du contenu
+        :type digest: str
+        :return: chemin du fichier
+        :rtype: str
+        """
+
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def get(self, url):
+        """ Récupère un dérivé, depuis le cache si possible, ou depuis sa source (il est alors mis en cache).
+
+        :param url: URL du dérivé
+        :type url: str
+        :return: tuple (empreinte du contenu, chemin du fichier, type MIME), ou None si le dérivé n'a pas pu être
+        récupéré (source injoignable, fichier plus grand que max_entry_size) ou si le cache est désactivé
+        :rtype: tuple
+        """
+
+        if not self.path:
+            return None
+
+        now = time.time()
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT digest, content_type, accessed_at FROM derivative WHERE url = ?", (url,)
+            ).fetchone()
+            if row and os.path.exists(self.file_path(row[0])):
+                if now - row[2] > ACCESS_UPDATE_INTERVAL:
+                    with connection:
+                        connection.execute("UPDATE derivative SET accessed_at = ? WHERE url = ?", (now, url))
+                return row[0], self.file_path(row[0]), row[1]
+
+            failure = connection.execute("SELECT failed_at FROM failure WHERE url = ?", (url,)).fetchone()
+            if failure and now - failure[0] < FAILURE_TTL:
+                return None
+
+            fetched = self._fetch(url)
+            if fetched is None:
+                with connection:
+                    connection.execute("INSERT OR REPLACE INTO failure (url, failed_at) VALUES (?, ?)", (url, now))
+                return None
+            digest, size, content_type = fetched
+            self._store(connection, url, digest, size, content_type, now)
+            return digest, self.file_path(digest), content_type
+        finally:
+            connection.close()
+
+    def _fetch(self, url):
+        """ Télécharge un dérivé dans un fichier temporaire, puis le place à l'emplacement de son contenu.
+
+        :param url: URL du dérivé
+        :type url: str
+        :return: tuple (empreinte du contenu, taille, type MIME), ou None
+        :rtype: tuple
+        """
+
+        try:
+            r = self.session.get(url, timeout=self.timeout, stream=True)
+        except requests.RequestException:
+            return None
+
+        # Le fichier temporaire est créé dans le dossier du cache, pour que os.replace() soit atomique.
+        descriptor, temporary = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as output:
+                if r.status_code != 200:
+                    return None
+                content_type = r.headers.get("Content-Type", "").split(";", 1)[0].strip() or None
+                if content_type and not content_type.startswith("image/"):
+                    return None
+                digest = hashlib.sha256()
+                size = 0
+                for chunk in r.iter_content(chunk_size=DERIVATIVE_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_entry_size:
+                        return None
+                    digest.update(chunk)
+                    output.write(chunk)
+            digest = digest.hexdigest()
+            os.makedirs(os.path.dirname(self.file_path(digest)), exist_ok=True)
+            os.replace(temporary, self.file_path(digest))
+            return digest, size, content_type
+        except (requests.RequestException, OSError):
+            return None
+        finally:
+            r.close()
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def _store(self, connection, url, digest, size, content_type, now):
+        """ Enregistre un dérivé dans l'index puis supprime les dérivés les moins récemment utilisés
+        si la taille maximale du cache est dépassée.
+        """
+
+        removed = []
+        with connection:
+            connection.execute("DELETE FROM failure WHERE url = ? OR failed_at < ?", (url, now - FAILURE_TTL))
+            connection.execute("INSERT OR REPLACE INTO blob (digest, size) VALUES (?, ?)", (digest, size))
+            connection.execute(
+                "INSERT OR REPLACE INTO derivative (url, digest, content_type, accessed_at) VALUES (?, ?, ?, ?)",
+                (url, digest, content_type, now)
+            )
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM blob").fetchone()[0]
+            if total > self.max_size:
+                excess = total - self.max_size
+                freed = 0
+                for old_url, old_digest in connection.execute(
+                        "SELECT url, digest FROM derivative WHERE url != ? ORDER BY accessed_at", (url,)).fetchall():
+                    if freed >= excess:
+                        break
+                    connection.execute("DELETE FROM derivative WHERE url = ?", (old_url,))
+                    # Le fichier n'est supprimé que s'il n'est plus utilisé par aucun dérivé.
+                    if connection.execute("SELECT 1 FROM derivative WHERE digest = ?", (old_digest,)).fetchone():
+                        continue
+                    freed += connection.execute(
+                        "SELECT size FROM blob WHERE digest = ?", (old_digest,)
+                    ).fetchone()[0]
+                    connection.execute("DELETE FROM blob WHERE digest = ?", (old_digest,))
+                    removed.append(old_digest)
+
+        # Les fichiers sont supprimés une fois la transaction terminée.
+        for old_digest in removed:
+            try:
+                os.remove(self.file_path(old_digest))
+            except OSError:
+                pass
@@ -1,9 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+
 import requests
 
+from .http_cache import HttpCache
+from .url_validator import create_session, validate_urls
 
-def photoset_flickr_query(api_key, photoset_id, user_id):
-    """ Récupère une liste d'URL depuis un album Flickr via l'API de Flickr.
-    Chaque URL correspond à une image de ladite collection.
+# Nombre maximum de photos par page accepté par la méthode flickr.photosets.getPhotos.
+FLICKR_MAX_PER_PAGE = 500
+
+
+class FlickrQueryError(Exception):
+    """ Erreur levée lorsqu'une page d'un album Flickr n'a pas pu être récupérée. """
+
+
+def _flickr_ok(content):
+    """ Indique si une réponse de l'API Flickr a abouti. Les erreurs de l'API (clé invalide, album introuvable,
+    limite de requêtes atteinte) sont renvoyées avec le code HTTP 200 : elles ne doivent pas être mises en cache.
+
+    :param content: contenu de la réponse
+    :type content: bytes
+    :return: True si data["stat"] == "ok"
+    :rtype: bool
+    """
+
+    try:
+        return json.loads(content).get("stat") == "ok"
+    except (ValueError, AttributeError):
+        return False
+
+
+def _photoset_page(session, url_query, page, timeout, cache):
+    """ Récupère une page d'un album Flickr, depuis le cache des réponses HTTP si possible.
+
+    :param session: session HTTP utilisée pour la requête.
+    :type session: requests.Session
+    :param url_query: URL de la requête à l'API Flickr, sans pagination.
+    :type url_query: str
+    :param page: numéro de la page à récupérer (à partir de 1).
+    :type page: int
+    :param timeout: délai maximum (en secondes) accordé à la requête.
+    :type timeout: float
+    :param cache: cache des réponses HTTP.
+    :type cache: HttpCache
+    :return: dictionnaire "photoset" renvoyé par l'API (page, pages, total, photo, etc.)
+    :rtype: dict
+    """
+
+    page_url = "{0}&page={1}&per_page={2}".format(url_query, page, FLICKR_MAX_PER_PAGE)
+    try:
+        status_code, content = cache.get(page_url, session=session, timeout=timeout, validate=_flickr_ok)
+    except requests.RequestException as erreur:
+        raise FlickrQueryError("Page {0} de l'album injoignable : {1}".format(page, erreur))
+
+    # On vérifie que la requête à l'API a bien abouti avec le code HTTP 200 et data["stat"] == "ok".
+    if status_code != 200:
+        raise FlickrQueryError("Page {0} de l'album : code HTTP {1}".format(page, status_code))
+    try:
+        data = json.loads(content)
+    except ValueError:
+        raise FlickrQueryError("Page {0} de l'album : réponse invalide".format(page))
+    if data.get("stat") != "ok":
+        raise FlickrQueryError("Page {0} de l'album : {1}".format(page, data.get("message", data.get("stat"))))
+
+    return data["photoset"]
+
+
+def _iter_photoset_urls(session, url_query, first_page, max_workers, timeout, cache, own_session):
+    """ Générateur renvoyant, page par page, les URL valides des images d'un album Flickr.
+
+    :param session: session HTTP utilisée pour les requêtes.
+    :type session: requests.Session
+    :param url_query: URL de la requête à l'API Flickr, sans pagination.
+    :type url_query: str
+    :param first_page: première page de l'album, déjà récupérée.
+    :type first_page: dict
+    :param max_workers: nombre maximum de requêtes lancées en même temps.
+    :type max_workers: int
+    :param timeout: délai maximum (en secondes) accordé à chaque requête HTTP.
+    :type timeout: float
+    :param cache: cache des réponses HTTP.
+    :type cache: HttpCache
+    :param own_session: True si la session doit être fermée à la fin du générateur.
+    :type own_session: bool
+    :return: URL des images, dans l'ordre de l'album
+    :rtype: generator
+    """
+
+    pages = int(first_page.get("pages", 1))
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    try:
+        # Une fois le nombre total de pages connu grâce à la première page, on lance la récupération
+        # de toutes les autres pages en parallèle.
+        futures = {
+            page: executor.submit(_photoset_page, session, url_query, page, timeout, cache)
+            for page in range(2, pages + 1)
+        }
+
+        # L'objet JSON récupéré depuis l'API Flickr renvoie une liste inversée des images d'une collection.
+        # Pour obtenir l'ordre original des images, visible sur un navigateur, on parcourt les pages
+        # de la dernière à la première, et les photos de chaque page de la dernière à la première.
+        for page in range(pages, 0, -1):
+            photoset = first_page if page == 1 else futures[page].result()
+
+            # On construit l'URL de chaque image à partir de l'identifiant de l'image, du secret et du server.
+            # le paramètre b dans l'URL créée permet de récupérer l'image dans un format large
+            # (1024 px maximum pour un côté).
+            candidates = [
+                "https://live.staticflickr.com/{0}/{1}_{2}_{3}.jpg".format(item["server"], item["id"], item["secret"], "b")
+                for item in reversed(photoset["photo"])
+            ]
+
+            # On teste chaque URL pour savoir si le code de réponse HTTP est 200.
+            # On s'assure ainsi que chaque URL, au moment de sa récupération, est valide.
+            # Les vérifications sont faites en parallèle avec des requêtes HEAD, sans télécharger les images.
+            for url in validate_urls(candidates, max_workers=max_workers, timeout=timeout, session=session):
+                yield url
+    finally:
+        executor.shutdown(wait=False)
+        if own_session:
+            session.close()
+
+
+def photoset_flickr_url(api_key, photoset_id, user_id):
+    """ Construit l'URL de la requête à l'API Flickr qui liste les photos d'un album.
 
     :param api_key: API key pour utiliser l'API de Flickr.
     :type api_key: str
@@ -11,69 +132,102 @@ def photoset_flickr_query(api_key, photoset_id, user_id):
     :type photoset_id: int
     :param user_id: ID de l'utilisateur-rice à qui appartient l'album duquel on veut récupérer les images.
     :type user_id: str
-    :return: liste d'URL d'images
-    :rtype: list
+    :return: URL de la requête, sans pagination
+    :rtype: str
     """
 
-    # On crée une liste vide dans laquelle on pourra stocker les données de chaque image.
-    imgs = []
-
-    # On crée une variable qui va stocker la requête faite à l'API REST Flickr, plusieurs paramètres sont nécessaires.
+    # On construit la requête faite à l'API REST Flickr, plusieurs paramètres sont nécessaires.
     # La méthode flickr.photosets.getPhotos permet de récupérer une liste de photos dans un album et leurs métadonnées.
     # api_key correspond à l'API key de l'utilisateur-rice.
     # photoset_id correspond à l'ID de l'album duquel on veut récupérer les images.
     # user_id correspond à l'ID utilisateur à qui appartient l'album duquel on veut récupérer les images.
     # nojsoncallback=1 permet d'obtenir comme réponse à la requête HTTP du raw JSON.
     # format=json permet de récupérer du JSON.
-    url_query = "https://api.flickr.com/services/rest/?method=flickr.photosets.getPhotos&api_key={0}&photoset_id={1}&user_id={2}&nojsoncallback=1&format=json".format(
+    # Les paramètres de pagination (page, per_page) sont ajoutés pour chaque page.
+    return "https://api.flickr.com/services/rest/?method=flickr.photosets.getPhotos&api_key={0}&photoset_id={1}&user_id={2}&nojsoncallback=1&format=json".format(
         api_key, photoset_id, user_id
     )
 
-    # On stocke l'objet de la réponse HTTP dans r.
-    r = requests.get(url_query)
-
-    # Si le code HTTP de la requête est 200 (success), r est converti en objet JSON et stocké dans data.
-    # On vérifie que la requête à l'API a bien abouti avec data["stat"] == "ok"
-    # On récupère trois données par image sous forme de liste.
-    # L'identifiant de l'image, le secret, et le server.
-    # Chaque liste est stockée dans la liste imgs. Un index = une image.
-    # Si la requête renvoie un autre code que 200, ou si la requête n'a pas abouti, alors la fonction retourne False.
-    if r.status_code == 200:
-        data = r.json()
-        if data["stat"] == "ok":
-            for item in data['photoset']['photo']:
-                imgs.append([item['id'], item['secret'], item["server"]])
-        else:
-            return False
-    else:
+
+def photoset_flickr_stream(api_key, photoset_id, user_id, max_workers=8, timeout=10, session=None, cache=None):
+    """ Récupère, sous forme de flux, les URL des images d'un album Flickr via l'API de Flickr.
+    La première page de l'album est récupérée immédiatement, pour détecter les erreurs (API key erronée,
+    album inexistant, etc.). Les autres pages sont récupérées en parallèle pendant la lecture du flux.
+    Si une page ne peut pas être récupérée pendant la lecture, le flux lève une FlickrQueryError
+    plutôt que de tronquer l'album.
+
+    :param api_key: API key pour utiliser l'API de Flickr.
+    :type api_key: str
+    :param photoset_id: identifiant de l'album Flickr duquel on veut récupérer les images.
+    :type photoset_id: int
+    :param user_id: ID de l'utilisateur-rice à qui appartient l'album duquel on veut récupérer les images.
+    :type user_id: str
+    :param max_workers: nombre maximum de requêtes lancées en même temps.
+    :type max_workers: int
+    :param timeout: délai maximum (en secondes) accordé à chaque requête HTTP.
+    :type timeout: float
+    :param session: session HTTP à utiliser. Si None, une session est créée pour l'occasion.
+    :type session: requests.Session
+    :param cache: cache des réponses HTTP. Si None, chaque page est demandée à l'API.
+    :type cache: HttpCache
+    :return: tuple (URL de la requête, générateur d'URL d'images, nombre total de photos) ou False
+    :rtype: tuple or bool
+    """
+
+    url_query = photoset_flickr_url(api_key, photoset_id, user_id)
+
+    if cache is None:
+        cache = HttpCache()
+
+    # On crée une session HTTP unique, réutilisée pour toutes les requêtes de l'album.
+    own_session = session is None
+    if own_session:
+        session = create_session(pool_size=max_workers)
+
+    # Si la première page ne peut pas être récupérée, la fonction retourne False.
+    try:
+        first_page = _photoset_page(session, url_query, 1, timeout, cache)
+    except FlickrQueryError:
+        if own_session:
+            session.close()
+        return False
+
+    urls = _iter_photoset_urls(session, url_query, first_page, max_workers, timeout, cache, own_session)
+    return url_query, urls, int(first_page.get("total", len(first_page["photo"])))
+
+
+def photoset_flickr_query(api_key, photoset_id, user_id, max_workers=8, timeout=10, cache=None):
+    """ Récupère une liste d'URL depuis un album Flickr via l'API de Flickr.
+    Chaque URL correspond à une image de ladite collection.
+
+    :param api_key: API key pour utiliser l'API de Flickr.
+    :type api_key: str
+    :param photoset_id: identifiant de l'album Flickr duquel on veut récupérer les images.
+    :type photoset_id: int
+    :param user_id: ID de l'utilisateur-rice à qui appartient l'album duquel on veut récupérer les images.
+    :type user_id: str
+    :param max_workers: nombre maximum de requêtes lancées en même temps.
+    :type max_workers: int
+    :param timeout: délai maximum (en secondes) accordé à chaque requête HTTP.
+    :type timeout: float
+    :param cache: cache des réponses HTTP. Si None, chaque page est demandée à l'API.
+    :type cache: HttpCache
+    :return: tuple (URL de la requête, liste d'URL d'images) ou False
+    :rtype: tuple or bool
+    """
+
+    stream = photoset_flickr_stream(
+        api_key, photoset_id, user_id, max_workers=max_workers, timeout=timeout, cache=cache
+    )
+    if not stream:
         return False
+    url_query, urls, total = stream
 
-    # L'objet JSON récupéré depuis l'API Flickr renvoie une liste inversée des images d'une collection.
-    # Pour obtenir l'ordre original des images dans la liste, visible sur un navigateur, on inverse la liste imgs.
-    imgs = imgs[::-1]
-
-    # On crée une liste vide url_list qui va stocker les URL de chaque image de l'album.
-    url_list = []
-
-    # On construit l'URL de chaque image à partir des données préalablement récupérées.
-    # Au sein des listes imbriquées de imgs :
-    # Index 0 = ID de l'image
-    # Index 1 = secret
-    # Index 2 = server
-    # le paramètre b dans l'URL créée permet de récupérer l'image dans un format large (1024 px maximum pour un côté).
-    # Chaque URL est stockée dans la liste url_list.
-    for idx in imgs:
-        id = idx[0]
-        secret = idx[1]
-        server = idx[2]
-        # On construit l'URL
-        query = "https://live.staticflickr.com/{0}/{1}_{2}_{3}.jpg".format(server, id, secret, "b")
-        # On teste chaque URL pour savoir si le code de réponse HTTP est 200.
-        # On s'assure ainsi que chaque URL, au moment de sa récupération, est valide.
-        request = requests.get(query)
-        # Si le code HTTP est 200, alors on ajoute l'URL à url_list.
-        if request.status_code == 200:
-            url_list.append(query)
+    # Si une page de l'album n'a pas pu être récupérée, on renvoie False plutôt qu'un album tronqué.
+    try:
+        url_list = list(urls)
+    except FlickrQueryError:
+        return False
 
     return url_query, url_list
 
@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import time
+
+import requests
+
+
+class HttpCache:
+    """ Cache local des réponses HTTP des sources d'images (manifests IIIF, pages d'albums Flickr).
+    Les réponses sont stockées dans une base SQLite, partagée par tous les processus de l'application.
+    Une réponse plus récente que ttl est renvoyée sans requête. Au-delà, elle est revalidée avec une requête
+    conditionnelle (ETag / Last-Modified) : si la source n'a pas changé, le serveur répond 304 sans renvoyer le contenu.
+    Quand la taille totale du cache dépasse max_size, les réponses les moins récemment utilisées sont supprimées.
+    Si path est None, le cache est désactivé et chaque appel à get() fait une requête simple.
+    """
+
+    def __init__(self, path=None, ttl=3600, max_size=200 * 1024 * 1024, max_entry_size=50 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        if path:
+            self._create_table()
+
+    def init_app(self, app):
+        """ Configure le cache à partir de la configuration de l'application.
+        Un chemin relatif est résolu depuis la racine de l'application, comme pour la base de données.
+
+        :param app: application Flask
+        """
+
+        path = app.config.get("HTTP_CACHE_PATH")
+        if path and not os.path.isabs(path):
+            path = os.path.join(app.root_path, path)
+        self.__init__(
+            path=path,
+            ttl=app.config.get("HTTP_CACHE_TTL", self.ttl),
+            max_size=app.config.get("HTTP_CACHE_MAX_SIZE", self.max_size),
+            max_entry_size=app.config.get("HTTP_CACHE_MAX_ENTRY_SIZE", self.max_entry_size)
+        )
+
+    def _connect(self):
+        # Une connexion par appel : les connexions SQLite ne se partagent pas entre threads.
+        # timeout laisse le temps aux autres processus de terminer leur écriture.
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _create_table(self):
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS response ("
+                "url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, body BLOB NOT NULL, "
+                "size INTEGER NOT NULL, fetched_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_response_accessed_at ON response (accessed_at)")
+        connection.close()
+
+    def get(self, url, session=None, timeout=None, validate=None):
+        """ Récupère le contenu d'une URL, depuis le cache si possible.
+
+        :param url: URL de la ressource.
+        :type url: str
+        :param session: session HTTP à utiliser. Si None, requests est utilisé directement.
+        :type session: requests.Session
+        :param timeout: délai maximum (en secondes) accordé à la requête.
+        :type timeout: float
+        :param validate: fonction appelée avec le contenu d'une réponse 200, qui renvoie False si la réponse
+        ne doit pas être mise en cache (erreur signalée dans le contenu, comme les erreurs de l'API Flickr).
+        :type validate: callable
+        :return: tuple (code HTTP, contenu de la réponse)
+        :rtype: tuple
+        """
+
+        http = session or requests
+
+        if not self.path:
+            r = http.get(url, timeout=timeout)
+            return r.status_code, r.content
+
+        now = time.time()
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT etag, last_modified, body, fetched_at FROM response WHERE url = ?", (url,)
+            ).fetchone()
+
+            # La réponse en cache est assez récente : aucune requête n'est faite.
+            if row and now - row[3] < self.ttl:
+                with connection:
+                    connection.execute("UPDATE response SET accessed_at = ? WHERE url = ?", (now, url))
+                return 200, row[2]
+
+            # On revalide la réponse en cache avec une requête conditionnelle.
+            headers = {}
+            if row and row[0]:
+                headers["If-None-Match"] = row[0]
+            if row and row[1]:
+                headers["If-Modified-Since"] = row[1]
+
+            r = http.get(url, headers=headers, timeout=timeout)
+
+            if r.status_code == 304 and row:
+                with connection:
+                    connection.execute(
+                        "UPDATE response SET fetched_at = ?, accessed_at = ? WHERE url = ?", (now, now, url)
+                    )
+                return 200, row[2]
+
+            if r.status_code == 200 and len(r.content) <= self.max_entry_size \
+                    and (validate is None or validate(r.content)):
+                self._store(connection, url, r, now)
+
+            return r.status_code, r.content
+        finally:
+            connection.close()
+
+    def _store(self, connection, url, response, now):
+        """ Enregistre une réponse dans le cache puis supprime les réponses les moins récemment utilisées
+        si la taille maximale du cache est dépassée.
+        """
+
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO response (url, etag, last_modified, body, size, fetched_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                 response.content, len(response.content), now, now)
+            )
+            total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM response").fetchone()[0]
+            if total > self.max_size:
+                excess = total - self.max_size
+                freed = 0
+                for old_url, size in connection.execute(
+                        "SELECT url, size FROM response ORDER BY accessed_at").fetchall():
+                    if freed >= excess:
+                        break
+                    connection.execute("DELETE FROM response WHERE url = ?", (old_url,))
+                    freed += size
@@ -1,8 +1,44 @@
 import requests
 
+from .json_stream import iter_array_items
 
-def iiif_query(manifest, from_f, to_f):
+# Taille (en octets) des morceaux lus successivement dans la réponse HTTP.
+MANIFEST_CHUNK_SIZE = 64 * 1024
+
+
+def _resource_info(resource):
+    """ Retourne le format, les dimensions et le service IIIF d'une image tels que décrits par le manifest.
+
+    :param resource: ressource de l'image dans le manifest
+    :type resource: dict
+    :return: dictionnaire (width, height, format, service)
+    :rtype: dict
+    """
+
+    service = resource.get("service")
+    if isinstance(service, list):
+        service = service[0] if service else None
+    if isinstance(service, dict):
+        service = service.get("@id") or service.get("id")
+    try:
+        width = int(resource["width"])
+        height = int(resource["height"])
+    except (KeyError, TypeError, ValueError):
+        width = height = None
+    return {
+        "width": width,
+        "height": height,
+        "format": resource.get("format"),
+        "service": service.rstrip("/") if isinstance(service, str) else None
+    }
+
+
+def iiif_query(manifest, from_f, to_f, cache=None, metadata=None, timeout=30):
     """ Récupère une liste d'URL d'images à partir d'un manifest IIIF.
+    Le manifest est lu en flux : les canvases situés avant from_f sont parcourus sans être décodés,
+    et la lecture s'arrête dès que to_f est atteint.
+    Si un cache est donné, le manifest est récupéré en entier depuis le cache (ou revalidé auprès du serveur),
+    puis lu en flux de la même manière.
 
     :param manifest: URL du manifest IIIF duquel seront récupérées les URL de chaque image.
     :type manifest: str
@@ -10,6 +46,13 @@ def iiif_query(manifest, from_f, to_f):
     :type from_f: int
     :param to_f: Deuxième chiffre de l'intervalle.
     :type to_f: int
+    :param cache: cache des réponses HTTP. Si None, le manifest est lu directement depuis le serveur.
+    :type cache: HttpCache
+    :param metadata: si un dictionnaire est donné, il est rempli avec le format, les dimensions et le service IIIF
+    de chaque image décrits par le manifest (clé : URL de l'image).
+    :type metadata: dict
+    :param timeout: délai maximum (en secondes) accordé à la connexion au serveur et à chaque lecture de la réponse.
+    :type timeout: float
     :return: Liste des URL des images sélectionnées du manifest IIIF.
     :rtype: list
     """
@@ -26,35 +69,61 @@ def iiif_query(manifest, from_f, to_f):
     except ValueError:
         return False
 
-    # On stocke l'objet de la réponse HTTP dans r.
-    r = requests.get(manifest)
-
-    # Si le code HTTP de la requête est 200 (success), r est converti en objet JSON et stocké dans data.
-    # Pour chaque image du manifest IIIF, on stocke dans img_url l'URL de l'image.
-    # Si la requête renvoie un autre code que 200, alors la fonction retourne False.
-    if r.status_code == 200:
-        data = r.json()
-        for item in data['sequences']:
-            for page in item['canvases']:
-                for img_data in page["images"]:
-                    img_url = img_data["resource"]["@id"]
-                    # Nous pourrions tester chaque URL pour savoir si le code de réponse HTTP est 200 avec :
-                    # request = requests.get(img_url)
-                    # Si le code HTTP est 200, alors on ajoute l'URL à url_list.
-                    # if request.status_code == 200:
-                        # url_img_list.append(img_url)
-                    # Cependant, obtenir le code de réponse HTTP pour chaque image d'un manifest volumineux
-                    # prend trop de temps.
-                    # On ajoute donc les liens sans vérifier leur validité.
-                    url_img_list.append(img_url)
-    else:
-        return False
-
     # Afin d'améliorer l'expérience utilisateur-rice, on modifie la gestion des index de la liste.
-    # Puis, on slice url_img_list selon le choix de l'utilisateur-rice.
     if from_f >= 1:
         from_f = from_f - 1
-    url_img_list = url_img_list[from_f:to_f]
+
+    # Un intervalle contenant un index négatif se compte depuis la fin du manifest :
+    # il faut alors lire le manifest en entier, puis découper la liste comme une liste Python.
+    whole_manifest = from_f < 0 or to_f < 0
+
+    # On stocke l'objet de la réponse HTTP dans r.
+    # Sans cache, stream=True permet de lire le contenu de la réponse au fur et à mesure,
+    # sans le télécharger en entier.
+    try:
+        if cache is not None and cache.path:
+            status_code, content = cache.get(manifest, timeout=timeout)
+            r = None
+            chunks = (content[i:i + MANIFEST_CHUNK_SIZE] for i in range(0, len(content), MANIFEST_CHUNK_SIZE))
+        else:
+            r = requests.get(manifest, stream=True, timeout=timeout)
+            status_code = r.status_code
+            chunks = r.iter_content(chunk_size=MANIFEST_CHUNK_SIZE)
+    except requests.RequestException:
+        return False
+
+    # Si le code HTTP de la requête est 200 (success), on lit le manifest morceau par morceau.
+    # Pour chaque image des canvases sélectionnés, on stocke dans img_url l'URL de l'image.
+    # Si la requête renvoie un autre code que 200, ou si le manifest est invalide, alors la fonction retourne False.
+    try:
+        if status_code != 200:
+            return False
+
+        canvases = iter_array_items(
+            chunks,
+            "canvases",
+            start=0 if whole_manifest else from_f,
+            stop=None if whole_manifest else to_f
+        )
+        for page in canvases:
+            for img_data in page["images"]:
+                img_url = img_data["resource"]["@id"]
+                # Obtenir le code de réponse HTTP pour chaque image d'un manifest volumineux prend trop de temps.
+                # On ajoute donc les liens sans vérifier leur validité.
+                url_img_list.append(img_url)
+                # Les dimensions de l'image et son service IIIF sont souvent dans le manifest :
+                # ils n'auront pas à être demandés au serveur d'images.
+                if metadata is not None:
+                    metadata[img_url] = _resource_info(img_data["resource"])
+    except (ValueError, KeyError, TypeError, requests.RequestException):
+        return False
+    finally:
+        # On ferme la connexion : le reste du manifest n'est pas téléchargé.
+        if r is not None:
+            r.close()
+
+    if whole_manifest:
+        url_img_list = url_img_list[from_f:to_f]
 
     return url_img_list
 
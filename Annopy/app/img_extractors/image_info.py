@@ -0,0 +1,275 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import re
+
+import requests
+
+from .url_validator import create_session
+
+# Taille (en octets) des morceaux lus successivement dans le début d'une image.
+SNIFF_CHUNK_SIZE = 8 * 1024
+
+# URL d'une image servie par un serveur IIIF (Image API) :
+# {service}/{region}/{size}/{rotation}/{quality}.{format}
+IIIF_IMAGE_URL = re.compile(
+    r"^(?P<service>https?://.+?)"
+    r"/(?:full|square|\d+,\d+,\d+,\d+|pct:[\d.]+,[\d.]+,[\d.]+,[\d.]+)"
+    r"/(?:full|max|\^?!?\d*,\d*|\^?pct:[\d.]+)"
+    r"/!?\d+(?:\.\d+)?"
+    r"/(?:default|native|color|gray|grey|bitonal)\.(?P<extension>[a-z0-9]+)$",
+    re.IGNORECASE
+)
+
+# Type MIME des formats d'images, selon l'extension de leur URL.
+FORMATS = {
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "tif": "image/tiff",
+    "tiff": "image/tiff",
+    "jp2": "image/jp2",
+    "webp": "image/webp"
+}
+
+# Marqueurs JPEG sans segment (pas de longueur après le marqueur).
+_JPEG_STANDALONE = {0x01} | set(range(0xD0, 0xDA))
+# Marqueurs JPEG de début d'image (Start Of Frame), qui contiennent les dimensions.
+_JPEG_SOF = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def iiif_service(url):
+    """ Retourne l'URL du service IIIF (Image API) d'une URL d'image, si l'URL en suit la syntaxe.
+
+    :param url: URL de l'image
+    :type url: str
+    :return: URL du service, ou None
+    :rtype: str
+    """
+
+    match = IIIF_IMAGE_URL.match(url)
+    return match.group("service") if match else None
+
+
+def url_format(url):
+    """ Retourne le type MIME d'une image d'après l'extension de son URL.
+
+    :param url: URL de l'image
+    :type url: str
+    :return: type MIME, ou None
+    :rtype: str
+    """
+
+    extension = url.split("?", 1)[0].rsplit("/", 1)[-1].rpartition(".")[2].lower()
+    return FORMATS.get(extension)
+
+
+def _jpeg_dimensions(data):
+    """ Parcourt les segments d'un JPEG jusqu'au marqueur SOF et retourne les dimensions de l'image.
+
+    :param data: début du fichier
+    :type data: bytes
+    :return: tuple (largeur, hauteur), ou None s'il faut lire la suite du fichier
+    :rtype: tuple
+    """
+
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            # Fichier invalide : on ne lit pas plus loin.
+            return 0, 0
+        marker = data[position + 1]
+        if marker == 0xFF:
+            # Octet de remplissage.
+            position += 1
+            continue
+        if marker in _JPEG_STANDALONE:
+            position += 2
+            continue
+        length = int.from_bytes(data[position + 2:position + 4], "big")
+        if marker in _JPEG_SOF:
+            if position + 9 > len(data):
+                return None
+            height = int.from_bytes(data[position + 5:position + 7], "big")
+            width = int.from_bytes(data[position + 7:position + 9], "big")
+            return width, height
+        position += 2 + length
+    return None
+
+
+def sniff_dimensions(data):
+    """ Détermine le format et les dimensions d'une image à partir du début du fichier (JPEG, PNG, GIF).
+
+    :param data: début du fichier
+    :type data: bytes
+    :return: tuple (type MIME, largeur, hauteur). Le type MIME est None si le format n'est pas reconnu ;
+    la largeur et la hauteur sont None s'il faut lire la suite du fichier.
+    :rtype: tuple
+    """
+
+    if data[:3] == b"\xff\xd8\xff":
+        dimensions = _jpeg_dimensions(data)
+        if dimensions is None:
+            return "image/jpeg", None, None
+        return ("image/jpeg",) + dimensions
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if len(data) < 24:
+            return "image/png", None, None
+        return "image/png", int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data[:4] == b"GIF8":
+        if len(data) < 10:
+            return "image/gif", None, None
+        return "image/gif", int.from_bytes(data[6:8], "little"), int.from_bytes(data[8:10], "little")
+    return None, None, None
+
+
+def sniff_image(session, url, timeout=10, max_bytes=64 * 1024):
+    """ Récupère le format et les dimensions d'une image en ne téléchargeant que le début du fichier
+    (requête GET partielle). La lecture s'arrête dès que les dimensions sont trouvées, ou après max_bytes octets.
+
+    :param session: session HTTP utilisée pour la requête.
+    :type session: requests.Session
+    :param url: URL de l'image.
+    :type url: str
+    :param timeout: délai maximum (en secondes) accordé à la requête.
+    :type timeout: float
+    :param max_bytes: nombre maximum d'octets lus.
+    :type max_bytes: int
+    :return: dictionnaire (width, height, format, service), ou None
+    :rtype: dict
+    """
+
+    # Si le serveur ignore l'en-tête Range (code 200), la réponse est lue en flux et fermée de la même manière.
+    r = session.get(url, headers={"Range": "bytes=0-{0}".format(max_bytes - 1)}, timeout=timeout, stream=True)
+    try:
+        if r.status_code not in (200, 206):
+            return None
+        data = b""
+        image_format = width = None
+        for chunk in r.iter_content(chunk_size=SNIFF_CHUNK_SIZE):
+            data += chunk
+            image_format, width, height = sniff_dimensions(data)
+            if width is not None or (image_format is None and len(data) >= 8) or len(data) >= max_bytes:
+                break
+    finally:
+        r.close()
+
+    if image_format is None:
+        image_format = r.headers.get("Content-Type", "").split(";", 1)[0].strip() or url_format(url)
+    if not width:
+        return {"width": None, "height": None, "format": image_format, "service": None} if image_format else None
+    return {"width": width, "height": height, "format": image_format, "service": None}
+
+
+def iiif_info(session, service, timeout=10, cache=None):
+    """ Récupère les dimensions d'une image depuis le document info.json de son service IIIF.
+
+    :param session: session HTTP utilisée pour la requête.
+    :type session: requests.Session
+    :param service: URL du service IIIF de l'image.
+    :type service: str
+    :param timeout: délai maximum (en secondes) accordé à la requête.
+    :type timeout: float
+    :param cache: cache des réponses HTTP. Si None, info.json est lu directement depuis le serveur.
+    :type cache: HttpCache
+    :return: dictionnaire (width, height, format, service), ou None
+    :rtype: dict
+    """
+
+    url = service.rstrip("/") + "/info.json"
+    if cache is not None:
+        status_code, content = cache.get(url, session=session, timeout=timeout)
+    else:
+        r = session.get(url, timeout=timeout)
+        status_code, content = r.status_code, r.content
+    if status_code != 200:
+        return None
+
+    try:
+        info = json.loads(content)
+        width = int(info["width"])
+        height = int(info["height"])
+    except (ValueError, KeyError, TypeError):
+        return None
+    # L'identifiant du service est "@id" (Image API 2) ou "id" (Image API 3).
+    return {
+        "width": width,
+        "height": height,
+        "format": None,
+        "service": (info.get("@id") or info.get("id") or service).rstrip("/")
+    }
+
+
+def fetch_image_info(session, url, service=None, timeout=10, max_bytes=64 * 1024, cache=None):
+    """ Récupère le format, les dimensions et le service IIIF d'une image, sans télécharger l'image :
+    depuis info.json pour une image IIIF (service connu ou déduit de l'URL), depuis le début du fichier sinon
+    (images Flickr).
+
+    :param session: session HTTP utilisée pour les requêtes.
+    :type session: requests.Session
+    :param url: URL de l'image.
+    :type url: str
+    :param service: URL du service IIIF de l'image, si elle est connue (manifest).
+    :type service: str
+    :param timeout: délai maximum (en secondes) accordé à chaque requête.
+    :type timeout: float
+    :param max_bytes: nombre maximum d'octets lus au début de l'image.
+    :type max_bytes: int
+    :param cache: cache des réponses HTTP (documents info.json).
+    :type cache: HttpCache
+    :return: dictionnaire (width, height, format, service), ou None si rien n'a pu être récupéré
+    :rtype: dict
+    """
+
+    try:
+        service = service or iiif_service(url)
+        if service:
+            info = iiif_info(session, service, timeout=timeout, cache=cache)
+            if info is not None:
+                info["format"] = url_format(url)
+                return info
+        return sniff_image(session, url, timeout=timeout, max_bytes=max_bytes)
+    except requests.RequestException:
+        # Une image injoignable (timeout, erreur de connexion) n'a pas de métadonnées.
+        return None
+
+
+def prefetch_image_info(images, max_workers=8, timeout=10, max_bytes=64 * 1024, session=None, cache=None):
+    """ Récupère en parallèle le format, les dimensions et le service IIIF d'une liste d'images.
+    L'ordre des résultats est celui de la liste donnée en paramètre.
+
+    :param images: tuples (URL de l'image, URL de son service IIIF ou None)
+    :type images: list
+    :param max_workers: nombre maximum de requêtes lancées en même temps.
+    :type max_workers: int
+    :param timeout: délai maximum (en secondes) accordé à chaque requête.
+    :type timeout: float
+    :param max_bytes: nombre maximum d'octets lus au début de chaque image.
+    :type max_bytes: int
+    :param session: session HTTP à utiliser. Si None, une session est créée pour l'occasion.
+    :type session: requests.Session
+    :param cache: cache des réponses HTTP (documents info.json).
+    :type cache: HttpCache
+    :return: liste des dictionnaires (width, height, format, service) ou None
+    :rtype: list
+    """
+
+    images = list(images)
+    if not images:
+        return []
+
+    own_session = session is None
+    if own_session:
+        session = create_session(pool_size=max_workers)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(
+                lambda image: fetch_image_info(
+                    session, image[0], service=image[1], timeout=timeout, max_bytes=max_bytes, cache=cache
+                ),
+                images
+            ))
+    finally:
+        if own_session:
+            session.close()
@@ -0,0 +1,126 @@
+import codecs
+import json
+import re
+
+# Caractères qui modifient la structure d'un document JSON, hors chaînes de caractères.
+_STRUCTURE = re.compile(r'[{}\[\]":,]')
+# Caractères significatifs à l'intérieur d'une chaîne de caractères.
+_IN_STRING = re.compile(r'["\\]')
+
+
+def iter_array_items(chunks, key, start=0, stop=None):
+    """ Parcourt un document JSON morceau par morceau et renvoie les éléments des tableaux
+    stockés sous la clé key (par exemple "canvases" dans un manifest IIIF).
+    Le document n'est jamais chargé entièrement en mémoire : seuls les éléments dont l'index est compris
+    entre start (inclus) et stop (exclu) sont décodés. Les éléments précédents sont parcourus sans être construits,
+    et la lecture s'arrête dès que l'index stop est atteint.
+    Les index sont comptés à la suite sur tous les tableaux portant la clé key.
+
+    :param chunks: morceaux successifs du document (bytes encodés en UTF-8 ou str).
+    :type chunks: iterable
+    :param key: nom de la clé des tableaux dont on veut récupérer les éléments.
+    :type key: str
+    :param start: index du premier élément à renvoyer.
+    :type start: int
+    :param stop: index auquel la lecture s'arrête. Si None, le document est lu jusqu'au bout.
+    :type stop: int
+    :return: éléments décodés des tableaux
+    :rtype: generator
+    """
+
+    if stop is not None and stop <= start:
+        return
+
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buf = ""
+    pos = 0
+    # Pile des conteneurs ouverts.
+    # Objet : ["o", attend_une_clé, dernière_clé]. Tableau : ["a", est_un_tableau_cible].
+    stack = []
+    in_string = False
+    string_start = None
+    string_is_key = False
+    # Profondeur de la pile à laquelle se trouve l'élément en cours de lecture, et début de sa capture.
+    item_depth = None
+    capture_start = None
+    index = 0
+
+    for chunk in chunks:
+        buf += decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+        while True:
+            if in_string:
+                m = _IN_STRING.search(buf, pos)
+                if m is None:
+                    pos = len(buf)
+                    break
+                i = m.start()
+                if m.group() == "\\":
+                    # Le caractère échappé peut se trouver dans le morceau suivant.
+                    if i + 1 >= len(buf):
+                        pos = i
+                        break
+                    pos = i + 2
+                    continue
+                in_string = False
+                pos = i + 1
+                if string_is_key:
+                    stack[-1][2] = json.loads(buf[string_start:pos])
+                continue
+
+            m = _STRUCTURE.search(buf, pos)
+            if m is None:
+                pos = len(buf)
+                break
+            i = m.start()
+            c = m.group()
+            pos = i + 1
+            top = stack[-1] if stack else None
+
+            if c == '"':
+                in_string = True
+                string_start = i
+                # On ne garde le texte d'une chaîne que s'il s'agit d'une clé, hors des éléments en cours de lecture.
+                string_is_key = item_depth is None and top is not None and top[0] == "o" and top[1]
+            elif c == ":":
+                if top is not None and top[0] == "o":
+                    top[1] = False
+            elif c == ",":
+                if top is not None and top[0] == "o":
+                    top[1] = True
+            elif c in "{[":
+                if item_depth is None and top is not None and top[0] == "a" and top[1]:
+                    # Début d'un élément d'un tableau cible.
+                    item_depth = len(stack)
+                    if index >= start:
+                        capture_start = i
+                if c == "{":
+                    stack.append(["o", True, None])
+                else:
+                    is_target = item_depth is None and top is not None and top[0] == "o" and top[2] == key
+                    stack.append(["a", is_target])
+            else:
+                stack.pop()
+                if item_depth is not None and len(stack) == item_depth:
+                    # Fin d'un élément d'un tableau cible.
+                    if capture_start is not None:
+                        yield json.loads(buf[capture_start:pos])
+                        capture_start = None
+                    item_depth = None
+                    index += 1
+                    if stop is not None and index >= stop:
+                        return
+
+        # On oublie la partie du document déjà lue, sauf l'élément ou la clé en cours de capture.
+        keep = pos
+        if capture_start is not None:
+            keep = min(keep, capture_start)
+        if in_string and string_is_key:
+            keep = min(keep, string_start)
+        if keep:
+            buf = buf[keep:]
+            pos -= keep
+            if capture_start is not None:
+                capture_start -= keep
+            if string_start is not None:
+                string_start -= keep
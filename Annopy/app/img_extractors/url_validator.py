@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def create_session(pool_size=8):
+    """ Crée une session HTTP dont les connexions sont gardées ouvertes (keep-alive) et réutilisées.
+
+    :param pool_size: nombre maximum de connexions gardées ouvertes par hôte.
+    :type pool_size: int
+    :return: session HTTP
+    :rtype: requests.Session
+    """
+
+    session = requests.Session()
+    # On dimensionne le pool de connexions selon le nombre de requêtes lancées en parallèle.
+    # Sans cela, requests ne garde que 10 connexions par hôte et en rouvre de nouvelles à chaque dépassement.
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def check_url(session, url, timeout=10):
+    """ Vérifie qu'une URL d'image renvoie le code HTTP 200, sans télécharger l'image.
+
+    :param session: session HTTP utilisée pour la requête.
+    :type session: requests.Session
+    :param url: URL de l'image à vérifier.
+    :type url: str
+    :param timeout: délai maximum (en secondes) accordé à la requête.
+    :type timeout: float
+    :return: True si l'URL est valide, False sinon.
+    :rtype: bool
+    """
+
+    try:
+        # On fait une requête HEAD : le serveur ne renvoie que les en-têtes, pas le contenu de l'image.
+        r = session.head(url, timeout=timeout, allow_redirects=True)
+        # Certains serveurs refusent la méthode HEAD (405, 501).
+        # On demande alors uniquement le premier octet de l'image avec une requête GET partielle.
+        if r.status_code in (405, 501):
+            r = session.get(url, headers={"Range": "bytes=0-0"}, timeout=timeout, stream=True)
+            r.close()
+            return r.status_code in (200, 206)
+        return r.status_code == 200
+    except requests.RequestException:
+        # Une URL injoignable (timeout, erreur de connexion) est considérée comme invalide.
+        return False
+
+
+def validate_urls(urls, max_workers=8, timeout=10, session=None):
+    """ Vérifie en parallèle une liste d'URL et renvoie celles qui sont valides.
+    L'ordre des URL renvoyées est celui de la liste donnée en paramètre.
+
+    :param urls: liste des URL à vérifier.
+    :type urls: list
+    :param max_workers: nombre maximum de vérifications lancées en même temps.
+    :type max_workers: int
+    :param timeout: délai maximum (en secondes) accordé à chaque requête.
+    :type timeout: float
+    :param session: session HTTP à utiliser. Si None, une session est créée pour l'occasion.
+    :type session: requests.Session
+    :return: liste des URL valides
+    :rtype: list
+    """
+
+    urls = list(urls)
+    if not urls:
+        return []
+
+    own_session = session is None
+    if own_session:
+        session = create_session(pool_size=max_workers)
+
+    try:
+        # executor.map renvoie les résultats dans l'ordre des URL données, quel que soit l'ordre d'exécution.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(lambda url: check_url(session, url, timeout), urls)
+            return [url for url, valid in zip(urls, results) if valid]
+    finally:
+        if own_session:
+            session.close()
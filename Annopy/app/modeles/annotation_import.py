@@ -0,0 +1,379 @@
+import datetime
+import gzip
+import json
+import os
+import time
+
+from sqlalchemy import select
+
+from ..app import db
+from ..img_extractors.json_stream import iter_array_items
+from .changes import record_changes
+from .counters import add_annotation_counts, refresh_collection_counters
+from .data import Annotation, AuthorshipAnnotation, CollectionHasImages, Image
+from .pagination import invalidate_counts
+from .regions import bbox_columns, selector_bbox
+from .search import index_annotations, search_enabled
+from .versions import bump_session_versions
+
+# Formats d'import :
+# - "jsonl" : une ligne JSON par annotation W3C, par AnnotationPage (avec items), ou au format de l'export
+#   (objet avec une clé "annotation") ;
+# - "w3c" : un document JSON, AnnotationPage ou AnnotationCollection : les annotations des tableaux "items"
+#   sont lues en flux, sans charger le document en mémoire.
+IMPORT_FORMATS = ("jsonl", "w3c")
+
+# Nombre d'URL d'images recherchées par requête.
+_LOOKUP_SIZE = 500
+# Nombre maximum d'URL d'images gardées en mémoire par ImageLookup.
+_LOOKUP_CACHE_SIZE = 100000
+
+
+def open_input(path):
+    """ Ouvre un fichier à importer en lecture binaire, en le décompressant s'il se termine par .gz.
+
+    :param path: chemin du fichier
+    :type path: str
+    :return: fichier ouvert
+    """
+
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def format_from_path(path):
+    """ Déduit le format d'un fichier à importer de son extension (.json : "w3c", sinon "jsonl").
+
+    :param path: chemin du fichier
+    :type path: str
+    :rtype: str
+    """
+
+    name = path[:-3] if path.endswith(".gz") else path
+    return "w3c" if name.endswith(".json") or name.endswith(".jsonld") else "jsonl"
+
+
+def _annotations_from(document):
+    """ Retourne les annotations contenues dans un objet JSON : une annotation, une AnnotationPage,
+    une AnnotationCollection (avec sa première page) ou une ligne de l'export.
+    """
+
+    if not isinstance(document, dict):
+        return [document]
+    if document.get("type") == "AnnotationCollection" and isinstance(document.get("first"), dict):
+        document = document["first"]
+    if document.get("type") == "AnnotationPage":
+        items = document.get("items")
+        return items if isinstance(items, list) else [None]
+    if document.get("type") != "Annotation" and isinstance(document.get("annotation"), dict):
+        return [document["annotation"]]
+    return [document]
+
+
+def iter_units(stream, import_format="jsonl", start=0):
+    """ Lit un fichier à importer, unité par unité : une ligne pour le format "jsonl", une annotation pour le format
+    "w3c". Chaque unité est renvoyée avec sa position (nombre d'unités lues depuis le début du fichier) : l'import
+    peut reprendre après la dernière unité enregistrée, sans décoder les unités précédentes.
+
+    :param stream: fichier ouvert en lecture binaire
+    :param import_format: "jsonl" ou "w3c"
+    :type import_format: str
+    :param start: nombre d'unités déjà importées, à passer
+    :type start: int
+    :return: tuples (position, annotations de l'unité ; None pour une annotation illisible)
+    :rtype: generator
+    """
+
+    if import_format == "w3c":
+        chunks = iter(lambda: stream.read(64 * 1024), b"")
+        for position, item in enumerate(iter_array_items(chunks, "items", start=start), start + 1):
+            yield position, [item]
+        return
+
+    for position, line in enumerate(stream, 1):
+        if position <= start:
+            continue
+        line = line.strip()
+        if not line:
+            yield position, []
+            continue
+        try:
+            yield position, _annotations_from(json.loads(line))
+        except ValueError:
+            yield position, [None]
+
+
+def annotation_source(annotation):
+    """ Retourne l'URL de l'image annotée (target.source), sans fragment (#xywh=...).
+
+    :param annotation: annotation au format W3C Web Annotation
+    :type annotation: dict
+    :return: URL de l'image, ou None si la cible n'est pas trouvée
+    :rtype: str
+    """
+
+    target = annotation.get("target")
+    if isinstance(target, list):
+        target = target[0] if target else None
+    source = target.get("source", target.get("id")) if isinstance(target, dict) else target
+    if isinstance(source, dict):
+        source = source.get("id")
+    if not isinstance(source, str) or not source:
+        return None
+    return source.split("#", 1)[0]
+
+
+def _created(annotation, default):
+    """ Retourne la date de création d'une annotation (propriété W3C "created", ISO 8601), ou default. """
+
+    created = annotation.get("created")
+    if not isinstance(created, str):
+        return default
+    try:
+        date = datetime.datetime.fromisoformat(created.replace("Z", "+00:00"))
+    except ValueError:
+        return default
+    if date.tzinfo is not None:
+        date = date.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return date
+
+
+class ImageLookup:
+    """ Retrouve l'ID des images à partir de leur URL (image_url, indexée), par lots de requêtes IN.
+    Les URL déjà recherchées sont gardées en mémoire. Si plusieurs images ont la même URL, la plus ancienne est choisie.
+    """
+
+    def __init__(self, collection_id=None):
+        self.collection_id = collection_id
+        self._cache = {}
+
+    def resolve(self, urls):
+        """ Recherche les images d'une liste d'URL.
+
+        :param urls: URL des images
+        :type urls: iterable
+        :return: dictionnaire URL -> ID de l'image (None si aucune image n'a cette URL)
+        :rtype: dict
+        """
+
+        urls = list(urls)
+        missing = sorted({url for url in urls if url not in self._cache})
+        if len(self._cache) + len(missing) > _LOOKUP_CACHE_SIZE:
+            self._cache.clear()
+
+        for index in range(0, len(missing), _LOOKUP_SIZE):
+            chunk = missing[index:index + _LOOKUP_SIZE]
+            query = db.session.query(Image.image_url, Image.image_id).filter(Image.image_url.in_(chunk))
+            if self.collection_id is not None:
+                query = query.join(
+                    CollectionHasImages, CollectionHasImages.collection_has_images_image_id == Image.image_id
+                ).filter(CollectionHasImages.collection_has_images_collection_id == self.collection_id)
+            found = {}
+            for url, image_id in query.order_by(Image.image_id):
+                found.setdefault(url, image_id)
+            for url in chunk:
+                self._cache[url] = found.get(url)
+
+        return {url: self._cache.get(url) for url in urls}
+
+
+def read_checkpoint(path):
+    """ Lit le point de reprise d'un import.
+
+    :param path: chemin du fichier de reprise
+    :type path: str
+    :return: état de l'import, ou None s'il n'y a pas de point de reprise
+    :rtype: dict
+    """
+
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_checkpoint(path, state):
+    """ Enregistre le point de reprise d'un import. Le fichier est remplacé d'un coup : il n'est jamais incomplet.
+
+    :param path: chemin du fichier de reprise
+    :type path: str
+    :param state: état de l'import
+    :type state: dict
+    """
+
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(temporary, path)
+
+
+def _insert_annotations(mappings):
+    """ Insère des annotations et ajoute à chaque dictionnaire l'ID (annotation_id) de l'annotation créée.
+
+    :param mappings: dictionnaires des colonnes des annotations
+    :type mappings: list
+    """
+
+    connection = db.session.connection()
+    if connection.dialect.name != "sqlite":
+        # return_defaults=True récupère l'ID de chaque annotation, avec une requête par annotation.
+        db.session.bulk_insert_mappings(Annotation, mappings, return_defaults=True)
+        return
+
+    # Avec SQLite, la première annotation est insérée seule : la transaction prend alors le verrou d'écriture
+    # de la base, et aucune autre connexion ne peut plus insérer d'annotation avant le commit.
+    # Les autres annotations sont insérées en une requête (executemany), puis leurs ID, attribués dans l'ordre
+    # d'insertion après celui de la première, sont relus en une requête.
+    annotations = Annotation.__table__
+    first_id = connection.execute(annotations.insert(), mappings[0]).inserted_primary_key[0]
+    if len(mappings) > 1:
+        connection.execute(annotations.insert(), mappings[1:])
+    ids = [
+        annotation_id for annotation_id, in connection.execute(
+            select([annotations.c.annotation_id]).where(annotations.c.annotation_id >= first_id)
+            .order_by(annotations.c.annotation_id)
+        )
+    ]
+    if len(ids) != len(mappings):
+        raise RuntimeError("les ID des annotations importées n'ont pas pu être relus")
+    for mapping, annotation_id in zip(mappings, ids):
+        mapping["annotation_id"] = annotation_id
+
+
+def _write_batch(annotations, user_id):
+    """ Enregistre un lot d'annotations et leurs authorships, puis commit.
+    Les insertions en masse ne passent pas par les événements de la session : le journal des modifications,
+    les versions et les statistiques des images et des collections sont mis à jour ici.
+
+    :param annotations: tuples (ID de l'image, annotation JSON compacte, date de création, rectangle de la région)
+    :type annotations: list
+    :param user_id: ID de l'utilisateur-ice qui importe les annotations
+    :type user_id: int
+    :return: ID des collections modifiées
+    :rtype: set
+    """
+
+    mappings = [
+        dict(bbox_columns(bbox), annotation_image_id=image_id, annotation_json=annotation_json)
+        for image_id, annotation_json, _, bbox in annotations
+    ]
+    _insert_annotations(mappings)
+    db.session.bulk_insert_mappings(AuthorshipAnnotation, [
+        {
+            "authorship_annotation_user_id": user_id,
+            "authorship_annotation_annotation_id": mapping["annotation_id"],
+            "authorship_annotation_date": created
+        }
+        for mapping, (_, _, created, _) in zip(mappings, annotations)
+    ])
+
+    record_changes(db.session.connection(), [
+        (mapping["annotation_id"], mapping["annotation_image_id"], "created") for mapping in mappings
+    ])
+    if search_enabled():
+        index_annotations(db.session.connection(), [
+            (mapping["annotation_id"], mapping["annotation_image_id"], mapping["annotation_json"])
+            for mapping in mappings
+        ])
+    image_ids = add_annotation_counts(db.session.connection(), [
+        (image_id, user_id, created) for image_id, _, created, _ in annotations
+    ])
+    _, collection_ids = bump_session_versions(db.session, image_ids=image_ids)
+    refresh_collection_counters(db.session.connection(), collection_ids)
+    db.session.commit()
+    return collection_ids
+
+
+def finish_import(collection_ids):
+    """ Termine un import : les annotations sont déjà dans l'index de recherche (voir _write_batch),
+    mais les résultats des recherches ont pu changer. On vide donc le cache de leur nombre.
+
+    :param collection_ids: ID des collections modifiées
+    :type collection_ids: iterable
+    """
+
+    if set(collection_ids):
+        invalidate_counts({"collection"})
+
+
+def import_annotations(units, user, collection_id=None, batch_size=5000, state=None, on_batch=None):
+    """ Importe des annotations W3C Web Annotation, lues par iter_units(), sur les images existantes.
+    Chaque annotation est associée à l'image dont l'URL (image_url) est sa cible (target.source) ; les annotations
+    sans image correspondante, ou illisibles, sont ignorées.
+    Les annotations sont enregistrées par lots, un commit par lot. Après chaque lot, on_batch est appelée avec l'état
+    de l'import (position de la dernière unité enregistrée, nombres d'annotations) : c'est le point de reprise.
+    Retourne un tuple (booléen, état de l'import ou liste).
+
+    :param units: unités lues par iter_units()
+    :type units: iterable
+    :param user: utilisateur-ice auteur-ice des annotations importées
+    :type user: User
+    :param collection_id: si renseigné, seules les images de cette collection sont recherchées
+    :type collection_id: int
+    :param batch_size: nombre d'annotations enregistrées par lot
+    :type batch_size: int
+    :param state: état d'un import interrompu, pour le reprendre (voir read_checkpoint())
+    :type state: dict
+    :param on_batch: fonction appelée après chaque lot avec l'état de l'import
+    :type on_batch: callable
+    :return: tuple (booléen, état de l'import ou liste d'erreurs)
+    :rtype: tuple
+    """
+
+    state = dict(state or {})
+    for key in ("position", "imported", "unmatched", "invalid"):
+        state.setdefault(key, 0)
+    collection_ids = set(state.get("collections", []))
+    lookup = ImageLookup(collection_id)
+    start = time.perf_counter()
+    imported_before = state["imported"]
+
+    pending = []
+    position = state["position"]
+
+    def flush():
+        # On cherche en une fois les images du lot, puis on enregistre les annotations.
+        images = lookup.resolve([source for _, source in pending if source is not None])
+        now = datetime.datetime.utcnow()
+        rows = []
+        for annotation, source in pending:
+            image_id = images.get(source) if source is not None else None
+            if image_id is None:
+                state["unmatched"] += 1
+                continue
+            rows.append((
+                image_id, json.dumps(annotation, separators=(",", ":")), _created(annotation, now),
+                selector_bbox(annotation)
+            ))
+        if rows:
+            collection_ids.update(_write_batch(rows, user.user_id))
+        state["imported"] += len(rows)
+        state["position"] = position
+        state["collections"] = sorted(collection_ids)
+        elapsed = time.perf_counter() - start
+        state["rate"] = round((state["imported"] - imported_before) / elapsed, 1) if elapsed > 0 else None
+        pending.clear()
+        if on_batch is not None:
+            on_batch(dict(state))
+
+    try:
+        for position, annotations in units:
+            for annotation in annotations:
+                if not isinstance(annotation, dict):
+                    state["invalid"] += 1
+                    continue
+                pending.append((annotation, annotation_source(annotation)))
+            # Un lot se termine toujours à la fin d'une unité : la reprise ne réimporte aucune annotation.
+            if len(pending) >= batch_size:
+                flush()
+        if pending or position != state["position"]:
+            flush()
+        finish_import(collection_ids)
+        return True, state
+
+    except Exception as erreur:
+        db.session.rollback()
+        # Les lots déjà commités restent en base : les résultats des recherches ont pu changer.
+        finish_import(collection_ids)
+        return False, [str(erreur)]
@@ -0,0 +1,68 @@
+import datetime
+
+from sqlalchemy import event, inspect
+
+from ..app import db
+from .data import Annotation, AnnotationChange
+
+
+# Bases de données sur lesquelles le journal est lu dans l'ordre des commits (voir record_changes) :
+# les numéros de séquence déjà lus ne peuvent plus être précédés par une modification commitée plus tard.
+CHANGE_FEED_DIALECTS = ("sqlite", "postgresql")
+
+
+def record_changes(connection, changes):
+    """ Ajoute des modifications d'annotations au journal (table annotation_change).
+    Les numéros de séquence sont attribués à l'insertion, pas au commit : sur PostgreSQL, une transaction
+    pourrait commiter un numéro plus petit que celui d'une transaction déjà commitée, et un client qui a déjà lu
+    ce dernier (paramètre since) ne recevrait jamais la modification. La table est donc verrouillée en écriture
+    jusqu'à la fin de la transaction : les écritures du journal sont commitées dans l'ordre de leurs numéros.
+    Les lectures ne sont pas bloquées. Avec SQLite, les écritures sont déjà sérialisées par la base.
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param changes: tuples (ID de l'annotation, ID de l'image, "created", "updated" ou "deleted")
+    :type changes: iterable
+    """
+
+    now = datetime.datetime.utcnow()
+    values = [
+        {
+            "annotation_change_annotation_id": annotation_id,
+            "annotation_change_image_id": image_id,
+            "annotation_change_action": action,
+            "annotation_change_date": now
+        }
+        for annotation_id, image_id, action in changes
+    ]
+    if values:
+        if connection.dialect.name == "postgresql":
+            connection.execute("LOCK TABLE annotation_change IN EXCLUSIVE MODE")
+        connection.execute(AnnotationChange.__table__.insert(), values)
+
+
+def _annotation_changes(session):
+    """ Retourne les modifications d'annotations du flush en cours, dans l'ordre des ID des annotations. """
+
+    changes = []
+    for instance in session.new:
+        if isinstance(instance, Annotation):
+            changes.append((instance.annotation_id, instance.annotation_image_id, "created"))
+    for instance in session.dirty:
+        if isinstance(instance, Annotation):
+            state = inspect(instance)
+            if state.attrs.annotation_json.history.has_changes() \
+                    or state.attrs.annotation_image_id.history.has_changes():
+                changes.append((instance.annotation_id, instance.annotation_image_id, "updated"))
+    for instance in session.deleted:
+        if isinstance(instance, Annotation):
+            changes.append((instance.annotation_id, instance.annotation_image_id, "deleted"))
+    return sorted(changes, key=lambda change: change[0])
+
+
+@event.listens_for(db.session, "after_flush")
+def _record_annotation_changes(session, flush_context):
+    """ Enregistre au journal, dans la transaction du flush, les annotations créées, modifiées ou supprimées. """
+
+    changes = _annotation_changes(session)
+    if changes:
+        record_changes(session.connection(), changes)
@@ -0,0 +1,315 @@
+from sqlalchemy import and_, case, event, func, inspect, select
+
+from ..app import db
+from .data import Annotation, AuthorshipAnnotation, Collection, CollectionHasImages, Image, ImageAnnotator
+
+# Nombre d'ID par requête (clause IN).
+_CHUNK_SIZE = 500
+
+
+def _chunks(ids):
+    """ Découpe une liste d'ID en listes de _CHUNK_SIZE ID au plus. """
+
+    ids = sorted(ids)
+    for start in range(0, len(ids), _CHUNK_SIZE):
+        yield ids[start:start + _CHUNK_SIZE]
+
+
+def _image_collections(connection, image_ids):
+    """ Retourne les ID des collections qui contiennent une liste d'images. """
+
+    links = CollectionHasImages.__table__
+    collection_ids = set()
+    for chunk in _chunks(image_ids):
+        collection_ids.update(
+            collection_id for collection_id, in connection.execute(
+                select([links.c.collection_has_images_collection_id])
+                .where(links.c.collection_has_images_image_id.in_(chunk))
+                .distinct()
+            )
+        )
+    return collection_ids
+
+
+def _update_image_totals(connection, image_ids):
+    """ Recalcule le nombre d'annotateur-ices et la date de la dernière annotation d'une liste d'images
+    à partir de la table image_annotator.
+    """
+
+    images = Image.__table__
+    annotators = ImageAnnotator.__table__
+    for chunk in _chunks(image_ids):
+        connection.execute(
+            images.update().where(images.c.image_id.in_(chunk)).values(
+                image_annotator_count=select([func.count()]).where(
+                    annotators.c.image_annotator_image_id == images.c.image_id
+                ).as_scalar(),
+                image_last_annotated=select([func.max(annotators.c.image_annotator_last)]).where(
+                    annotators.c.image_annotator_image_id == images.c.image_id
+                ).as_scalar()
+            )
+        )
+
+
+def refresh_image_counters(connection, image_ids):
+    """ Recalcule les statistiques d'une liste d'images (nombre d'annotations, d'annotateur-ices, date de la dernière
+    annotation) et leurs lignes de la table image_annotator, à partir de leurs annotations.
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param image_ids: ID des images
+    :type image_ids: iterable
+    """
+
+    image_ids = {image_id for image_id in image_ids if image_id is not None}
+    images = Image.__table__
+    annotations = Annotation.__table__
+    authorships = AuthorshipAnnotation.__table__
+    annotators = ImageAnnotator.__table__
+
+    for chunk in _chunks(image_ids):
+        connection.execute(annotators.delete().where(annotators.c.image_annotator_image_id.in_(chunk)))
+        connection.execute(annotators.insert().from_select(
+            [
+                annotators.c.image_annotator_image_id, annotators.c.image_annotator_user_id,
+                annotators.c.image_annotator_count, annotators.c.image_annotator_last
+            ],
+            select([
+                annotations.c.annotation_image_id, authorships.c.authorship_annotation_user_id,
+                func.count(), func.max(authorships.c.authorship_annotation_date)
+            ]).select_from(
+                annotations.join(
+                    authorships, authorships.c.authorship_annotation_annotation_id == annotations.c.annotation_id
+                )
+            ).where(and_(
+                annotations.c.annotation_image_id.in_(chunk),
+                authorships.c.authorship_annotation_user_id.isnot(None)
+            )).group_by(annotations.c.annotation_image_id, authorships.c.authorship_annotation_user_id)
+        ))
+        connection.execute(
+            images.update().where(images.c.image_id.in_(chunk)).values(
+                image_annotation_count=select([func.count()]).where(
+                    annotations.c.annotation_image_id == images.c.image_id
+                ).as_scalar()
+            )
+        )
+    _update_image_totals(connection, image_ids)
+
+
+def add_annotation_counts(connection, annotations):
+    """ Ajoute aux statistiques des images des annotations qui viennent d'être créées, sans relire les annotations
+    existantes (insertions en masse : import d'annotations).
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param annotations: tuples (ID de l'image, ID de l'utilisateur-ice, date de création)
+    :type annotations: iterable
+    :return: ID des images modifiées
+    :rtype: set
+    """
+
+    counts = {}
+    authors = {}
+    for image_id, user_id, created in annotations:
+        counts[image_id] = counts.get(image_id, 0) + 1
+        count, last = authors.get((image_id, user_id), (0, None))
+        authors[(image_id, user_id)] = (count + 1, created if last is None or created > last else last)
+    if not counts:
+        return set()
+
+    images = Image.__table__
+    annotators = ImageAnnotator.__table__
+    connection.execute(
+        images.update().where(images.c.image_id == db.bindparam("id")).values(
+            image_annotation_count=images.c.image_annotation_count + db.bindparam("count")
+        ),
+        [{"id": image_id, "count": count} for image_id, count in counts.items()]
+    )
+
+    # On met à jour les lignes existantes de image_annotator, et on crée les autres.
+    existing = set()
+    for chunk in _chunks(counts):
+        existing.update(
+            (image_id, user_id) for image_id, user_id in connection.execute(
+                select([annotators.c.image_annotator_image_id, annotators.c.image_annotator_user_id])
+                .where(annotators.c.image_annotator_image_id.in_(chunk))
+            )
+        )
+    updates = [
+        {"image_id": image_id, "user_id": user_id, "count": count, "last": last}
+        for (image_id, user_id), (count, last) in authors.items() if (image_id, user_id) in existing
+    ]
+    if updates:
+        connection.execute(
+            annotators.update().where(and_(
+                annotators.c.image_annotator_image_id == db.bindparam("image_id"),
+                annotators.c.image_annotator_user_id == db.bindparam("user_id")
+            )).values(
+                image_annotator_count=annotators.c.image_annotator_count + db.bindparam("count"),
+                image_annotator_last=case(
+                    [(annotators.c.image_annotator_last >= db.bindparam("last"), annotators.c.image_annotator_last)],
+                    else_=db.bindparam("last")
+                )
+            ),
+            updates
+        )
+    inserts = [
+        {
+            "image_annotator_image_id": image_id,
+            "image_annotator_user_id": user_id,
+            "image_annotator_count": count,
+            "image_annotator_last": last
+        }
+        for (image_id, user_id), (count, last) in authors.items() if (image_id, user_id) not in existing
+    ]
+    if inserts:
+        connection.execute(annotators.insert(), inserts)
+
+    _update_image_totals(connection, counts)
+    return set(counts)
+
+
+def refresh_collection_counters(connection, collection_ids):
+    """ Recalcule les statistiques d'une liste de collections à partir des statistiques de leurs images
+    et de la table image_annotator : les annotations ne sont pas relues.
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param collection_ids: ID des collections
+    :type collection_ids: iterable
+    """
+
+    collection_ids = {collection_id for collection_id in collection_ids if collection_id is not None}
+    collections = Collection.__table__
+    images = Image.__table__
+    links = CollectionHasImages.__table__
+    annotators = ImageAnnotator.__table__
+
+    for chunk in _chunks(collection_ids):
+        values = {
+            collection_id: {
+                "id": collection_id, "images": 0, "annotated": 0, "annotations": 0, "annotators": 0, "last": None
+            }
+            for collection_id in chunk
+        }
+        for collection_id, image_count, annotated, annotation_count, last in connection.execute(
+            select([
+                links.c.collection_has_images_collection_id,
+                func.count(),
+                func.sum(case([(images.c.image_annotation_count > 0, 1)], else_=0)),
+                func.sum(images.c.image_annotation_count),
+                func.max(images.c.image_last_annotated)
+            ]).select_from(
+                links.join(images, images.c.image_id == links.c.collection_has_images_image_id)
+            ).where(links.c.collection_has_images_collection_id.in_(chunk))
+            .group_by(links.c.collection_has_images_collection_id)
+        ):
+            values[collection_id].update(
+                images=image_count, annotated=annotated or 0, annotations=annotation_count or 0, last=last
+            )
+        for collection_id, annotator_count in connection.execute(
+            select([
+                links.c.collection_has_images_collection_id,
+                func.count(annotators.c.image_annotator_user_id.distinct())
+            ]).select_from(
+                links.join(annotators, annotators.c.image_annotator_image_id == links.c.collection_has_images_image_id)
+            ).where(links.c.collection_has_images_collection_id.in_(chunk))
+            .group_by(links.c.collection_has_images_collection_id)
+        ):
+            values[collection_id]["annotators"] = annotator_count
+
+        connection.execute(
+            collections.update().where(collections.c.collection_id == db.bindparam("id")).values(
+                collection_image_count=db.bindparam("images"),
+                collection_annotated_image_count=db.bindparam("annotated"),
+                collection_annotation_count=db.bindparam("annotations"),
+                collection_annotator_count=db.bindparam("annotators"),
+                collection_last_annotated=db.bindparam("last")
+            ),
+            list(values.values())
+        )
+
+
+def refresh_counters(connection, image_ids=(), collection_ids=()):
+    """ Recalcule les statistiques d'une liste d'images, puis celles des collections qui les contiennent
+    et d'une liste de collections.
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param image_ids: ID des images modifiées
+    :type image_ids: iterable
+    :param collection_ids: ID des collections modifiées
+    :type collection_ids: iterable
+    """
+
+    image_ids = {image_id for image_id in image_ids if image_id is not None}
+    collection_ids = set(collection_ids)
+    if image_ids:
+        refresh_image_counters(connection, image_ids)
+        collection_ids.update(_image_collections(connection, image_ids))
+    refresh_collection_counters(connection, collection_ids)
+
+
+def add_collection_images(connection, collection_id, count):
+    """ Ajoute des images sans annotation au nombre d'images d'une collection (insertions en masse :
+    création d'une collection).
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param collection_id: ID de la collection
+    :type collection_id: int
+    :param count: nombre d'images ajoutées
+    :type count: int
+    """
+
+    collections = Collection.__table__
+    connection.execute(
+        collections.update().where(collections.c.collection_id == collection_id).values(
+            collection_image_count=collections.c.collection_image_count + count
+        )
+    )
+
+
+def _modified_counters(session):
+    """ Retourne les ID des images et des collections dont les statistiques ont pu changer lors du flush en cours,
+    et les ID des annotations dont une authorship a été ajoutée ou supprimée.
+    """
+
+    image_ids = set()
+    collection_ids = set()
+    annotation_ids = set()
+
+    for instance in list(session.new) + list(session.deleted):
+        if isinstance(instance, Annotation):
+            image_ids.add(instance.annotation_image_id)
+        elif isinstance(instance, AuthorshipAnnotation):
+            annotation_ids.add(instance.authorship_annotation_annotation_id)
+        elif isinstance(instance, CollectionHasImages):
+            collection_ids.add(instance.collection_has_images_collection_id)
+
+    for instance in session.dirty:
+        if isinstance(instance, Annotation):
+            image_ids.update(inspect(instance).attrs.annotation_image_id.history.sum())
+
+    # Les statistiques des collections supprimées n'ont plus à être mises à jour.
+    for instance in session.deleted:
+        if isinstance(instance, Collection):
+            collection_ids.discard(instance.collection_id)
+
+    annotation_ids.discard(None)
+    return image_ids, collection_ids, annotation_ids
+
+
+@event.listens_for(db.session, "after_flush")
+def _refresh_counters(session, flush_context):
+    """ Met à jour, dans la transaction du flush, les statistiques des images et des collections modifiées. """
+
+    image_ids, collection_ids, annotation_ids = _modified_counters(session)
+    if not image_ids and not collection_ids and not annotation_ids:
+        return
+
+    connection = session.connection()
+    if annotation_ids:
+        annotations = Annotation.__table__
+        for chunk in _chunks(annotation_ids):
+            image_ids.update(
+                image_id for image_id, in connection.execute(
+                    select([annotations.c.annotation_image_id]).where(annotations.c.annotation_id.in_(chunk))
+                )
+            )
+    refresh_counters(connection, image_ids, collection_ids)
@@ -1,8 +1,14 @@
 from flask import url_for
+from sqlalchemy.orm.attributes import set_committed_value
 import datetime
 import json
 
 from ..app import db
+from .json_export import RawJSON
+
+# Nombre maximum d'ID par requête lors du chargement des authorships des annotations (clause IN).
+# Il reste sous la limite de variables d'une requête SQLite (32766).
+PRELOAD_CHUNK_SIZE = 10000
 
 
 # Création de la table des collections
@@ -14,6 +20,19 @@ class Collection(db.Model):
     collection_name = db.Column(db.String(45), unique=True, nullable=False)
     collection_description = db.Column(db.Text, nullable=False)
     collection_source = db.Column(db.Text, nullable=False)
+    # Version des données de la collection renvoyées par l'API : elle est incrémentée à chaque modification
+    # de la collection, de ses images ou de leurs annotations (voir modeles/versions.py).
+    # Elle sert d'ETag aux réponses de l'API, et collection_modified de Last-Modified.
+    collection_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    collection_modified = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # Statistiques de la collection, tenues à jour à chaque écriture d'annotation (voir modeles/counters.py) :
+    # nombre d'images, d'images annotées, d'annotations, d'annotateur-ices et date de la dernière annotation.
+    # Elles sont indexées : les collections peuvent être triées et filtrées sans lire les annotations.
+    collection_image_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    collection_annotated_image_count = db.Column(db.Integer, nullable=False, default=0, server_default="0", index=True)
+    collection_annotation_count = db.Column(db.Integer, nullable=False, default=0, server_default="0", index=True)
+    collection_annotator_count = db.Column(db.Integer, nullable=False, default=0, server_default="0", index=True)
+    collection_last_annotated = db.Column(db.DateTime, index=True)
     # Jointure avec la table CollectionHasCategories, pour associer une collection à une catégorie.
     # Relation many to many
     has_categories = db.relationship('CollectionHasCategories', back_populates="collection")
@@ -85,6 +104,97 @@ class Collection(db.Model):
         except Exception as erreur:
             return False, [str(erreur)]
 
+    @staticmethod
+    def preload_for_api(collections, with_images=True):
+        """ Charge en une requête par table toutes les données utilisées par to_json_api() pour une liste de
+        collections : catégories, authorship et utilisateur-ices, images, annotations et leurs authorships.
+        Les relations des objets sont remplies avec les résultats. La sérialisation ne déclenche ensuite plus
+        aucune requête, quel que soit le nombre d'images (6 requêtes au total, chargement des collections compris,
+        plus une requête par tranche de PRELOAD_CHUNK_SIZE annotations au-delà de la première).
+
+        :param collections: collections à sérialiser
+        :type collections: list
+        :param with_images: False pour ne charger ni les images ni les annotations (cas de l'export en flux,
+        qui les charge par lots avec iter_images_for_api())
+        :type with_images: bool
+        :return: collections, avec leurs relations chargées
+        :rtype: list
+        """
+
+        collections = [collection for collection in collections if collection is not None]
+        if not collections:
+            return collections
+        collection_ids = [collection.collection_id for collection in collections]
+
+        # Catégories des collections.
+        categories = {collection_id: [] for collection_id in collection_ids}
+        for link in CollectionHasCategories.query.options(db.joinedload(CollectionHasCategories.category)).filter(
+                CollectionHasCategories.collection_id.in_(collection_ids)
+        ).order_by(CollectionHasCategories.id):
+            categories[link.collection_id].append(link)
+
+        # Authorship des collections, avec les utilisateur-ices.
+        authorships = {collection_id: [] for collection_id in collection_ids}
+        for authorship in AuthorshipCollection.query.options(db.joinedload(AuthorshipCollection.user)).filter(
+                AuthorshipCollection.authorship_collection_collection_id.in_(collection_ids)
+        ).order_by(AuthorshipCollection.authorship_collection_id):
+            authorships[authorship.authorship_collection_collection_id].append(authorship)
+
+        # On remplit les relations, sans les marquer comme modifiées.
+        for collection in collections:
+            set_committed_value(collection, "has_categories", categories[collection.collection_id])
+            set_committed_value(collection, "collection_authorship", authorships[collection.collection_id])
+
+        if not with_images:
+            return collections
+
+        # Images des collections.
+        links = {collection_id: [] for collection_id in collection_ids}
+        images = []
+        for link in CollectionHasImages.query.options(db.joinedload(CollectionHasImages.image)).filter(
+                CollectionHasImages.collection_has_images_collection_id.in_(collection_ids)
+        ).order_by(CollectionHasImages.collection_has_images_id):
+            links[link.collection_has_images_collection_id].append(link)
+            images.append(link.image)
+
+        for collection in collections:
+            set_committed_value(collection, "has_images", links[collection.collection_id])
+
+        # Les annotations et les authorships sont filtrées par une sous-requête sur les images des collections,
+        # plutôt que par une liste d'ID qui pourrait compter des milliers d'éléments.
+        Image.preload_for_api(images, image_ids=db.session.query(
+            CollectionHasImages.collection_has_images_image_id
+        ).filter(CollectionHasImages.collection_has_images_collection_id.in_(collection_ids)))
+
+        return collections
+
+    def iter_images_for_api(self, chunk_size=200):
+        """ Renvoie les images de la collection au format de to_json_api(), lot par lot.
+        Chaque lot est chargé avec ses annotations en trois requêtes, en reprenant après le dernier ID lu
+        (pagination par clé) : la mémoire utilisée ne dépend que de la taille d'un lot.
+
+        :param chunk_size: nombre d'images chargées par lot
+        :type chunk_size: int
+        :return: dictionnaires des images
+        :rtype: generator
+        """
+
+        last_id = 0
+        while True:
+            links = CollectionHasImages.query.options(db.joinedload(CollectionHasImages.image)).filter(
+                CollectionHasImages.collection_has_images_collection_id == self.collection_id,
+                CollectionHasImages.collection_has_images_id > last_id
+            ).order_by(CollectionHasImages.collection_has_images_id).limit(chunk_size).all()
+
+            if not links:
+                return
+
+            Image.preload_for_api([link.image for link in links])
+            for link in links:
+                yield link.image_to_json()
+
+            last_id = links[-1].collection_has_images_id
+
     def get_id(self):
         """ Retourne l'ID de l'objet actuellement utilisé
 
@@ -93,13 +203,22 @@ class Collection(db.Model):
         """
         return self.collection_id
 
-    def to_json_api(self):
+    def to_json_api(self, images=None):
         """ Retourne les données de la collection sous forme de dictionnaire
         pour leur exploitation au format JSON via l'API.
 
+        :param images: données des images à utiliser à la place de la relation has_images
+        (par exemple une LazyList, pour l'export en flux)
+        :type images: iterable
         :return: dictionnaire des données de la collection
         :rtype: dict
         """
+        if images is None:
+            images = [
+                image.image_to_json()
+                for image in self.has_images
+            ]
+
         return {
             "type": "collection",
             "id": self.collection_id,
@@ -110,6 +229,13 @@ class Collection(db.Model):
                     for category in self.has_categories
                 ],
                 "description": self.collection_description,
+                "statistics": {
+                    "images": self.collection_image_count,
+                    "annotated_images": self.collection_annotated_image_count,
+                    "annotations": self.collection_annotation_count,
+                    "annotators": self.collection_annotator_count,
+                    "last_annotated": self.collection_last_annotated
+                },
             },
             "relationships": {
                 "editions": [
@@ -117,10 +243,7 @@ class Collection(db.Model):
                     for author in self.collection_authorship
                 ]
             },
-            "images": [
-                image.image_to_json()
-                for image in self.has_images
-            ],
+            "images": images,
             "links": {
                 "self": url_for("collection", collection_id=self.collection_id, _external=True),
                 "json": url_for("api_collection_data", collection_id=self.collection_id, _external=True)
@@ -205,11 +328,15 @@ class Category(db.Model):
 # On crée la table d'association CollectionHasCategories pour les collections et les catégories.
 class CollectionHasCategories(db.Model):
     __tablename__ = "collection_categories"
+    # Index de recherche des catégories d'une collection.
+    __table_args__ = (
+        db.Index("ix_collection_categories_collection_category", "collection_id", "category_id"),
+    )
     id = db.Column(db.Integer(), primary_key=True)
     # Clé étrangère de la collection.
     collection_id = db.Column(db.Integer(), db.ForeignKey('collection.collection_id'))
     # Clé étrangère de la catégorie.
-    category_id = db.Column(db.Integer(), db.ForeignKey('categories.id'))
+    category_id = db.Column(db.Integer(), db.ForeignKey('categories.id'), index=True)
     # Jointure avec la table Collection.
     collection = db.relationship("Collection", back_populates="has_categories")
     # Jointure avec la table Category.
@@ -231,7 +358,24 @@ class CollectionHasCategories(db.Model):
 class Image(db.Model):
     __tablename__ = "image"
     image_id = db.Column(db.Integer, unique=True, nullable=False, primary_key=True, autoincrement=True)
-    image_url = db.Column(db.Text, nullable=False)
+    # L'URL est indexée : l'import d'annotations retrouve les images à partir de la cible des annotations.
+    image_url = db.Column(db.Text, nullable=False, index=True)
+    # Version des données de l'image renvoyées par l'API, incrémentée à chaque modification de ses annotations.
+    image_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    image_modified = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    # Statistiques de l'image, tenues à jour à chaque écriture d'annotation (voir modeles/counters.py) :
+    # nombre d'annotations, d'annotateur-ices et date de la dernière annotation (création ou modification).
+    image_annotation_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    image_annotator_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    image_last_annotated = db.Column(db.DateTime)
+    # Métadonnées de l'image, récupérées à l'import sans télécharger l'image (voir modeles/image_metadata.py) :
+    # dimensions (en pixels), type MIME, URL du service IIIF et date de la récupération
+    # (None tant que les métadonnées n'ont pas été demandées à la source).
+    image_width = db.Column(db.Integer)
+    image_height = db.Column(db.Integer)
+    image_format = db.Column(db.String(50))
+    image_service = db.Column(db.Text)
+    image_metadata_fetched = db.Column(db.DateTime)
     # Jointure avec la table CollectionHasImages.
     # Relation many to many
     has_collection = db.relationship("CollectionHasImages", back_populates="image")
@@ -268,6 +412,59 @@ class Image(db.Model):
         except Exception as erreur:
             return False, [str(erreur)]
 
+    @staticmethod
+    def preload_for_api(images, image_ids=None):
+        """ Charge en deux requêtes les annotations d'une liste d'images et leurs authorships (avec les
+        utilisateur-ices), et remplit les relations des objets. La sérialisation ne déclenche ensuite plus
+        aucune requête.
+
+        :param images: images à sérialiser
+        :type images: list
+        :param image_ids: filtre sur les ID des images (liste ou sous-requête). Si None, la liste des ID de images.
+        :return: images, avec leurs relations chargées
+        :rtype: list
+        """
+
+        images = [image for image in images if image is not None]
+        if not images:
+            return images
+        if image_ids is None:
+            image_ids = [image.image_id for image in images]
+
+        # Annotations des images.
+        # Chaque requête lit son propre état de la base : une image associée à la collection après le chargement
+        # des images (sous-requête image_ids) n'est pas sérialisée, ses annotations sont ignorées.
+        annotations = {image.image_id: [] for image in images}
+        annotations_by_id = {}
+        for annotation in Annotation.query.filter(
+                Annotation.annotation_image_id.in_(image_ids)
+        ).order_by(Annotation.annotation_id):
+            if annotation.annotation_image_id not in annotations:
+                continue
+            annotations[annotation.annotation_image_id].append(annotation)
+            annotations_by_id[annotation.annotation_id] = annotation
+
+        # Authorships des annotations, avec les utilisateur-ices.
+        # Elles sont filtrées par les ID des annotations chargées (par lots de PRELOAD_CHUNK_SIZE) : une annotation
+        # créée entre les deux requêtes n'a pas d'authorship chargée.
+        annotation_authorships = {annotation_id: [] for annotation_id in annotations_by_id}
+        annotation_ids = sorted(annotation_authorships)
+        for start in range(0, len(annotation_ids), PRELOAD_CHUNK_SIZE):
+            for authorship in AuthorshipAnnotation.query.options(db.joinedload(AuthorshipAnnotation.user)).filter(
+                    AuthorshipAnnotation.authorship_annotation_annotation_id.in_(
+                        annotation_ids[start:start + PRELOAD_CHUNK_SIZE]
+                    )
+            ).order_by(AuthorshipAnnotation.authorship_annotation_id):
+                annotation_authorships[authorship.authorship_annotation_annotation_id].append(authorship)
+
+        # On remplit les relations, sans les marquer comme modifiées.
+        for image in images:
+            set_committed_value(image, "annotation", annotations[image.image_id])
+        for annotation_id, annotation in annotations_by_id.items():
+            set_committed_value(annotation, "annotation_authorship", annotation_authorships[annotation_id])
+
+        return images
+
     def get_id(self):
         """ Retourne l'ID de l'objet actuellement utilisé
 
@@ -288,6 +485,15 @@ class Image(db.Model):
             "attributes": {
                 "id": self.image_id,
                 "url": self.image_url,
+                "width": self.image_width,
+                "height": self.image_height,
+                "format": self.image_format,
+                "service": self.image_service,
+                "statistics": {
+                    "annotations": self.image_annotation_count,
+                    "annotators": self.image_annotator_count,
+                    "last_annotated": self.image_last_annotated
+                },
                 "annotations":
                     [
                         # on affiche chaque annotation associée à l'image concernée, grâce à la jointure
@@ -307,7 +513,14 @@ class Annotation(db.Model):
     # Voir https://recogito.github.io/annotorious/getting-started/web-annotation/
     annotation_json = db.Column(db.Text, nullable=False)
     # Clé étrangère de l'image à laquelle est associée l'annotation.
-    annotation_image_id = db.Column(db.Integer, db.ForeignKey("image.image_id"))
+    annotation_image_id = db.Column(db.Integer, db.ForeignKey("image.image_id"), index=True)
+    # Rectangle englobant la région de l'image ciblée par l'annotation (sélecteurs FragmentSelector et SvgSelector),
+    # en pixels. Il est calculé à chaque écriture de annotation_json (voir modeles/regions.py) ; les colonnes sont
+    # nulles si l'annotation n'a pas de sélecteur lisible.
+    annotation_min_x = db.Column(db.Float)
+    annotation_min_y = db.Column(db.Float)
+    annotation_max_x = db.Column(db.Float)
+    annotation_max_y = db.Column(db.Float)
     # Jointure avec la table Image.
     # Relation one to one
     image = db.relationship("Image", back_populates="annotation")
@@ -316,6 +529,174 @@ class Annotation(db.Model):
     # Si l'annotation est supprimée, l'authorship l'est également avec cascade="all, delete".
     annotation_authorship = db.relationship("AuthorshipAnnotation", back_populates="annotation", cascade="all, delete")
 
+    @staticmethod
+    def create_batch(image, user, annotations):
+        """ Crée les annotations d'une image et leurs authorships en une seule transaction.
+        Retourne un tuple (booléen, liste des ID des annotations créées ou liste des erreurs).
+
+        :param image: image annotée
+        :type image: Image
+        :param user: utilisateur-ice qui a créé les annotations
+        :type user: User
+        :param annotations: annotations au format W3C Web Annotation, générées par Annotorious
+        :type annotations: list
+        :return: tuple (booléen, liste d'ID ou liste d'erreurs)
+        :rtype: tuple
+        """
+
+        status, data = Annotation.apply_batch(image, user, create=annotations)
+        if status is False:
+            return False, data
+        return True, data["created"]
+
+    @staticmethod
+    def apply_batch(image, user, create=None, update=None, delete=None):
+        """ Crée, modifie et supprime des annotations d'une image en une seule transaction.
+        Chaque authorship est liée à son annotation par la relation annotation_authorship : les ID sont
+        attribués au flush, sans requête pour retrouver les annotations créées.
+        Une annotation ne peut être modifiée ou supprimée que par un-e de ses auteur-ices ; chaque modification
+        ajoute une authorship (une édition) à l'annotation.
+        Retourne un tuple (booléen, dictionnaire des ID créés, modifiés et supprimés ou liste des erreurs).
+
+        :param image: image annotée
+        :type image: Image
+        :param user: utilisateur-ice qui fait les modifications
+        :type user: User
+        :param create: annotations à créer, au format W3C Web Annotation
+        :type create: list
+        :param update: annotations à modifier, sous la forme {"id": ID, "annotation": annotation}
+        :type update: list
+        :param delete: ID des annotations à supprimer
+        :type delete: list
+        :return: tuple (booléen, dictionnaire ou liste d'erreurs)
+        :rtype: tuple
+        """
+
+        create = [] if create is None else create
+        update = [] if update is None else update
+        delete = [] if delete is None else delete
+
+        # On vérifie le format des données.
+        errors = []
+        if not isinstance(create, list) or not all(isinstance(item, dict) for item in create):
+            errors.append("Les annotations à créer doivent être une liste d'objets JSON.")
+        if not isinstance(update, list) or not all(
+                isinstance(item, dict) and isinstance(item.get("id"), int) and isinstance(item.get("annotation"), dict)
+                for item in update):
+            errors.append("Les annotations à modifier doivent être une liste d'objets {\"id\": ..., \"annotation\": ...}.")
+        if not isinstance(delete, list) or not all(isinstance(item, int) for item in delete):
+            errors.append("Les annotations à supprimer doivent être une liste d'ID.")
+        if errors:
+            return False, errors
+        if {item["id"] for item in update} & set(delete):
+            return False, ["Une annotation ne peut pas être modifiée et supprimée dans la même requête."]
+
+        # On récupère en une requête les annotations à modifier ou supprimer, et en une autre celles
+        # dont l'utilisateur-ice est auteur-ice.
+        target_ids = {item["id"] for item in update} | set(delete)
+        targets = {}
+        authored_ids = set()
+        if target_ids:
+            targets = {
+                annotation.annotation_id: annotation
+                for annotation in Annotation.query.filter(
+                    Annotation.annotation_id.in_(target_ids),
+                    Annotation.annotation_image_id == image.image_id
+                )
+            }
+            authored_ids = {
+                annotation_id for annotation_id, in db.session.query(
+                    AuthorshipAnnotation.authorship_annotation_annotation_id
+                ).filter(
+                    AuthorshipAnnotation.authorship_annotation_annotation_id.in_(target_ids),
+                    AuthorshipAnnotation.authorship_annotation_user_id == user.user_id
+                )
+            }
+        for annotation_id in sorted(target_ids):
+            if annotation_id not in targets:
+                errors.append("L'annotation {0} n'existe pas sur cette image.".format(annotation_id))
+            elif annotation_id not in authored_ids:
+                errors.append("L'annotation {0} n'a pas été créée par l'utilisateur-ice.".format(annotation_id))
+        if errors:
+            return False, errors
+
+        new_annotations = [
+            Annotation(
+                # On transforme le dictionnaire annotation en une chaine de caractère formatée JSON compacte.
+                # Elle est renvoyée telle quelle par l'API.
+                annotation_json=json.dumps(annotation, separators=(",", ":")),
+                image=image,
+                annotation_authorship=[AuthorshipAnnotation(user=user)]
+            )
+            for annotation in create
+        ]
+
+        try:
+            # On ajoute toutes les annotations (et leurs authorships, par cascade).
+            db.session.add_all(new_annotations)
+            for item in update:
+                annotation = targets[item["id"]]
+                annotation.annotation_json = json.dumps(item["annotation"], separators=(",", ":"))
+                annotation.annotation_authorship.append(AuthorshipAnnotation(user=user))
+            for annotation_id in delete:
+                db.session.delete(targets[annotation_id])
+
+            # Les ID sont lus après le flush : après le commit, chaque objet serait rechargé depuis la base.
+            db.session.flush()
+            result = {
+                "created": [annotation.annotation_id for annotation in new_annotations],
+                "updated": [item["id"] for item in update],
+                "deleted": list(delete)
+            }
+            # On commit une seule fois, pour toutes les modifications.
+            db.session.commit()
+            return True, result
+
+        except Exception as erreur:
+            db.session.rollback()
+            return False, [str(erreur)]
+
+    @staticmethod
+    def preload_for_api(annotations):
+        """ Charge en une requête les authorships d'une liste d'annotations (avec les utilisateur-ices),
+        et remplit les relations des objets.
+
+        :param annotations: annotations à sérialiser
+        :type annotations: list
+        :return: annotations, avec leurs relations chargées
+        :rtype: list
+        """
+
+        annotation_authorships = {annotation.annotation_id: [] for annotation in annotations}
+        if not annotation_authorships:
+            return annotations
+
+        for authorship in AuthorshipAnnotation.query.options(db.joinedload(AuthorshipAnnotation.user)).filter(
+                AuthorshipAnnotation.authorship_annotation_annotation_id.in_(list(annotation_authorships))
+        ).order_by(AuthorshipAnnotation.authorship_annotation_id):
+            annotation_authorships[authorship.authorship_annotation_annotation_id].append(authorship)
+
+        # On remplit les relations, sans les marquer comme modifiées.
+        for annotation in annotations:
+            set_committed_value(annotation, "annotation_authorship", annotation_authorships[annotation.annotation_id])
+
+        return annotations
+
+    def is_edited_by(self, user):
+        """ Indique si un-e utilisateur-ice est auteur-ice de l'annotation (a créé ou modifié l'annotation).
+
+        :param user: utilisateur-ice
+        :type user: User
+        :rtype: bool
+        """
+
+        return db.session.query(
+            AuthorshipAnnotation.query.filter(
+                AuthorshipAnnotation.authorship_annotation_annotation_id == self.annotation_id,
+                AuthorshipAnnotation.authorship_annotation_user_id == user.user_id
+            ).exists()
+        ).scalar()
+
     def to_json_api(self):
         """ Retourne les données de l'annotation sous forme de dictionnaire
         pour leur exploitation au format JSON via l'API.
@@ -329,8 +710,9 @@ class Annotation(db.Model):
             "attributes": {
                 "id": self.annotation_id,
                 "annotation_json": [
-                    # On transforme la chaîne de caractère formatée JSON enregistrée en base de données en objet JSON
-                    json.loads(self.annotation_json)
+                    # La chaîne de caractère formatée JSON enregistrée en base de données est insérée telle quelle
+                    # dans la réponse, sans être décodée puis réencodée.
+                    RawJSON(self.annotation_json)
                 ],
                 "relationships": {
                     "editions": [
@@ -342,14 +724,42 @@ class Annotation(db.Model):
             }
         }
 
+    def region_to_json_api(self):
+        """ Retourne la région annotée, avec l'annotation, sous forme de dictionnaire pour son exploitation
+        au format JSON via l'API. Le rectangle de la région est donné comme un fragment xywh :
+        [x, y, largeur, hauteur].
+
+        :return: dictionnaire des données de la région
+        :rtype: dict
+        """
+
+        return {
+            "type": "region",
+            "attributes": {
+                "image_id": self.annotation_image_id,
+                "xywh": [
+                    self.annotation_min_x, self.annotation_min_y,
+                    self.annotation_max_x - self.annotation_min_x, self.annotation_max_y - self.annotation_min_y
+                ],
+                "annotation": self.to_json_api()
+            }
+        }
+
 
 # On crée la table d'association AuthorshipCollection pour les collections et les users.
 class AuthorshipCollection(db.Model):
+    # Index de recherche des auteur-ices d'une collection (et de vérification de l'authorship d'un-e user).
+    __table_args__ = (
+        db.Index(
+            "ix_authorship_collection_collection_user",
+            "authorship_collection_collection_id", "authorship_collection_user_id"
+        ),
+    )
     authorship_collection_id = db.Column(db.Integer, nullable=True, autoincrement=True, primary_key=True)
     # Clé étrangère de la collection
     authorship_collection_collection_id = db.Column(db.Integer, db.ForeignKey('collection.collection_id'))
     # Clé étrangère du user.
-    authorship_collection_user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'))
+    authorship_collection_user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), index=True)
     authorship_collection_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     # Jointure avec la table User.
     user = db.relationship("User", back_populates="authorship_collection")
@@ -371,9 +781,16 @@ class AuthorshipCollection(db.Model):
 
 # On crée la table d'association AuthorshipAnnotation pour les annotations et les users.
 class AuthorshipAnnotation(db.Model):
+    # Index de recherche des auteur-ices d'une annotation (et de vérification de l'authorship d'un-e user).
+    __table_args__ = (
+        db.Index(
+            "ix_authorship_annotation_annotation_user",
+            "authorship_annotation_annotation_id", "authorship_annotation_user_id"
+        ),
+    )
     authorship_annotation_id = db.Column(db.Integer, nullable=True, autoincrement=True, primary_key=True)
     # Clé étrangère du user.
-    authorship_annotation_user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'))
+    authorship_annotation_user_id = db.Column(db.Integer, db.ForeignKey('user.user_id'), index=True)
     # Clé étrangère de l'annotation.
     authorship_annotation_annotation_id = db.Column(db.Integer, db.ForeignKey('annotation.annotation_id'))
     authorship_annotation_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
@@ -397,11 +814,18 @@ class AuthorshipAnnotation(db.Model):
 
 # On crée la table d'association CollectionHasImages pour les collections et les images.
 class CollectionHasImages(db.Model):
+    # Index de recherche des images d'une collection.
+    __table_args__ = (
+        db.Index(
+            "ix_collection_has_images_collection_image",
+            "collection_has_images_collection_id", "collection_has_images_image_id"
+        ),
+    )
     collection_has_images_id = db.Column(db.Integer, nullable=True, autoincrement=True, primary_key=True)
     # Clé étrangère de la collection.
     collection_has_images_collection_id = db.Column(db.Integer, db.ForeignKey('collection.collection_id'))
     # Clé étrangère de l'image.
-    collection_has_images_image_id = db.Column(db.Integer, db.ForeignKey('image.image_id'))
+    collection_has_images_image_id = db.Column(db.Integer, db.ForeignKey('image.image_id'), index=True)
     # Jointure avec la table Collection.
     collection = db.relationship("Collection", back_populates="has_images")
     # Jointure avec la table Image.
@@ -417,3 +841,162 @@ class CollectionHasImages(db.Model):
         return {
             "image": self.image.to_json_api()
         }
+
+
+# On crée la table ImageAnnotator, qui résume les annotations d'une image par utilisateur-ice : nombre d'authorships
+# et date de la dernière. Elle est tenue à jour à chaque écriture (voir modeles/counters.py) et permet de compter
+# les annotateur-ices d'une collection, ou de retrouver les images annotées par un-e utilisateur-ice,
+# sans lire les annotations.
+class ImageAnnotator(db.Model):
+    __tablename__ = "image_annotator"
+    image_annotator_image_id = db.Column(db.Integer, db.ForeignKey("image.image_id"), primary_key=True)
+    image_annotator_user_id = db.Column(db.Integer, db.ForeignKey("user.user_id"), primary_key=True, index=True)
+    image_annotator_count = db.Column(db.Integer, nullable=False, default=0)
+    image_annotator_last = db.Column(db.DateTime)
+
+
+# On crée la table AnnotationChange, journal des créations, modifications et suppressions d'annotations.
+# Elle est remplie à chaque écriture (voir modeles/changes.py) et permet aux moissonneurs de ne récupérer
+# que les annotations modifiées depuis leur dernière synchronisation.
+class AnnotationChange(db.Model):
+    __tablename__ = "annotation_change"
+    # AUTOINCREMENT : les numéros de séquence ne sont jamais réutilisés, même si les dernières lignes sont supprimées.
+    __table_args__ = {"sqlite_autoincrement": True}
+    # Numéro de séquence de la modification, croissant.
+    annotation_change_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    # Ce ne sont pas des clés étrangères : la suppression de l'annotation (et de son image) est conservée au journal.
+    annotation_change_annotation_id = db.Column(db.Integer, nullable=False, index=True)
+    annotation_change_image_id = db.Column(db.Integer, index=True)
+    # Type de modification : "created", "updated" ou "deleted".
+    annotation_change_action = db.Column(db.String(10), nullable=False)
+    annotation_change_date = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+
+    @staticmethod
+    def since(sequence, limit, collection_id=None):
+        """ Retourne les modifications d'annotations postérieures à un numéro de séquence, dans l'ordre.
+        Si une annotation a été modifiée plusieurs fois dans la page, seule sa dernière modification est gardée.
+        Les annotations existantes sont chargées avec leurs authorships.
+
+        :param sequence: numéro de séquence de la dernière modification déjà reçue (0 pour tout recevoir)
+        :type sequence: int
+        :param limit: nombre maximum de modifications lues
+        :type limit: int
+        :param collection_id: si renseigné, seules les modifications des annotations des images de la collection
+        sont renvoyées
+        :type collection_id: int
+        :return: tuple (modifications, dernier numéro de séquence lu, True s'il reste des modifications)
+        :rtype: tuple
+        """
+
+        query = AnnotationChange.query.filter(AnnotationChange.annotation_change_id > sequence)
+        if collection_id is not None:
+            query = query.join(
+                CollectionHasImages,
+                CollectionHasImages.collection_has_images_image_id == AnnotationChange.annotation_change_image_id
+            ).filter(CollectionHasImages.collection_has_images_collection_id == collection_id)
+        # On lit une modification de plus que demandé pour savoir s'il en reste.
+        rows = query.order_by(AnnotationChange.annotation_change_id).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if not rows:
+            return [], sequence, False
+
+        # On ne garde que la dernière modification de chaque annotation.
+        latest = {change.annotation_change_annotation_id: change for change in rows}
+        changes = sorted(latest.values(), key=lambda change: change.annotation_change_id)
+
+        # On charge en deux requêtes les annotations encore existantes et leurs authorships.
+        annotations = {
+            annotation.annotation_id: annotation
+            for annotation in Annotation.preload_for_api(
+                Annotation.query.filter(Annotation.annotation_id.in_(list(latest))).all()
+            )
+        }
+        for change in changes:
+            change.current_annotation = annotations.get(change.annotation_change_annotation_id)
+
+        return changes, rows[-1].annotation_change_id, has_more
+
+    def to_json_api(self):
+        """ Retourne la modification sous forme de dictionnaire pour son exploitation au format JSON via l'API.
+        L'annotation est renvoyée dans son état actuel, ou vaut None si elle a été supprimée depuis.
+
+        :return: dictionnaire des données de la modification
+        :rtype: dict
+        """
+
+        annotation = getattr(self, "current_annotation", None)
+        return {
+            "type": "change",
+            "attributes": {
+                "sequence": self.annotation_change_id,
+                "action": self.annotation_change_action,
+                "on": self.annotation_change_date,
+                "annotation_id": self.annotation_change_annotation_id,
+                "image_id": self.annotation_change_image_id,
+                "annotation": annotation.to_json_api() if annotation is not None else None
+            }
+        }
+
+
+# On crée la table ImportJob, qui suit l'import en arrière-plan des images d'une collection.
+class ImportJob(db.Model):
+    __tablename__ = "import_job"
+    import_job_id = db.Column(db.Integer, unique=True, nullable=False, primary_key=True, autoincrement=True)
+    # ID de la collection dans laquelle les images sont importées.
+    # Ce n'est pas une clé étrangère : l'import est conservé si la collection est supprimée après un échec,
+    # pour garder la trace de l'erreur.
+    import_job_collection_id = db.Column(db.Integer, nullable=False, index=True)
+    # Clé étrangère de l'utilisateur-ice qui a lancé l'import.
+    import_job_user_id = db.Column(db.Integer, db.ForeignKey("user.user_id"))
+    # Source de l'import : "iiif" ou "flickr" (images), "annotations" (import d'un fichier d'annotations).
+    import_job_source = db.Column(db.String(20), nullable=False)
+    # Étape de l'import : "queued", "fetching", "inserting", "metadata" (métadonnées des images), "done" ou "failed".
+    import_job_phase = db.Column(db.String(20), nullable=False, default="queued")
+    # Nombre d'images enregistrées, et nombre d'images annoncé par la source s'il est connu.
+    import_job_processed = db.Column(db.Integer, nullable=False, default=0)
+    import_job_total = db.Column(db.Integer)
+    import_job_error = db.Column(db.Text)
+    import_job_created = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    import_job_started = db.Column(db.DateTime)
+    import_job_finished = db.Column(db.DateTime)
+    # Processus qui exécute l'import ("machine:pid") : un import dont le processus n'existe plus a été interrompu.
+    import_job_owner = db.Column(db.String(255))
+    # Fichier d'annotations en attente d'import, supprimé à la fin de l'import.
+    import_job_path = db.Column(db.Text)
+
+    def to_json_api(self):
+        """ Retourne l'état de l'import sous forme de dictionnaire
+        pour son exploitation au format JSON via l'API.
+
+        :return: dictionnaire de l'état de l'import
+        :rtype: dict
+        """
+
+        # Le débit est calculé sur la durée de l'import, jusqu'à maintenant s'il n'est pas terminé.
+        throughput = None
+        if self.import_job_started:
+            end = self.import_job_finished or datetime.datetime.utcnow()
+            elapsed = (end - self.import_job_started).total_seconds()
+            if elapsed > 0:
+                throughput = round(self.import_job_processed / elapsed, 2)
+
+        return {
+            "type": "job",
+            "id": self.import_job_id,
+            "attributes": {
+                "source": self.import_job_source,
+                "phase": self.import_job_phase,
+                "processed": self.import_job_processed,
+                "total": self.import_job_total,
+                "throughput": throughput,
+                "error": self.import_job_error,
+                "created": self.import_job_created,
+                "started": self.import_job_started,
+                "finished": self.import_job_finished
+            },
+            "links": {
+                "self": url_for("api_job", job_id=self.import_job_id, _external=True),
+                "collection": url_for("collection", collection_id=self.import_job_collection_id, _external=True)
+            }
+        }
@@ -0,0 +1,434 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import time
+import zlib
+
+from sqlalchemy import create_engine, func, select
+
+from .data import Annotation, Collection, CollectionHasImages, Image
+from .json_export import RawJSON, dumps_api, orjson
+
+# zstandard est une dépendance optionnelle : s'il est installé, les exports peuvent être compressés avec zstd.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Formats d'export :
+# - "jsonl" : une ligne JSON par annotation, avec les ID de sa collection et de son image et l'URL de l'image ;
+# - "w3c" : une ligne JSON par page d'annotations (AnnotationPage du modèle W3C Web Annotation), chaque page
+#   faisant partie de l'AnnotationCollection d'une collection.
+EXPORT_FORMATS = ("jsonl", "w3c")
+# Compressions des exports : extension des fichiers produits.
+EXPORT_COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+W3C_CONTEXT = "http://www.w3.org/ns/anno.jsonld"
+
+# Taille (en caractères) des blocs de texte transmis au compresseur.
+_BLOCK_SIZE = 64 * 1024
+
+
+def corpus_query(first_collection_id=None, last_collection_id=None):
+    """ Construit la requête de lecture des annotations du corpus, triées par collection, image et annotation.
+
+    :param first_collection_id: ID de la première collection exportée (None pour commencer à la première)
+    :type first_collection_id: int
+    :param last_collection_id: ID de la dernière collection exportée (None pour aller jusqu'à la dernière)
+    :type last_collection_id: int
+    :return: requête
+    :rtype: Select
+    """
+
+    links = CollectionHasImages.__table__
+    collections = Collection.__table__
+    images = Image.__table__
+    annotations = Annotation.__table__
+
+    query = select([
+        links.c.collection_has_images_collection_id, collections.c.collection_name,
+        images.c.image_id, images.c.image_url,
+        annotations.c.annotation_id, annotations.c.annotation_json
+    ]).select_from(
+        links.join(collections, collections.c.collection_id == links.c.collection_has_images_collection_id)
+        .join(images, images.c.image_id == links.c.collection_has_images_image_id)
+        .join(annotations, annotations.c.annotation_image_id == images.c.image_id)
+    )
+    if first_collection_id is not None:
+        query = query.where(links.c.collection_has_images_collection_id >= first_collection_id)
+    if last_collection_id is not None:
+        query = query.where(links.c.collection_has_images_collection_id <= last_collection_id)
+    return query.order_by(
+        links.c.collection_has_images_collection_id, images.c.image_id, annotations.c.annotation_id
+    )
+
+
+def iter_corpus_rows(connection, first_collection_id=None, last_collection_id=None, chunk_size=1000):
+    """ Lit les annotations du corpus par lots, avec un curseur côté serveur (stream_results) :
+    une seule requête est exécutée, et seul le lot en cours est gardé en mémoire.
+
+    :param connection: connexion à la base de données
+    :param first_collection_id: ID de la première collection exportée
+    :type first_collection_id: int
+    :param last_collection_id: ID de la dernière collection exportée
+    :type last_collection_id: int
+    :param chunk_size: nombre de lignes lues par lot
+    :type chunk_size: int
+    :return: lignes (ID de la collection, nom de la collection, ID de l'image, URL de l'image, ID de l'annotation,
+    annotation)
+    :rtype: generator
+    """
+
+    result = connection.execution_options(stream_results=True).execute(
+        corpus_query(first_collection_id, last_collection_id)
+    )
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+
+def export_json(annotation_json, loads=json.loads):
+    """ Vérifie une annotation enregistrée avant son insertion dans une ligne d'export.
+    Une annotation sur plusieurs lignes (JSON indenté) casserait le fichier JSON-Lines : elle est réencodée
+    en JSON compact. Une annotation dont le JSON est invalide, ou n'est pas un objet, n'est pas exportée.
+
+    :param annotation_json: annotation, telle qu'enregistrée en base
+    :type annotation_json: str
+    :param loads: fonction de décodage du JSON (json.loads ou orjson.loads)
+    :type loads: callable
+    :return: JSON de l'annotation, sur une ligne, ou None s'il est invalide
+    :rtype: str
+    """
+
+    try:
+        annotation = loads(annotation_json)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(annotation, dict):
+        return None
+    if "\n" in annotation_json or "\r" in annotation_json:
+        return json.dumps(annotation, separators=(",", ":"), ensure_ascii=False)
+    return annotation_json
+
+
+def iter_export_lines(rows, export_format="jsonl", base_url="", page_size=100, backend="json", invalid=None):
+    """ Transforme les lignes lues par iter_corpus_rows() en lignes d'export (JSON-Lines).
+    Les annotations enregistrées sont vérifiées (voir export_json), puis insérées telles quelles, sans être
+    réencodées.
+
+    :param rows: lignes lues par iter_corpus_rows()
+    :type rows: iterable
+    :param export_format: "jsonl" (une annotation par ligne) ou "w3c" (une AnnotationPage par ligne)
+    :type export_format: str
+    :param base_url: URL de l'application, utilisée pour les identifiants des collections
+    :type base_url: str
+    :param page_size: nombre d'annotations par AnnotationPage
+    :type page_size: int
+    :param backend: encodeur JSON des AnnotationPage, "json" ou "orjson"
+    :type backend: str
+    :param invalid: si une liste est donnée, les ID des annotations non exportées (JSON invalide) y sont ajoutés
+    :type invalid: list
+    :return: lignes de texte, terminées par un retour à la ligne
+    :rtype: generator
+    """
+
+    loads = orjson.loads if backend == "orjson" and orjson is not None else json.loads
+
+    def checked(rows):
+        for row in rows:
+            annotation_json = export_json(row[5], loads)
+            if annotation_json is None:
+                if invalid is not None:
+                    invalid.append(row[4])
+                continue
+            yield row[:5] + (annotation_json,)
+
+    rows = checked(rows)
+
+    if export_format == "jsonl":
+        for collection_id, _, image_id, image_url, annotation_id, annotation_json in rows:
+            # Une ligne par annotation : la ligne est formatée directement, c'est le cas le plus courant.
+            yield '{{"collection_id":{0},"image_id":{1},"image_url":{2},"annotation_id":{3},"annotation":{4}}}\n'.format(
+                collection_id, image_id, json.dumps(image_url, ensure_ascii=False), annotation_id, annotation_json
+            )
+        return
+
+    def page(collection_id, collection_name, start_index, items):
+        return dumps_api({
+            "@context": W3C_CONTEXT,
+            "type": "AnnotationPage",
+            "partOf": {
+                "id": "{0}/api/collection/{1}".format(base_url, collection_id),
+                "type": "AnnotationCollection",
+                "label": collection_name
+            },
+            "startIndex": start_index,
+            "items": items
+        }, ensure_ascii=False, backend=backend) + "\n"
+
+    current = None
+    items = []
+    start_index = 0
+    for collection_id, collection_name, _, _, _, annotation_json in rows:
+        if current is not None and (collection_id != current[0] or len(items) >= page_size):
+            yield page(current[0], current[1], start_index, items)
+            start_index = start_index + len(items) if collection_id == current[0] else 0
+            items = []
+        current = (collection_id, collection_name)
+        # Les annotations enregistrées (Annotorious) ont déjà leur id et leur @context W3C.
+        items.append(RawJSON(annotation_json))
+    if items:
+        yield page(current[0], current[1], start_index, items)
+
+
+def check_compression(compression):
+    """ Vérifie qu'une compression est disponible.
+
+    :param compression: None, "gzip" ou "zstd"
+    :type compression: str
+    :return: message d'erreur, ou None si la compression est disponible
+    :rtype: str
+    """
+
+    if compression not in EXPORT_COMPRESSIONS:
+        return "Compression inconnue : {0} (gzip ou zstd).".format(compression)
+    if compression == "zstd" and zstandard is None:
+        return "La compression zstd nécessite le paquet zstandard (pip install zstandard)."
+    return None
+
+
+def iter_encoded(lines, compression=None):
+    """ Encode des lignes de texte en UTF-8 et les compresse, par blocs.
+
+    :param lines: lignes de texte
+    :type lines: iterable
+    :param compression: None, "gzip" ou "zstd"
+    :type compression: str
+    :return: blocs d'octets
+    :rtype: generator
+    """
+
+    if compression == "gzip":
+        # wbits=31 : format gzip (en-tête et somme de contrôle), lisible par gzip.open() et zcat.
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif compression == "zstd":
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = None
+
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= _BLOCK_SIZE:
+            data = "".join(block).encode("utf-8")
+            block, size = [], 0
+            if compressor is not None:
+                data = compressor.compress(data)
+            if data:
+                yield data
+
+    data = "".join(block).encode("utf-8")
+    if compressor is not None:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def export_corpus(engine, output, export_format="jsonl", compression=None, first_collection_id=None,
+                  last_collection_id=None, chunk_size=1000, base_url="", page_size=100, backend="json", invalid=None):
+    """ Écrit les annotations du corpus (ou d'un intervalle d'ID de collections) dans un fichier.
+    Retourne un tuple (booléen, nombre d'annotations exportées ou liste).
+
+    :param engine: moteur de la base de données
+    :type engine: Engine
+    :param output: chemin du fichier, ou fichier ouvert en écriture binaire
+    :param export_format: "jsonl" ou "w3c"
+    :type export_format: str
+    :param compression: None, "gzip" ou "zstd"
+    :type compression: str
+    :param first_collection_id: ID de la première collection exportée
+    :type first_collection_id: int
+    :param last_collection_id: ID de la dernière collection exportée
+    :type last_collection_id: int
+    :param chunk_size: nombre d'annotations lues par lot
+    :type chunk_size: int
+    :param base_url: URL de l'application, utilisée pour les identifiants
+    :type base_url: str
+    :param page_size: nombre d'annotations par AnnotationPage (format "w3c")
+    :type page_size: int
+    :param backend: encodeur JSON, "json" ou "orjson"
+    :type backend: str
+    :param invalid: si une liste est donnée, les ID des annotations non exportées (JSON invalide) y sont ajoutés
+    :type invalid: list
+    :return: tuple (booléen, nombre d'annotations exportées ou liste d'erreurs)
+    :rtype: tuple
+    """
+
+    erreurs = []
+    if export_format not in EXPORT_FORMATS:
+        erreurs.append("Format inconnu : {0} (jsonl ou w3c).".format(export_format))
+    erreur = check_compression(compression)
+    if erreur:
+        erreurs.append(erreur)
+    if erreurs:
+        return False, erreurs
+
+    count = 0
+    invalid = invalid if invalid is not None else []
+    already_invalid = len(invalid)
+
+    def counted(rows):
+        nonlocal count
+        for row in rows:
+            count += 1
+            yield row
+
+    own_file = isinstance(output, str)
+    stream = open(output, "wb") if own_file else output
+    try:
+        with engine.connect() as connection:
+            rows = counted(iter_corpus_rows(connection, first_collection_id, last_collection_id, chunk_size))
+            lines = iter_export_lines(rows, export_format, base_url, page_size, backend, invalid)
+            for data in iter_encoded(lines, compression):
+                stream.write(data)
+        return True, count - (len(invalid) - already_invalid)
+    except Exception as erreur:
+        return False, [str(erreur)]
+    finally:
+        if own_file:
+            stream.close()
+
+
+def partition_collections(engine, partitions, first_collection_id=None, last_collection_id=None):
+    """ Découpe les ID des collections en intervalles contenant à peu près le même nombre d'annotations.
+
+    :param engine: moteur de la base de données
+    :type engine: Engine
+    :param partitions: nombre d'intervalles souhaité
+    :type partitions: int
+    :param first_collection_id: ID de la première collection exportée
+    :type first_collection_id: int
+    :param last_collection_id: ID de la dernière collection exportée
+    :type last_collection_id: int
+    :return: intervalles (ID de la première collection, ID de la dernière collection), dans l'ordre
+    :rtype: list
+    """
+
+    links = CollectionHasImages.__table__
+    annotations = Annotation.__table__
+    query = select([
+        links.c.collection_has_images_collection_id, func.count(annotations.c.annotation_id)
+    ]).select_from(
+        links.join(annotations, annotations.c.annotation_image_id == links.c.collection_has_images_image_id)
+    ).group_by(links.c.collection_has_images_collection_id).order_by(links.c.collection_has_images_collection_id)
+    if first_collection_id is not None:
+        query = query.where(links.c.collection_has_images_collection_id >= first_collection_id)
+    if last_collection_id is not None:
+        query = query.where(links.c.collection_has_images_collection_id <= last_collection_id)
+
+    with engine.connect() as connection:
+        counts = connection.execute(query).fetchall()
+    if not counts:
+        return []
+
+    target = sum(count for _, count in counts) / max(partitions, 1)
+    ranges = []
+    start = counts[0][0]
+    size = 0
+    for index, (collection_id, count) in enumerate(counts):
+        size += count
+        is_last = index == len(counts) - 1
+        if is_last or (size >= target and len(ranges) < partitions - 1):
+            ranges.append((start, collection_id))
+            if not is_last:
+                start = counts[index + 1][0]
+            size = 0
+    return ranges
+
+
+def _export_partition(url, path, *args, **options):
+    """ Exporte un intervalle de collections dans un processus de export_partitions(), avec son propre moteur.
+    Retourne aussi les ID des annotations non exportées : la liste n'est pas partagée entre les processus.
+    """
+
+    engine = create_engine(url)
+    invalid = []
+    try:
+        return path, export_corpus(engine, path, *args, invalid=invalid, **options), invalid
+    finally:
+        engine.dispose()
+
+
+def export_partitions(engine, directory, partitions, workers, export_format="jsonl", compression=None,
+                      first_collection_id=None, last_collection_id=None, on_done=None, invalid=None, **options):
+    """ Exporte le corpus en plusieurs fichiers en parallèle, un par intervalle d'ID de collections.
+    Chaque fichier est écrit par un processus, avec sa propre connexion à la base de données : la sérialisation
+    et la compression des fichiers se font sur plusieurs cœurs.
+
+    :param engine: moteur de la base de données
+    :type engine: Engine
+    :param directory: dossier des fichiers produits
+    :type directory: str
+    :param partitions: nombre de fichiers
+    :type partitions: int
+    :param workers: nombre de fichiers écrits en même temps
+    :type workers: int
+    :param export_format: "jsonl" ou "w3c"
+    :type export_format: str
+    :param compression: None, "gzip" ou "zstd"
+    :type compression: str
+    :param first_collection_id: ID de la première collection exportée
+    :type first_collection_id: int
+    :param last_collection_id: ID de la dernière collection exportée
+    :type last_collection_id: int
+    :param on_done: fonction appelée à la fin de chaque fichier avec (chemin, résultat de export_corpus())
+    :type on_done: callable
+    :param invalid: si une liste est donnée, les ID des annotations non exportées (JSON invalide) y sont ajoutés
+    :type invalid: list
+    :param options: autres options de export_corpus() (chunk_size, base_url, page_size, backend)
+    :return: tuple (booléen, nombre total d'annotations exportées ou liste d'erreurs)
+    :rtype: tuple
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    ranges = partition_collections(engine, partitions, first_collection_id, last_collection_id)
+    extension = ".jsonl" + EXPORT_COMPRESSIONS.get(compression, "")
+    # L'URL complète (avec le mot de passe) permet à chaque processus d'ouvrir sa connexion.
+    url = engine.url.__to_string__(hide_password=False)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [
+            executor.submit(
+                _export_partition, url,
+                os.path.join(directory, "annotations-{0}-{1}{2}".format(first, last, extension)),
+                export_format, compression, first, last, **options
+            )
+            for first, last in ranges
+        ]
+        for future in as_completed(futures):
+            path, result, partition_invalid = future.result()
+            if invalid is not None:
+                invalid.extend(partition_invalid)
+            if on_done is not None:
+                on_done(path, result)
+            results.append(result)
+
+    erreurs = [erreur for status, result in results if status is False for erreur in result]
+    if erreurs:
+        return False, erreurs
+    return True, sum(result for _, result in results)
+
+
+def throughput(count, start):
+    """ Retourne le débit (annotations par seconde) d'un export commencé à start (time.perf_counter()). """
+
+    elapsed = time.perf_counter() - start
+    return round(count / elapsed, 1) if elapsed > 0 else None
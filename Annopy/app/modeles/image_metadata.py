@@ -0,0 +1,124 @@
+import datetime
+
+from sqlalchemy import select
+
+from ..app import db, http_cache
+from ..img_extractors.image_info import prefetch_image_info
+from .data import CollectionHasImages, Image
+from .versions import bump_session_versions
+
+
+def metadata_columns(metadata):
+    """ Convertit les métadonnées d'une image (width, height, format, service) en colonnes de la table image.
+
+    :param metadata: dictionnaire (width, height, format, service)
+    :type metadata: dict
+    :return: dictionnaire des colonnes
+    :rtype: dict
+    """
+
+    return {
+        "image_width": metadata.get("width"),
+        "image_height": metadata.get("height"),
+        "image_format": metadata.get("format"),
+        "image_service": metadata.get("service")
+    }
+
+
+def prefetch_image_metadata(collection_id=None, refresh=False, batch_size=200, max_workers=8, timeout=10,
+                            max_bytes=64 * 1024, on_batch=None):
+    """ Récupère et enregistre les dimensions, le format et le service IIIF des images, sans les télécharger :
+    depuis info.json pour les images IIIF, depuis le début du fichier pour les autres (images Flickr).
+    Les images sont traitées par lots de batch_size, dans l'ordre de leur ID ; les requêtes d'un lot sont lancées
+    en parallèle, puis le lot est commité. Une image injoignable est marquée comme traitée, sans métadonnées.
+    Retourne un tuple (booléen, dictionnaire ou liste).
+
+    :param collection_id: ID de la collection dont les images sont traitées (par défaut, toutes les images)
+    :type collection_id: int
+    :param refresh: True pour traiter aussi les images dont les métadonnées ont déjà été récupérées
+    :type refresh: bool
+    :param batch_size: nombre d'images traitées par lot
+    :type batch_size: int
+    :param max_workers: nombre maximum de requêtes lancées en même temps
+    :type max_workers: int
+    :param timeout: délai maximum (en secondes) accordé à chaque requête HTTP
+    :type timeout: float
+    :param max_bytes: nombre maximum d'octets lus au début de chaque image
+    :type max_bytes: int
+    :param on_batch: fonction appelée après chaque lot avec l'avancement (processed, found)
+    :type on_batch: callable
+    :return: tuple (booléen, avancement (processed, found) ou liste d'erreurs)
+    :rtype: tuple
+    """
+
+    images = Image.__table__
+    links = CollectionHasImages.__table__
+    state = {"processed": 0, "found": 0}
+    last_id = 0
+
+    try:
+        while True:
+            query = select([images.c.image_id, images.c.image_url, images.c.image_format, images.c.image_service])
+            if collection_id is not None:
+                query = query.select_from(
+                    images.join(links, links.c.collection_has_images_image_id == images.c.image_id)
+                ).where(links.c.collection_has_images_collection_id == collection_id)
+            if not refresh:
+                query = query.where(images.c.image_metadata_fetched.is_(None))
+            rows = db.session.execute(
+                query.where(images.c.image_id > last_id).order_by(images.c.image_id).limit(batch_size)
+            ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            # Les requêtes HTTP sont faites hors de toute écriture : la base n'est pas verrouillée pendant ce temps.
+            results = prefetch_image_info(
+                [(image_url, service) for _, image_url, _, service in rows],
+                max_workers=max_workers, timeout=timeout, max_bytes=max_bytes, cache=http_cache
+            )
+
+            now = datetime.datetime.utcnow()
+            found = []
+            missing = []
+            for (image_id, image_url, image_format, service), metadata in zip(rows, results):
+                if metadata is None:
+                    missing.append({"id": image_id, "fetched": now})
+                    continue
+                # On garde le format et le service déjà connus (manifest) si la source ne les donne pas.
+                columns = metadata_columns(metadata)
+                columns["image_format"] = columns["image_format"] or image_format
+                columns["image_service"] = columns["image_service"] or service
+                columns.update(id=image_id, fetched=now)
+                found.append(columns)
+
+            connection = db.session.connection()
+            if found:
+                connection.execute(
+                    images.update().where(images.c.image_id == db.bindparam("id")).values(
+                        image_metadata_fetched=db.bindparam("fetched"),
+                        **{name: db.bindparam(name) for name in metadata_columns({})}
+                    ),
+                    found
+                )
+                # Les métadonnées font partie des données de l'image renvoyées par l'API.
+                bump_session_versions(db.session, image_ids=[columns["id"] for columns in found])
+            if missing:
+                connection.execute(
+                    images.update().where(images.c.image_id == db.bindparam("id")).values(
+                        image_metadata_fetched=db.bindparam("fetched")
+                    ),
+                    missing
+                )
+
+            state["processed"] += len(rows)
+            state["found"] += len(found)
+            if on_batch is not None:
+                on_batch(state)
+            db.session.commit()
+
+        return True, state
+
+    except Exception as erreur:
+        db.session.rollback()
+        return False, [str(erreur)]
@@ -0,0 +1,117 @@
+import datetime
+from itertools import islice
+
+from ..app import db
+from .counters import add_collection_images
+from .data import Image, CollectionHasImages
+from .image_metadata import metadata_columns
+from .versions import bump_session_versions
+
+
+def _batches(iterable, batch_size):
+    """ Découpe un itérable en listes de batch_size éléments au plus.
+
+    :param iterable: itérable à découper (liste, générateur).
+    :param batch_size: taille maximale de chaque lot.
+    :type batch_size: int
+    :return: lots successifs
+    :rtype: generator
+    """
+
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _new_image(url, metadata, now):
+    """ Crée une image, avec ses métadonnées si la source les a données.
+
+    :param url: URL de l'image
+    :type url: str
+    :param metadata: métadonnées des images (clé : URL), ou None
+    :type metadata: dict
+    :param now: date de l'import
+    :type now: datetime.datetime
+    :return: nouvelle image
+    :rtype: Image
+    """
+
+    image_metadata = metadata.get(url) if metadata else None
+    if image_metadata is None:
+        return Image(image_url=url)
+    # Sans les dimensions, les métadonnées restent à récupérer (depuis info.json, si le service est connu).
+    return Image(
+        image_url=url,
+        image_metadata_fetched=now if image_metadata.get("width") else None,
+        **metadata_columns(image_metadata)
+    )
+
+
+def ingest_images(collection, image_urls, batch_size=500, on_batch=None, commit_batches=False, metadata=None):
+    """ Enregistre les images d'une collection en une seule transaction.
+    Les images et leurs associations avec la collection sont insérées par lots, au fur et à mesure de la lecture
+    de image_urls (qui peut être un générateur) : un seul commit est fait, à la fin.
+    Les objets déjà ajoutés à la session (authorship, catégorie) sont enregistrés dans la même transaction.
+    En cas d'erreur, la transaction est annulée et aucune image n'est enregistrée.
+    Avec commit_batches=True, chaque lot est commité : l'avancement est alors visible depuis les autres connexions,
+    mais seul le lot en cours est annulé en cas d'erreur.
+    Retourne un tuple (booléen, nombre d'images ou liste).
+
+    :param collection: collection à laquelle les images sont associées
+    :type collection: Collection
+    :param image_urls: URL des images, dans l'ordre de la collection
+    :type image_urls: iterable
+    :param batch_size: nombre d'images insérées par lot
+    :type batch_size: int
+    :param on_batch: fonction appelée après chaque lot avec le nombre total d'images insérées
+    :type on_batch: callable
+    :param commit_batches: True pour commiter après chaque lot
+    :type commit_batches: bool
+    :param metadata: métadonnées des images données par la source (clé : URL ; valeur : width, height, format,
+    service), par exemple celles d'un manifest IIIF
+    :type metadata: dict
+    :return: tuple (booléen, nombre d'images enregistrées ou liste d'erreurs)
+    :rtype: tuple
+    """
+
+    count = 0
+
+    try:
+        for batch in _batches(image_urls, batch_size):
+            # On crée les images du lot. return_defaults=True permet de récupérer leur ID
+            # sans refaire de requête pour retrouver la dernière image créée.
+            now = datetime.datetime.utcnow()
+            images = [_new_image(url, metadata, now) for url in batch]
+            db.session.bulk_save_objects(images, return_defaults=True)
+
+            # On associe toutes les images du lot à la collection en une seule requête (executemany).
+            db.session.bulk_insert_mappings(CollectionHasImages, [
+                {
+                    "collection_has_images_collection_id": collection.collection_id,
+                    "collection_has_images_image_id": image.image_id
+                }
+                for image in images
+            ])
+
+            # Les insertions en masse ne passent pas par les événements de la session :
+            # on incrémente nous-mêmes la version de la collection.
+            bump_session_versions(db.session, collection_ids=[collection.collection_id])
+            # Les nouvelles images n'ont pas d'annotation : seul le nombre d'images de la collection change.
+            add_collection_images(db.session.connection(), collection.collection_id, len(images))
+
+            count += len(images)
+            if on_batch is not None:
+                on_batch(count)
+            if commit_batches:
+                db.session.commit()
+
+        # On commit une seule fois, pour toutes les images (ou pour le dernier lot).
+        db.session.commit()
+        return True, count
+
+    except Exception as erreur:
+        db.session.rollback()
+        return False, [str(erreur)]
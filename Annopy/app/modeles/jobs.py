@@ -0,0 +1,311 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os
+import socket
+import threading
+
+from ..app import app, db
+from .annotation_import import import_annotations, iter_units, open_input
+from .data import Collection, ImportJob
+from .image_metadata import prefetch_image_metadata
+from .ingestion import ingest_images
+from .users import User
+
+# Étapes d'un import qui n'est pas terminé.
+PENDING_PHASES = ("queued", "fetching", "inserting", "metadata")
+
+# Pool de threads qui exécute les imports en arrière-plan. Il est créé au premier import,
+# une fois la configuration de l'application chargée.
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    """ Retourne le pool de threads des imports, en le créant si besoin.
+
+    :return: pool de threads
+    :rtype: ThreadPoolExecutor
+    """
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=app.config["IMPORT_WORKERS"])
+    return _executor
+
+
+def _process_owner():
+    """ Retourne l'identifiant du processus courant ("machine:pid"), enregistré dans les imports qu'il exécute.
+
+    :return: identifiant du processus
+    :rtype: str
+    """
+
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+
+def _owner_alive(owner):
+    """ Indique si le processus qui exécute un import existe encore. Un processus d'une autre machine
+    est considéré comme vivant : son état ne peut pas être vérifié.
+
+    :param owner: identifiant du processus ("machine:pid"), ou None
+    :type owner: str
+    :return: True si le processus existe (ou ne peut pas être vérifié)
+    :rtype: bool
+    """
+
+    if owner is None:
+        return False
+    host, _, pid = owner.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+def reconcile_import_jobs():
+    """ Termine les imports interrompus par l'arrêt du processus qui les exécutait (redémarrage de l'application) :
+    les imports s'exécutent dans les threads de ce processus et ne reprennent pas seuls.
+    Un import d'images interrompu avant la fin de l'enregistrement des images échoue et sa collection incomplète
+    est supprimée, comme dans run_import_job ; interrompu pendant la récupération des métadonnées, il est terminé
+    avec une erreur, sans supprimer la collection. Un import d'annotations échoue (les lots déjà enregistrés sont
+    conservés) et son fichier est supprimé.
+    Les imports d'un processus toujours en cours d'exécution (commande flask lancée à côté du serveur, par exemple)
+    ne sont pas modifiés.
+
+    :return: nombre d'imports terminés
+    :rtype: int
+    """
+
+    error = "import interrompu par l'arrêt de l'application"
+    count = 0
+    for job in ImportJob.query.filter(ImportJob.import_job_phase.in_(PENDING_PHASES)).all():
+        if _owner_alive(job.import_job_owner):
+            continue
+
+        if job.import_job_path is not None:
+            try:
+                os.remove(job.import_job_path)
+            except OSError:
+                pass
+
+        if job.import_job_source == "annotations":
+            _finish(job, "failed", error)
+        elif job.import_job_phase == "metadata":
+            _finish(job, "done", "métadonnées des images : " + error)
+        else:
+            collection = Collection.query.get(job.import_job_collection_id)
+            if collection is not None:
+                db.session.delete(collection)
+            _finish(job, "failed", error)
+        count += 1
+
+    return count
+
+
+def submit_import_job(collection, user, source, producer):
+    """ Crée un import en arrière-plan pour une collection et le place dans la file d'attente.
+    producer est la fonction qui récupère les images depuis la source (iiif_query, photoset_flickr_stream) :
+    elle est appelée dans le thread de l'import et doit retourner un tuple (URL des images, nombre total d'images
+    ou None), ou False en cas d'erreur. Le tuple peut contenir en troisième élément les métadonnées des images
+    données par la source (dictionnaire dont les clés sont les URL, voir ingest_images).
+
+    :param collection: collection dans laquelle les images sont importées
+    :type collection: Collection
+    :param user: utilisateur-ice qui lance l'import
+    :type user: User
+    :param source: source des images ("iiif" ou "flickr")
+    :type source: str
+    :param producer: fonction qui récupère les URL des images
+    :type producer: callable
+    :return: import créé
+    :rtype: ImportJob
+    """
+
+    job = ImportJob(
+        import_job_collection_id=collection.collection_id,
+        import_job_user_id=user.user_id,
+        import_job_source=source,
+        import_job_phase="queued",
+        import_job_owner=_process_owner()
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    _get_executor().submit(run_import_job, job.import_job_id, producer)
+    return job
+
+
+def _finish(job, phase, error=None):
+    """ Enregistre la fin d'un import.
+
+    :param job: import terminé
+    :type job: ImportJob
+    :param phase: "done" ou "failed"
+    :type phase: str
+    :param error: message d'erreur, si l'import a échoué
+    :type error: str
+    """
+
+    job.import_job_phase = phase
+    job.import_job_error = error
+    job.import_job_finished = datetime.datetime.utcnow()
+    db.session.add(job)
+    db.session.commit()
+
+
+def run_import_job(job_id, producer):
+    """ Exécute un import : récupère les URL des images depuis la source, puis les enregistre en base par lots.
+    L'avancement est enregistré dans la table ImportJob après chaque lot.
+    Si l'import échoue, ou si aucune image n'a été récupérée, la collection est supprimée.
+    Une fois les images enregistrées, leurs dimensions, leur format et leur service IIIF sont récupérés
+    (étape "metadata") ; une erreur lors de cette étape est enregistrée dans l'import, sans supprimer la collection.
+
+    :param job_id: ID de l'import
+    :type job_id: int
+    :param producer: fonction qui récupère les URL des images
+    :type producer: callable
+    """
+
+    with app.app_context():
+        job = ImportJob.query.get(job_id)
+        collection = Collection.query.get(job.import_job_collection_id)
+
+        try:
+            job.import_job_phase = "fetching"
+            job.import_job_started = datetime.datetime.utcnow()
+            db.session.commit()
+
+            result = producer()
+            if not result:
+                raise ValueError("la récupération des images depuis la source a échoué")
+            imgs_url, total = result[:2]
+            metadata = result[2] if len(result) > 2 else None
+
+            job.import_job_phase = "inserting"
+            job.import_job_total = total
+            db.session.commit()
+
+            def on_batch(count):
+                # L'avancement est commité avec le lot d'images correspondant.
+                job.import_job_processed = count
+
+            status, data = ingest_images(
+                collection, imgs_url,
+                batch_size=app.config["INGESTION_BATCH_SIZE"],
+                on_batch=on_batch,
+                commit_batches=True,
+                metadata=metadata
+            )
+
+            if status is True and data == 0:
+                status, data = False, ["aucune image n'a été récupérée"]
+            if status is False:
+                raise ValueError(", ".join(data))
+
+        except Exception as erreur:
+            db.session.rollback()
+            # On supprime la collection pour ne pas garder une collection incomplète.
+            collection = Collection.query.get(job.import_job_collection_id)
+            if collection is not None:
+                db.session.delete(collection)
+            _finish(job, "failed", str(erreur))
+            return
+
+        # Les images sont enregistrées : les métadonnées manquantes pourront être récupérées plus tard
+        # avec la commande flask prefetch-images.
+        job.import_job_phase = "metadata"
+        db.session.commit()
+        status, data = prefetch_image_metadata(
+            collection_id=job.import_job_collection_id,
+            batch_size=app.config["IMAGE_METADATA_BATCH_SIZE"],
+            max_workers=app.config["IMAGE_METADATA_WORKERS"],
+            timeout=app.config["IMAGE_METADATA_TIMEOUT"],
+            max_bytes=app.config["IMAGE_METADATA_SNIFF_SIZE"]
+        )
+        _finish(job, "done", None if status else "métadonnées des images : " + ", ".join(data))
+
+
+def submit_annotation_import_job(collection, user, path, import_format):
+    """ Crée un import d'annotations en arrière-plan dans une collection et le place dans la file d'attente.
+    Le fichier est supprimé à la fin de l'import.
+
+    :param collection: collection dont les images sont annotées
+    :type collection: Collection
+    :param user: utilisateur-ice qui lance l'import, auteur-ice des annotations
+    :type user: User
+    :param path: chemin du fichier d'annotations (JSON-Lines ou document W3C, compressé avec gzip s'il finit par .gz)
+    :type path: str
+    :param import_format: "jsonl" ou "w3c"
+    :type import_format: str
+    :return: import créé
+    :rtype: ImportJob
+    """
+
+    job = ImportJob(
+        import_job_collection_id=collection.collection_id,
+        import_job_user_id=user.user_id,
+        import_job_source="annotations",
+        import_job_phase="queued",
+        import_job_owner=_process_owner(),
+        import_job_path=path
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    _get_executor().submit(run_annotation_import_job, job.import_job_id, path, import_format)
+    return job
+
+
+def run_annotation_import_job(job_id, path, import_format):
+    """ Exécute un import d'annotations : les annotations du fichier sont enregistrées par lots sur les images
+    de la collection. L'avancement (nombre d'annotations enregistrées) est enregistré après chaque lot.
+    Si l'import échoue, les lots déjà enregistrés sont conservés.
+
+    :param job_id: ID de l'import
+    :type job_id: int
+    :param path: chemin du fichier d'annotations
+    :type path: str
+    :param import_format: "jsonl" ou "w3c"
+    :type import_format: str
+    """
+
+    with app.app_context():
+        job = ImportJob.query.get(job_id)
+
+        try:
+            job.import_job_phase = "inserting"
+            job.import_job_started = datetime.datetime.utcnow()
+            db.session.commit()
+
+            def on_batch(state):
+                # L'avancement est commité avec le lot d'annotations suivant, ou à la fin de l'import.
+                job.import_job_processed = state["imported"]
+
+            with open_input(path) as stream:
+                status, data = import_annotations(
+                    iter_units(stream, import_format), User.query.get(job.import_job_user_id),
+                    job.import_job_collection_id,
+                    batch_size=app.config["ANNOTATION_IMPORT_BATCH_SIZE"], on_batch=on_batch
+                )
+            if status is False:
+                raise ValueError(", ".join(data))
+
+            job.import_job_processed = data["imported"]
+            _finish(job, "done")
+
+        except Exception as erreur:
+            db.session.rollback()
+            _finish(job, "failed", str(erreur))
+
+        finally:
+            # Le fichier a pu être supprimé par reconcile_import_jobs() au redémarrage d'un autre processus.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,243 @@
+from datetime import date, datetime
+from uuid import uuid4
+import json as std_json
+import re
+
+from flask import current_app, json
+from flask.json import JSONEncoder
+from werkzeug.http import http_date
+
+# orjson est une dépendance optionnelle : s'il est installé, il peut être choisi pour encoder les réponses de l'API
+# (configuration API_JSON_BACKEND).
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class RawJSON:
+    """ Fragment de JSON déjà encodé (par exemple une annotation stockée en base), inséré tel quel dans la réponse,
+    sans être décodé puis réencodé.
+    """
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+
+class ApiJSONEncoder(JSONEncoder):
+    """ Encodeur JSON de l'application. Il accepte les RawJSON, qu'il décode si on ne passe pas par dumps_api(). """
+
+    def default(self, o):
+        if isinstance(o, RawJSON):
+            return std_json.loads(o.text)
+        return JSONEncoder.default(self, o)
+
+
+class _SplicingEncoder(ApiJSONEncoder):
+    """ Encodeur utilisé par dumps_api() : chaque RawJSON est remplacé par un marqueur unique,
+    qui est ensuite substitué par le texte du fragment.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fragments = []
+        self.nonce = uuid4().hex
+
+    def default(self, o):
+        if isinstance(o, RawJSON):
+            self.fragments.append(o.text)
+            # Le caractère NUL est toujours échappé par l'encodeur : le marqueur ne peut pas être confondu
+            # avec une chaîne de caractères qui aurait le même texte.
+            return "\x00{0}:{1}\x00".format(self.nonce, len(self.fragments) - 1)
+        return ApiJSONEncoder.default(self, o)
+
+
+def _orjson_default(o):
+    """ Conversion des types non gérés par orjson, identique à celle de l'encodeur de Flask pour les dates. """
+
+    if isinstance(o, RawJSON):
+        # orjson.Fragment insère le texte tel quel (orjson >= 3.9). Avant, le fragment est décodé.
+        if hasattr(orjson, "Fragment"):
+            return orjson.Fragment(o.text)
+        return std_json.loads(o.text)
+    if isinstance(o, (date, datetime)):
+        return http_date(o)
+    raise TypeError("Type non sérialisable : {0}".format(type(o).__name__))
+
+
+def dumps_api(value, indent=None, separators=(",", ":"), ensure_ascii=True, backend="json"):
+    """ Sérialise une structure en JSON, en insérant les RawJSON tels quels.
+
+    :param value: structure à sérialiser
+    :param indent: indentation (None pour un JSON compact)
+    :type indent: int
+    :param separators: séparateurs des éléments et des clés
+    :type separators: tuple
+    :param ensure_ascii: True pour échapper les caractères non ASCII
+    :type ensure_ascii: bool
+    :param backend: "json" (bibliothèque standard) ou "orjson"
+    :type backend: str
+    :return: texte JSON
+    :rtype: str
+    """
+
+    if backend == "orjson":
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if indent is not None:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(value, default=_orjson_default, option=option).decode("utf-8")
+
+    encoder = _SplicingEncoder(indent=indent, separators=separators, ensure_ascii=ensure_ascii, sort_keys=False)
+    text = encoder.encode(value)
+    if encoder.fragments:
+        fragments = encoder.fragments
+        marker = re.compile(r'"\\u0000' + encoder.nonce + r':(\d+)\\u0000"')
+        text = marker.sub(lambda m: fragments[int(m.group(1))], text)
+    return text
+
+
+def api_json_backend():
+    """ Retourne l'encodeur JSON choisi pour l'API (configuration API_JSON_BACKEND) :
+    "orjson" s'il est demandé ("orjson" ou "auto") et installé, "json" sinon.
+
+    :return: "json" ou "orjson"
+    :rtype: str
+    """
+
+    backend = current_app.config.get("API_JSON_BACKEND", "json")
+    if backend in ("orjson", "auto") and orjson is not None:
+        return "orjson"
+    return "json"
+
+
+class LazyList:
+    """ Liste dont les éléments sont produits au fur et à mesure de la sérialisation (générateur, requête par lots).
+    Utilisée dans une structure passée à iter_json(), elle permet d'écrire le JSON sans construire la liste en mémoire.
+    """
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+
+    def __iter__(self):
+        return iter(self.iterable)
+
+
+def _has_lazy(value):
+    """ Indique si une structure contient une LazyList (sans parcourir les LazyList elles-mêmes).
+
+    :param value: structure à tester
+    :return: True si la structure contient une LazyList
+    :rtype: bool
+    """
+
+    if isinstance(value, LazyList):
+        return True
+    if isinstance(value, dict):
+        return any(_has_lazy(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(_has_lazy(item) for item in value)
+    return False
+
+
+def jsonify_options():
+    """ Retourne les options de formatage utilisées par jsonify() pour l'application courante,
+    afin que les réponses de l'API écrites avec dumps_api() ou iter_json() soient identiques aux réponses de jsonify().
+
+    :return: options à passer à dumps_api() ou iter_json()
+    :rtype: dict
+    """
+
+    backend = api_json_backend()
+    ensure_ascii = current_app.config["JSON_AS_ASCII"]
+    if current_app.config["JSONIFY_PRETTYPRINT_REGULAR"] or current_app.debug:
+        indent, separators = 2, (", ", ": ")
+    else:
+        indent, separators = None, (",", ":")
+    # orjson écrit toujours en UTF-8, sans espace en fin de ligne : on aligne les options sur son format,
+    # pour que les morceaux écrits par iter_json() soient identiques.
+    if backend == "orjson":
+        ensure_ascii = False
+        if indent is not None:
+            separators = (",", ": ")
+    return {
+        "indent": indent,
+        "separators": separators,
+        "ensure_ascii": ensure_ascii,
+        "backend": backend
+    }
+
+
+def api_jsonify(data):
+    """ Équivalent de jsonify() pour l'API : les RawJSON sont insérés tels quels, et l'encodeur choisi dans la
+    configuration (API_JSON_BACKEND) est utilisé.
+
+    :param data: données à renvoyer
+    :return: HTTP response
+    """
+
+    return current_app.response_class(
+        dumps_api(data, **jsonify_options()) + "\n",
+        mimetype=current_app.config["JSONIFY_MIMETYPE"]
+    )
+
+
+def iter_json(value, indent=None, separators=(",", ":"), ensure_ascii=True, backend="json", _level=0):
+    """ Sérialise une structure en JSON, morceau par morceau.
+    Les parties de la structure qui ne contiennent pas de LazyList sont sérialisées d'un bloc avec dumps_api() ;
+    seules les LazyList et les conteneurs qui les contiennent sont parcourus.
+    Le texte produit est identique à celui de dumps_api() avec les mêmes options.
+
+    :param value: structure à sérialiser
+    :param indent: indentation (None pour un JSON compact)
+    :type indent: int
+    :param separators: séparateurs des éléments et des clés
+    :type separators: tuple
+    :param ensure_ascii: True pour échapper les caractères non ASCII
+    :type ensure_ascii: bool
+    :param backend: "json" (bibliothèque standard) ou "orjson"
+    :type backend: str
+    :return: morceaux successifs du JSON
+    :rtype: generator
+    """
+
+    item_separator, key_separator = separators
+
+    if not _has_lazy(value):
+        text = dumps_api(value, indent, separators, ensure_ascii, backend)
+        # Les chaînes JSON ne contiennent jamais de retour à la ligne non échappé :
+        # on peut décaler l'indentation d'un bloc sérialisé à part en remplaçant les retours à la ligne.
+        if indent is not None and _level:
+            text = text.replace("\n", "\n" + " " * (indent * _level))
+        yield text
+        return
+
+    if indent is not None:
+        newline = "\n" + " " * (indent * (_level + 1))
+        closing = "\n" + " " * (indent * _level)
+    else:
+        newline = closing = ""
+
+    if isinstance(value, dict):
+        if not value:
+            yield "{}"
+            return
+        yield "{"
+        first = True
+        for key, item in value.items():
+            yield (newline if first else item_separator + newline) + json.dumps(key, ensure_ascii=ensure_ascii) + key_separator
+            first = False
+            for chunk in iter_json(item, indent, separators, ensure_ascii, backend, _level + 1):
+                yield chunk
+        yield closing + "}"
+        return
+
+    # Liste ou LazyList : la liste n'est ouverte qu'au premier élément, pour écrire "[]" si elle est vide.
+    first = True
+    for item in value:
+        yield ("[" + newline) if first else (item_separator + newline)
+        first = False
+        for chunk in iter_json(item, indent, separators, ensure_ascii, backend, _level + 1):
+            yield chunk
+    yield "[]" if first else closing + "]"
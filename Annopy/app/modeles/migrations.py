@@ -0,0 +1,288 @@
+import datetime
+import json
+
+from sqlalchemy import func, inspect, literal, select
+
+from ..app import db
+from .counters import refresh_collection_counters, refresh_image_counters
+from .data import Annotation, AnnotationChange, AuthorshipAnnotation, Collection, Image
+from .regions import annotation_bbox, bbox_columns
+
+# Version du schéma de la base de données : numéro de la dernière migration appliquée.
+# La table ne contient qu'une ligne. Elle est créée par db.create_all().
+schema_version = db.Table(
+    "schema_version",
+    db.Column("version", db.Integer, nullable=False)
+)
+
+# Nombre d'annotations réécrites par lot lors de la migration des annotations.
+MIGRATION_BATCH_SIZE = 1000
+
+# Clé du verrou consultatif (PostgreSQL) pris pendant l'application des migrations.
+MIGRATION_LOCK_ID = 7260
+
+
+def create_missing_indexes(connection):
+    """ Crée les index déclarés dans les modèles qui n'existent pas encore dans la base de données.
+    db.create_all() ne crée les index que pour les tables qu'elle crée : les bases existantes sont mises à jour ici.
+    Les index des colonnes qui n'existent pas encore sont créés par la migration qui ajoute ces colonnes.
+
+    :param connection: connexion à la base de données
+    """
+
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if index.name not in existing and all(column.name in columns for column in index.columns):
+                index.create(connection)
+
+
+def add_missing_columns(connection):
+    """ Ajoute aux tables existantes les colonnes déclarées dans les modèles qui n'existent pas encore.
+    Les colonnes NOT NULL doivent avoir une valeur par défaut côté serveur (server_default).
+
+    :param connection: connexion à la base de données
+    """
+
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table in db.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            statement = "ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+                preparer.format_table(table),
+                preparer.format_column(column),
+                column.type.compile(dialect=connection.dialect)
+            )
+            if column.server_default is not None:
+                statement += " DEFAULT {0}".format(column.server_default.arg)
+            if not column.nullable:
+                statement += " NOT NULL"
+            connection.execute(statement)
+
+
+def add_versions(connection):
+    """ Ajoute les colonnes de version et de date de modification des collections et des images.
+    La date de modification des lignes existantes est la date de la migration.
+
+    :param connection: connexion à la base de données
+    """
+
+    add_missing_columns(connection)
+    now = datetime.datetime.utcnow()
+    collections = Collection.__table__
+    images = Image.__table__
+    connection.execute(
+        collections.update().where(collections.c.collection_modified.is_(None)).values(collection_modified=now)
+    )
+    connection.execute(
+        images.update().where(images.c.image_modified.is_(None)).values(image_modified=now)
+    )
+
+
+def fill_annotation_changes(connection):
+    """ Remplit le journal des modifications d'annotations avec les annotations existantes,
+    enregistrées comme créées à la date de leur première authorship.
+    Un moissonneur qui lit le journal depuis le début reçoit ainsi toutes les annotations.
+
+    :param connection: connexion à la base de données
+    """
+
+    annotations = Annotation.__table__
+    authorships = AuthorshipAnnotation.__table__
+    changes = AnnotationChange.__table__
+    first_date = select([func.min(authorships.c.authorship_annotation_date)]).where(
+        authorships.c.authorship_annotation_annotation_id == annotations.c.annotation_id
+    ).as_scalar()
+    connection.execute(changes.insert().from_select(
+        [
+            changes.c.annotation_change_annotation_id, changes.c.annotation_change_image_id,
+            changes.c.annotation_change_action, changes.c.annotation_change_date
+        ],
+        select([
+            annotations.c.annotation_id, annotations.c.annotation_image_id,
+            literal("created"), func.coalesce(first_date, datetime.datetime.utcnow())
+        ]).order_by(annotations.c.annotation_id)
+    ))
+
+
+def compact_annotations(connection):
+    """ Réécrit les annotations enregistrées avant que le JSON ne soit stocké sous forme compacte.
+    Les annotations sont renvoyées telles quelles par l'API : elles ont ainsi toutes le même format.
+    Les annotations dont le JSON est invalide ne sont pas modifiées.
+
+    :param connection: connexion à la base de données
+    """
+
+    annotations = Annotation.__table__
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select([annotations.c.annotation_id, annotations.c.annotation_json])
+            .where(annotations.c.annotation_id > last_id)
+            .order_by(annotations.c.annotation_id)
+            .limit(MIGRATION_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            return
+
+        updates = []
+        for annotation_id, annotation_json in rows:
+            try:
+                compact = json.dumps(json.loads(annotation_json), separators=(",", ":"))
+            except (TypeError, ValueError):
+                continue
+            if compact != annotation_json:
+                updates.append({"id": annotation_id, "json": compact})
+
+        if updates:
+            connection.execute(
+                annotations.update()
+                .where(annotations.c.annotation_id == db.bindparam("id"))
+                .values(annotation_json=db.bindparam("json")),
+                updates
+            )
+        last_id = rows[-1][0]
+
+
+def add_annotation_bboxes(connection):
+    """ Ajoute les colonnes du rectangle des régions annotées, et le calcule pour les annotations existantes.
+    L'index spatial est ensuite rempli à partir de ces colonnes par init_region_index().
+
+    :param connection: connexion à la base de données
+    """
+
+    add_missing_columns(connection)
+    annotations = Annotation.__table__
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            select([annotations.c.annotation_id, annotations.c.annotation_json])
+            .where(annotations.c.annotation_id > last_id)
+            .order_by(annotations.c.annotation_id)
+            .limit(MIGRATION_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            return
+
+        updates = []
+        for annotation_id, annotation_json in rows:
+            bbox = annotation_bbox(annotation_json)
+            if bbox is not None:
+                values = bbox_columns(bbox)
+                values["id"] = annotation_id
+                updates.append(values)
+
+        if updates:
+            connection.execute(
+                annotations.update()
+                .where(annotations.c.annotation_id == db.bindparam("id"))
+                .values({name: db.bindparam(name) for name in bbox_columns(None)}),
+                updates
+            )
+        last_id = rows[-1][0]
+
+
+def add_counters(connection):
+    """ Ajoute les colonnes des statistiques des images et des collections, et les calcule à partir
+    des annotations existantes. La table image_annotator est créée par db.create_all().
+
+    :param connection: connexion à la base de données
+    """
+
+    add_missing_columns(connection)
+    create_missing_indexes(connection)
+    images = Image.__table__
+    collections = Collection.__table__
+    refresh_image_counters(connection, [image_id for image_id, in connection.execute(select([images.c.image_id]))])
+    refresh_collection_counters(
+        connection, [collection_id for collection_id, in connection.execute(select([collections.c.collection_id]))]
+    )
+
+
+# Liste des migrations, dans l'ordre : (version, description, fonction).
+# Une migration n'est appliquée qu'une fois : pour modifier le schéma, on ajoute une migration à la fin de la liste.
+MIGRATIONS = [
+    (1, "index des clés étrangères et des tables d'association", create_missing_indexes),
+    (2, "JSON compact pour les annotations existantes", compact_annotations),
+    (3, "version et date de modification des collections et des images", add_versions),
+    (4, "journal des modifications des annotations existantes", fill_annotation_changes),
+    (5, "index des URL des images", create_missing_indexes),
+    (6, "rectangle des régions des annotations existantes", add_annotation_bboxes),
+    (7, "statistiques des images et des collections", add_counters),
+    (8, "dimensions, format et service IIIF des images", add_missing_columns),
+]
+
+
+def current_version(connection):
+    """ Retourne la version du schéma de la base de données (0 si aucune migration n'a été appliquée).
+
+    :param connection: connexion à la base de données
+    :return: version
+    :rtype: int
+    """
+
+    version = connection.execute(select([schema_version.c.version])).scalar()
+    return version or 0
+
+
+def lock_schema(connection):
+    """ Verrouille les migrations jusqu'à la fin de la transaction en cours : plusieurs processus de l'application
+    démarrés en même temps ne peuvent pas appliquer la même migration.
+    SQLite : la transaction prend le verrou d'écriture dès son début (BEGIN IMMEDIATE) ; PostgreSQL : verrou
+    consultatif (advisory lock), libéré au commit.
+
+    :param connection: connexion à la base de données, dans une transaction
+    """
+
+    if connection.dialect.name == "sqlite":
+        connection.execute("BEGIN IMMEDIATE")
+    elif connection.dialect.name == "postgresql":
+        connection.execute(select([func.pg_advisory_xact_lock(MIGRATION_LOCK_ID)]))
+
+
+def upgrade(connection):
+    """ Applique à la base de données les migrations qui ne l'ont pas encore été.
+    Chaque migration est appliquée dans sa propre transaction, avec la mise à jour de la version.
+    La version est lue dans la même transaction, après la prise du verrou des migrations (voir lock_schema) :
+    une migration appliquée entre-temps par un autre processus n'est pas appliquée une deuxième fois.
+
+    :param connection: connexion à la base de données
+    :return: liste des migrations appliquées (version, description)
+    :rtype: list
+    """
+
+    applied = []
+    if current_version(connection) >= MIGRATIONS[-1][0]:
+        return applied
+
+    for migration_version, description, function in MIGRATIONS:
+        with connection.begin():
+            lock_schema(connection)
+            if migration_version <= current_version(connection):
+                continue
+            function(connection)
+            connection.execute(schema_version.delete())
+            connection.execute(schema_version.insert().values(version=migration_version))
+        applied.append((migration_version, description))
+
+    return applied
+
+
+def upgrade_database(app):
+    """ Met à jour le schéma de la base de données de l'application.
+
+    :param app: application Flask
+    :return: liste des migrations appliquées (version, description)
+    :rtype: list
+    """
+
+    with db.engine.connect() as connection:
+        applied = upgrade(connection)
+    for version, description in applied:
+        app.logger.info("Migration %s appliquée : %s", version, description)
+    return applied
@@ -0,0 +1,226 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+import datetime
+import threading
+import time
+
+from sqlalchemy import event
+
+from ..app import db
+
+# Cache des nombres totaux de résultats des listes paginées : {clé: (nombre, date de calcul)}.
+# Les entrées d'une table sont supprimées dès qu'une ligne y est ajoutée ou supprimée.
+# Les entrées sont rangées de la moins à la plus récemment utilisée.
+_counts = OrderedDict()
+
+# Nombre maximum d'entrées du cache (une par mot-clé de recherche) : au-delà, les moins récemment utilisées
+# sont supprimées.
+COUNTS_MAX_SIZE = 1000
+_counts_lock = threading.Lock()
+
+# Origine des dates des curseurs : une date est encodée par son nombre de secondes depuis cette date.
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode_cursor(direction, key, rank=None):
+    """ Encode un curseur de pagination opaque.
+
+    :param direction: "n" pour les résultats situés après key, "p" pour ceux situés avant
+    :type direction: str
+    :param key: valeur de la clé du dernier (ou du premier) résultat de la page courante
+    :type key: int
+    :param rank: score du résultat, si les résultats sont triés par score (recherche) ou par une autre valeur
+    (nombre, date)
+    :type rank: float
+    :return: curseur
+    :rtype: str
+    """
+
+    text = "{0}:{1}".format(direction, key)
+    if isinstance(rank, datetime.datetime):
+        text += ":t" + repr((rank - _EPOCH) / datetime.timedelta(seconds=1))
+    elif rank is not None:
+        # repr() conserve toutes les décimales du score : la comparaison avec la base reste exacte.
+        text += ":" + repr(float(rank))
+    return urlsafe_b64encode(text.encode("ascii")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """ Décode un curseur de pagination. Lève une ValueError si le curseur est invalide.
+
+    :param cursor: curseur créé avec encode_cursor()
+    :type cursor: str
+    :return: tuple (direction, clé, score ou None)
+    :rtype: tuple
+    """
+
+    try:
+        text = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        parts = text.split(":")
+        direction, key = parts[0], int(parts[1])
+        rank = None
+        if len(parts) == 3 and parts[2].startswith("t"):
+            rank = _EPOCH + datetime.timedelta(seconds=float(parts[2][1:]))
+        elif len(parts) == 3:
+            rank = float(parts[2])
+    except (TypeError, ValueError, IndexError, UnicodeError, OverflowError):
+        raise ValueError("curseur invalide")
+    if direction not in ("n", "p") or len(parts) > 3:
+        raise ValueError("curseur invalide")
+    return direction, key, rank
+
+
+class KeysetPage:
+    """ Page de résultats paginée par clé (keyset pagination).
+    Contrairement à paginate(), la page est lue à partir de la clé du dernier résultat de la page précédente :
+    la requête coûte le même prix quelle que soit la position de la page, et aucun COUNT(*) n'est exécuté.
+    """
+
+    def __init__(self, rows, has_next, has_prev, key_name, ranked=False):
+        # Si les résultats sont triés par score, chaque ligne est un tuple (objet, score).
+        self.items = [row[0] for row in rows] if ranked else rows
+        self.has_next = has_next
+        self.has_prev = has_prev
+        self.next_cursor = self._cursor("n", rows[-1], key_name, ranked) if has_next and rows else None
+        self.prev_cursor = self._cursor("p", rows[0], key_name, ranked) if has_prev and rows else None
+        # Nombre total de résultats, renseigné avec cached_count() si la page l'affiche.
+        self.total = None
+
+    @staticmethod
+    def _cursor(direction, row, key_name, ranked):
+        if ranked:
+            return encode_cursor(direction, getattr(row[0], key_name), row[1])
+        return encode_cursor(direction, getattr(row, key_name))
+
+
+def keyset_paginate(query, column, cursor=None, per_page=5, fallback=False, rank=None, rank_descending=False):
+    """ Pagine une requête selon une colonne unique et croissante (clé primaire).
+    Si rank est donné (score d'une recherche, les meilleurs résultats ayant le score le plus bas, ou statistique),
+    les résultats sont triés par score, puis par clé, et le curseur contient le score du dernier résultat.
+    Une ValueError est levée si le curseur est invalide, sauf avec fallback=True : la première page est alors renvoyée.
+
+    :param query: requête à paginer
+    :type query: BaseQuery
+    :param column: colonne servant de clé (collection_id, user_id)
+    :type column: Column
+    :param cursor: curseur de la page demandée (None pour la première page)
+    :type cursor: str
+    :param per_page: nombre de résultats par page
+    :type per_page: int
+    :param fallback: True pour renvoyer la première page si le curseur est invalide
+    :type fallback: bool
+    :param rank: expression SQL du score des résultats (nombre ou date, jamais nul)
+    :param rank_descending: True pour trier les résultats par score décroissant (puis par clé croissante)
+    :type rank_descending: bool
+    :return: page de résultats
+    :rtype: KeysetPage
+    """
+
+    ranked = rank is not None
+    if ranked:
+        query = query.add_columns(rank)
+        if rank_descending:
+            ascending = (rank.desc(), column.asc())
+            descending = (rank.asc(), column.desc())
+        else:
+            ascending = (rank.asc(), column.asc())
+            descending = (rank.desc(), column.desc())
+    else:
+        ascending = (column.asc(),)
+        descending = (column.desc(),)
+
+    direction = None
+    if cursor:
+        try:
+            direction, key, key_rank = decode_cursor(cursor)
+            if ranked and key_rank is None:
+                raise ValueError("curseur invalide")
+        except ValueError:
+            if not fallback:
+                raise
+            direction = None
+
+    if direction is None:
+        rows = query.order_by(*ascending).limit(per_page + 1).all()
+        return KeysetPage(rows[:per_page], len(rows) > per_page, False, column.key, ranked)
+
+    if direction == "n":
+        if ranked:
+            after = rank < key_rank if rank_descending else rank > key_rank
+            condition = after | ((rank == key_rank) & (column > key))
+        else:
+            condition = column > key
+        rows = query.filter(condition).order_by(*ascending).limit(per_page + 1).all()
+        return KeysetPage(rows[:per_page], len(rows) > per_page, True, column.key, ranked)
+
+    # Pour la page précédente, on lit les résultats dans l'ordre inverse, puis on les remet dans l'ordre.
+    if ranked:
+        before = rank > key_rank if rank_descending else rank < key_rank
+        condition = before | ((rank == key_rank) & (column < key))
+    else:
+        condition = column < key
+    rows = query.filter(condition).order_by(*descending).limit(per_page + 1).all()
+    has_prev = len(rows) > per_page
+    rows = rows[:per_page]
+    rows.reverse()
+    return KeysetPage(rows, True, has_prev, column.key, ranked)
+
+
+def cached_count(query, table, key=None, ttl=60):
+    """ Retourne le nombre de résultats d'une requête, en le gardant en cache pendant ttl secondes.
+    Le cache d'une table est vidé quand une ligne y est ajoutée ou supprimée ; il reste approximatif pour
+    les requêtes filtrées sur des valeurs modifiées. Les entrées expirées sont supprimées à chaque écriture,
+    et le cache garde au plus COUNTS_MAX_SIZE entrées.
+
+    :param query: requête dont on compte les résultats
+    :type query: BaseQuery
+    :param table: nom de la table interrogée
+    :type table: str
+    :param key: complément de la clé du cache (par exemple le mot-clé d'une recherche)
+    :type key: str
+    :param ttl: durée de validité (en secondes) du nombre calculé
+    :type ttl: int
+    :return: nombre de résultats
+    :rtype: int
+    """
+
+    cache_key = (table, key)
+    now = time.time()
+    with _counts_lock:
+        entry = _counts.get(cache_key)
+        if entry is not None and now - entry[1] < ttl:
+            _counts.move_to_end(cache_key)
+            return entry[0]
+
+    total = query.order_by(None).count()
+    with _counts_lock:
+        for expired in [expired for expired, (_, computed) in _counts.items() if now - computed >= ttl]:
+            del _counts[expired]
+        _counts[cache_key] = (total, now)
+        while len(_counts) > COUNTS_MAX_SIZE:
+            _counts.popitem(last=False)
+    return total
+
+
+@event.listens_for(db.session, "after_flush")
+def _invalidate_counts(session, flush_context):
+    """ Vide le cache des nombres de résultats des tables dont des lignes ont été ajoutées ou supprimées. """
+
+    invalidate_counts({
+        getattr(instance, "__tablename__", None)
+        for instance in list(session.new) + list(session.deleted)
+    })
+
+
+def invalidate_counts(tables):
+    """ Vide le cache des nombres de résultats pour une liste de tables.
+
+    :param tables: noms des tables
+    :type tables: set
+    """
+
+    if not tables:
+        return
+    with _counts_lock:
+        for cache_key in [cache_key for cache_key in _counts if cache_key[0] in tables]:
+            del _counts[cache_key]
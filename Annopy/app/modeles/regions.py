@@ -0,0 +1,392 @@
+import json
+import re
+from xml.etree import ElementTree
+
+from sqlalchemy import event, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import column
+
+from ..app import db
+from .data import Annotation, CollectionHasImages
+
+# Index spatial des régions annotées (SQLite R*Tree).
+# Chaque ligne de l'index a pour id l'ID d'une annotation, et pour dimensions l'ID de son image et le rectangle
+# englobant sa région (colonnes annotation_min_x, etc. de la table annotation) : une recherche sur une image
+# ne parcourt que les régions de cette image. L'index est tenu à jour par des triggers sur la table annotation :
+# les insertions en masse (import d'annotations) y sont donc aussi enregistrées.
+REGION_TABLE = "annotation_region"
+
+# Triggers qui recopient dans l'index les rectangles des annotations ajoutées, modifiées ou supprimées.
+# Une région occupe l'intervalle [ID, ID + 0.5] de la dimension de l'image : si tous les intervalles étaient de
+# longueur nulle, le volume des nœuds de l'index serait toujours nul, et l'index ne saurait plus les répartir
+# (une recherche sur une image de 200 000 régions lit alors une grande partie de l'index).
+_REGION_VALUES = (
+    "new.annotation_id, new.annotation_image_id, new.annotation_image_id + 0.5, "
+    "new.annotation_min_x, new.annotation_max_x, new.annotation_min_y, new.annotation_max_y"
+)
+_REGION_CONDITION = "new.annotation_image_id IS NOT NULL AND new.annotation_min_x IS NOT NULL"
+_REGION_TRIGGERS = (
+    "CREATE TRIGGER IF NOT EXISTS {0}_insert AFTER INSERT ON annotation WHEN {2} BEGIN "
+    "INSERT INTO {0} VALUES ({1}); END",
+    "CREATE TRIGGER IF NOT EXISTS {0}_update AFTER UPDATE OF annotation_image_id, annotation_min_x, "
+    "annotation_min_y, annotation_max_x, annotation_max_y ON annotation BEGIN "
+    "DELETE FROM {0} WHERE id = old.annotation_id; "
+    "INSERT INTO {0} SELECT {1} WHERE {2}; END",
+    "CREATE TRIGGER IF NOT EXISTS {0}_delete AFTER DELETE ON annotation BEGIN "
+    "DELETE FROM {0} WHERE id = old.annotation_id; END",
+)
+
+# L'index n'est utilisé que si la base de données est SQLite et que le module R*Tree est disponible.
+# Sinon, les régions sont recherchées sur les colonnes de la table annotation, image par image.
+_enabled = False
+
+# Sélecteur de fragment de média : xywh=[pixel:]x,y,w,h. Les coordonnées en pourcentage (percent:) ne sont pas
+# retenues : la taille de l'image n'est pas connue.
+_FRAGMENT = re.compile(r"xywh=(?:pixel:)?\s*([-+\d.eE]+),([-+\d.eE]+),([-+\d.eE]+),([-+\d.eE]+)")
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+_PATH_TOKEN = re.compile(r"[MmLlHhVvCcSsQqTtAaZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?")
+# Nombre de valeurs lues par chaque commande d'un chemin SVG.
+_PATH_ARGUMENTS = {"M": 2, "L": 2, "H": 1, "V": 1, "C": 6, "S": 4, "Q": 4, "T": 2, "A": 7, "Z": 0}
+
+
+def init_region_index():
+    """ Crée l'index spatial des régions et ses triggers s'ils n'existent pas, et le remplit à partir des annotations
+    existantes. Doit être appelée dans le contexte de l'application, après les migrations.
+
+    :return: True si l'index est utilisé
+    :rtype: bool
+    """
+
+    global _enabled
+    _enabled = False
+
+    if db.engine.dialect.name != "sqlite":
+        return False
+
+    exists = db.session.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = :name", {"name": REGION_TABLE}
+    ).scalar()
+
+    if not exists:
+        try:
+            db.session.execute(
+                "CREATE VIRTUAL TABLE {0} USING rtree(id, min_image, max_image, min_x, max_x, min_y, max_y)".format(
+                    REGION_TABLE
+                )
+            )
+        except OperationalError:
+            # SQLite a été compilé sans le module R*Tree.
+            db.session.rollback()
+            return False
+        for trigger in _REGION_TRIGGERS:
+            db.session.execute(trigger.format(REGION_TABLE, _REGION_VALUES, _REGION_CONDITION))
+        db.session.execute(
+            "INSERT INTO {0} SELECT {1} FROM annotation WHERE {2}".format(
+                REGION_TABLE,
+                _REGION_VALUES.replace("new.", ""),
+                _REGION_CONDITION.replace("new.", "")
+            )
+        )
+        db.session.commit()
+
+    _enabled = True
+    return True
+
+
+def region_index_enabled():
+    """ Indique si l'index spatial des régions est utilisé.
+
+    :rtype: bool
+    """
+
+    return _enabled
+
+
+def _bounds(points):
+    """ Retourne le rectangle (min_x, min_y, max_x, max_y) d'une liste de points (x, y), ou None si elle est vide. """
+
+    if not points:
+        return None
+    xs = [x for x, _ in points]
+    ys = [y for _, y in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _union(boxes):
+    """ Retourne le rectangle qui englobe une liste de rectangles (les None sont ignorés). """
+
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+    return (
+        min(box[0] for box in boxes), min(box[1] for box in boxes),
+        max(box[2] for box in boxes), max(box[3] for box in boxes)
+    )
+
+
+def fragment_bbox(value):
+    """ Calcule le rectangle d'un sélecteur de fragment de média (xywh=pixel:x,y,w,h).
+
+    :param value: valeur du FragmentSelector, ou fragment d'une URL
+    :type value: str
+    :return: tuple (min_x, min_y, max_x, max_y), ou None si le fragment n'est pas lisible
+    :rtype: tuple
+    """
+
+    match = _FRAGMENT.search(value)
+    if match is None:
+        return None
+    try:
+        x, y, width, height = (float(number) for number in match.groups())
+    except ValueError:
+        return None
+    if width < 0 or height < 0:
+        return None
+    return x, y, x + width, y + height
+
+
+def _path_points(d):
+    """ Retourne les points d'un chemin SVG (attribut d), points de contrôle des courbes compris :
+    une courbe de Bézier est contenue dans le polygone de ses points de contrôle.
+    """
+
+    tokens = _PATH_TOKEN.findall(d)
+    points = []
+    x = y = start_x = start_y = 0.0
+    command = None
+    index = 0
+    while index < len(tokens):
+        if tokens[index].isalpha():
+            command = tokens[index]
+            index += 1
+            if command in "Zz":
+                x, y = start_x, start_y
+                points.append((x, y))
+                continue
+        if command is None:
+            return points
+        count = _PATH_ARGUMENTS[command.upper()]
+        values = [float(token) for token in tokens[index:index + count]]
+        if len(values) < count:
+            return points
+        index += count
+
+        relative = command.islower()
+        upper = command.upper()
+        if upper == "H":
+            x = values[0] + (x if relative else 0)
+            points.append((x, y))
+        elif upper == "V":
+            y = values[0] + (y if relative else 0)
+            points.append((x, y))
+        elif upper == "A":
+            end_x = values[5] + (x if relative else 0)
+            end_y = values[6] + (y if relative else 0)
+            # L'arc reste à moins de deux rayons de son point de départ (le rayon est agrandi par SVG
+            # jusqu'à la moitié de la corde si nécessaire).
+            radius = max(abs(values[0]), abs(values[1]), ((end_x - x) ** 2 + (end_y - y) ** 2) ** 0.5 / 2)
+            points.extend([(x - 2 * radius, y - 2 * radius), (x + 2 * radius, y + 2 * radius)])
+            x, y = end_x, end_y
+            points.append((x, y))
+        else:
+            base_x, base_y = (x, y) if relative else (0.0, 0.0)
+            pairs = [(values[i] + base_x, values[i + 1] + base_y) for i in range(0, count, 2)]
+            points.extend(pairs)
+            x, y = pairs[-1]
+        if upper == "M":
+            start_x, start_y = x, y
+            # Les coordonnées qui suivent un "moveto" sont des "lineto".
+            command = "l" if relative else "L"
+    return points
+
+
+def svg_bbox(value):
+    """ Calcule le rectangle d'un sélecteur SVG (rect, circle, ellipse, line, polygon, polyline, path).
+    Les transformations SVG ne sont pas prises en compte.
+
+    :param value: valeur du SvgSelector, document SVG
+    :type value: str
+    :return: tuple (min_x, min_y, max_x, max_y), ou None si aucune forme n'est lisible
+    :rtype: tuple
+    """
+
+    try:
+        root = ElementTree.fromstring(value)
+    except ElementTree.ParseError:
+        return None
+
+    def number(element, name):
+        return float(element.get(name, 0))
+
+    boxes = []
+    for element in root.iter():
+        tag = element.tag.rsplit("}", 1)[-1]
+        try:
+            if tag == "rect":
+                x, y = number(element, "x"), number(element, "y")
+                boxes.append((x, y, x + number(element, "width"), y + number(element, "height")))
+            elif tag in ("circle", "ellipse"):
+                cx, cy = number(element, "cx"), number(element, "cy")
+                rx = number(element, "r") if tag == "circle" else number(element, "rx")
+                ry = number(element, "r") if tag == "circle" else number(element, "ry")
+                boxes.append((cx - rx, cy - ry, cx + rx, cy + ry))
+            elif tag == "line":
+                boxes.append(_bounds([
+                    (number(element, "x1"), number(element, "y1")), (number(element, "x2"), number(element, "y2"))
+                ]))
+            elif tag in ("polygon", "polyline"):
+                values = [float(item) for item in _NUMBER.findall(element.get("points", ""))]
+                boxes.append(_bounds(list(zip(values[0::2], values[1::2]))))
+            elif tag == "path":
+                boxes.append(_bounds(_path_points(element.get("d", ""))))
+        except ValueError:
+            continue
+    return _union(boxes)
+
+
+def selector_bbox(annotation):
+    """ Calcule le rectangle englobant les régions ciblées par une annotation W3C Web Annotation.
+    Les sélecteurs FragmentSelector et SvgSelector des cibles sont lus, ainsi que le fragment xywh= d'une cible
+    donnée sous forme d'URL. Si l'annotation a plusieurs sélecteurs, leur union est retenue.
+
+    :param annotation: annotation
+    :type annotation: dict
+    :return: tuple (min_x, min_y, max_x, max_y), ou None si aucun sélecteur n'est lisible
+    :rtype: tuple
+    """
+
+    if not isinstance(annotation, dict):
+        return None
+    targets = annotation.get("target")
+    targets = targets if isinstance(targets, list) else [targets]
+
+    boxes = []
+    for target in targets:
+        if isinstance(target, str):
+            if "#" in target:
+                boxes.append(fragment_bbox(target.split("#", 1)[1]))
+            continue
+        if not isinstance(target, dict):
+            continue
+        selectors = target.get("selector")
+        selectors = selectors if isinstance(selectors, list) else [selectors]
+        for selector in selectors:
+            if not isinstance(selector, dict) or not isinstance(selector.get("value"), str):
+                continue
+            if selector.get("type") == "FragmentSelector":
+                boxes.append(fragment_bbox(selector["value"]))
+            elif selector.get("type") == "SvgSelector":
+                boxes.append(svg_bbox(selector["value"]))
+    return _union(boxes)
+
+
+def annotation_bbox(annotation_json):
+    """ Calcule le rectangle englobant les régions ciblées par une annotation enregistrée en base.
+
+    :param annotation_json: annotation, telle qu'enregistrée en base
+    :type annotation_json: str
+    :return: tuple (min_x, min_y, max_x, max_y), ou None
+    :rtype: tuple
+    """
+
+    try:
+        return selector_bbox(json.loads(annotation_json))
+    except (TypeError, ValueError):
+        return None
+
+
+def bbox_columns(bbox):
+    """ Retourne les valeurs des colonnes du rectangle d'une annotation.
+
+    :param bbox: tuple (min_x, min_y, max_x, max_y), ou None
+    :type bbox: tuple
+    :return: dictionnaire {nom de la colonne: valeur}
+    :rtype: dict
+    """
+
+    bbox = bbox if bbox is not None else (None, None, None, None)
+    return dict(zip(("annotation_min_x", "annotation_min_y", "annotation_max_x", "annotation_max_y"), bbox))
+
+
+@event.listens_for(Annotation.annotation_json, "set")
+def _set_annotation_bbox(annotation, value, oldvalue, initiator):
+    """ Met à jour le rectangle de l'annotation à chaque modification de son JSON. """
+
+    for name, bound in bbox_columns(annotation_bbox(value)).items():
+        setattr(annotation, name, bound)
+
+
+def find_regions(bbox, image_id=None, collection_id=None, after=0, limit=100):
+    """ Recherche les annotations dont la région croise un rectangle, sur une image ou sur les images
+    d'une collection, par ID croissant. Un point est un rectangle de largeur et de hauteur nulles.
+    Les annotations sont chargées avec leurs authorships.
+
+    :param bbox: rectangle recherché (min_x, min_y, max_x, max_y), en pixels
+    :type bbox: tuple
+    :param image_id: ID de l'image
+    :type image_id: int
+    :param collection_id: ID de la collection (si image_id n'est pas renseigné)
+    :type collection_id: int
+    :param after: ID de la dernière annotation de la page précédente
+    :type after: int
+    :param limit: nombre maximum d'annotations renvoyées
+    :type limit: int
+    :return: tuple (annotations, True s'il reste des annotations)
+    :rtype: tuple
+    """
+
+    min_x, min_y, max_x, max_y = bbox
+    query = Annotation.query.filter(
+        Annotation.annotation_id > after,
+        Annotation.annotation_min_x <= max_x, Annotation.annotation_max_x >= min_x,
+        Annotation.annotation_min_y <= max_y, Annotation.annotation_max_y >= min_y
+    )
+    image_ids = None
+    if collection_id is not None and image_id is None:
+        links = CollectionHasImages.__table__
+        image_ids = select([links.c.collection_has_images_image_id]).where(
+            links.c.collection_has_images_collection_id == collection_id
+        )
+
+    if not _enabled:
+        if image_ids is not None:
+            return _page(query.filter(Annotation.annotation_image_id.in_(image_ids)), limit)
+        return _page(query.filter(Annotation.annotation_image_id == image_id), limit)
+
+    # Les régions candidates sont lues dans l'index, image par image : CROSS JOIN impose à SQLite de parcourir
+    # les images de la collection puis, pour chacune, l'index spatial.
+    parameters = {"min_x": min_x, "min_y": min_y, "max_x": max_x, "max_y": max_y, "after": after}
+    if image_ids is not None:
+        candidates = (
+            "SELECT r.id FROM collection_has_images AS l CROSS JOIN {0} AS r "
+            "WHERE l.collection_has_images_collection_id = :collection_id "
+            "AND r.min_image <= l.collection_has_images_image_id AND r.max_image >= l.collection_has_images_image_id"
+        )
+        parameters["collection_id"] = collection_id
+    else:
+        candidates = "SELECT r.id FROM {0} AS r WHERE r.min_image <= :image_id AND r.max_image >= :image_id"
+        parameters["image_id"] = image_id
+    candidates = text(
+        candidates.format(REGION_TABLE) + " AND r.min_x <= :max_x AND r.max_x >= :min_x "
+        "AND r.min_y <= :max_y AND r.max_y >= :min_y AND r.id > :after"
+    ).bindparams(**parameters).columns(column("id"))
+
+    # Les coordonnées de l'index sont arrondies vers l'extérieur (réels sur 32 bits) : l'image et le rectangle sont
+    # vérifiés sur la table annotation. "+ 0" empêche SQLite de lire les annotations par l'index de leur image
+    # plutôt que par leur ID.
+    query = query.filter(Annotation.annotation_id.in_(candidates))
+    if image_ids is not None:
+        return _page(query.filter((Annotation.annotation_image_id + 0).in_(image_ids)), limit)
+    return _page(query.filter(Annotation.annotation_image_id + 0 == image_id), limit)
+
+
+def _page(query, limit):
+    """ Retourne les limit premières annotations d'une requête par ID croissant, chargées avec leurs authorships,
+    et True s'il en reste.
+    """
+
+    # On lit une annotation de plus que demandé pour savoir s'il en reste.
+    annotations = query.order_by(Annotation.annotation_id).limit(limit + 1).all()
+    has_more = len(annotations) > limit
+    return Annotation.preload_for_api(annotations[:limit]), has_more
+
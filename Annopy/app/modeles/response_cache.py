@@ -0,0 +1,251 @@
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResponseCache:
+    """ Cache des réponses JSON de l'API (données d'une collection, d'une image), déjà sérialisées.
+    Les réponses sont gardées en mémoire, dans un cache LRU dont la taille totale est limitée à max_size octets.
+    Si path est renseigné, elles sont aussi stockées dans une base SQLite partagée par tous les processus
+    de l'application, limitée à disk_max_size octets : une réponse absente de la mémoire y est cherchée
+    avant d'être sérialisée.
+    Chaque réponse est identifiée par le type et l'ID de l'objet et par l'ETag de la réponse, qui contient la version
+    de l'objet : une réponse en cache ne peut donc pas être renvoyée après une modification de l'objet.
+    Les réponses des objets modifiés sont en plus supprimées après chaque commit (voir modeles/versions.py).
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024, max_entry_size=16 * 1024 * 1024, path=None,
+                 disk_max_size=512 * 1024 * 1024):
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.path = path
+        self.disk_max_size = disk_max_size
+        self._lock = Lock()
+        # (type, ID, ETag) -> contenu de la réponse, du moins récemment utilisé au plus récemment utilisé.
+        self._entries = OrderedDict()
+        # (type, ID) -> clés des réponses de l'objet en mémoire.
+        self._keys = {}
+        self._size = 0
+        self._metrics = dict.fromkeys(
+            ("memory_hits", "disk_hits", "misses", "stores", "evictions", "invalidations"), 0
+        )
+        if path:
+            self._create_table()
+
+    def init_app(self, app):
+        """ Configure le cache à partir de la configuration de l'application.
+        Un chemin relatif est résolu depuis la racine de l'application, comme pour la base de données.
+
+        :param app: application Flask
+        """
+
+        path = app.config.get("API_CACHE_PATH")
+        if path and not os.path.isabs(path):
+            path = os.path.join(app.root_path, path)
+        self.__init__(
+            max_size=app.config.get("API_CACHE_MAX_SIZE", self.max_size),
+            max_entry_size=app.config.get("API_CACHE_MAX_ENTRY_SIZE", self.max_entry_size),
+            path=path,
+            disk_max_size=app.config.get("API_CACHE_DISK_MAX_SIZE", self.disk_max_size)
+        )
+
+    def _connect(self):
+        # Une connexion par appel : les connexions SQLite ne se partagent pas entre threads.
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        return connection
+
+    def _create_table(self):
+        with self._connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS api_response ("
+                "kind TEXT NOT NULL, object_id INTEGER NOT NULL, etag TEXT NOT NULL, body BLOB NOT NULL, "
+                "size INTEGER NOT NULL, accessed_at REAL NOT NULL, PRIMARY KEY (kind, object_id, etag))"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_api_response_accessed_at ON api_response (accessed_at)"
+            )
+        connection.close()
+
+    def get(self, kind, object_id, etag):
+        """ Récupère une réponse en cache.
+
+        :param kind: type de l'objet ("collection", "image")
+        :type kind: str
+        :param object_id: ID de l'objet
+        :type object_id: int
+        :param etag: ETag de la réponse
+        :type etag: str
+        :return: contenu de la réponse, ou None si elle n'est pas en cache
+        :rtype: bytes
+        """
+
+        key = (kind, object_id, etag)
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self._metrics["memory_hits"] += 1
+                return body
+
+        body = self._disk_get(key) if self.path else None
+
+        with self._lock:
+            if body is None:
+                self._metrics["misses"] += 1
+                return None
+            self._metrics["disk_hits"] += 1
+            self._memory_set(key, body)
+        return body
+
+    def set(self, kind, object_id, etag, body):
+        """ Met une réponse en cache. Les réponses plus grandes que max_entry_size ne sont pas gardées.
+
+        :param kind: type de l'objet ("collection", "image")
+        :type kind: str
+        :param object_id: ID de l'objet
+        :type object_id: int
+        :param etag: ETag de la réponse
+        :type etag: str
+        :param body: contenu de la réponse
+        :type body: bytes
+        """
+
+        if len(body) > self.max_entry_size:
+            return
+        key = (kind, object_id, etag)
+        with self._lock:
+            self._metrics["stores"] += 1
+            self._memory_set(key, body)
+        if self.path:
+            self._disk_set(key, body)
+
+    def invalidate(self, kind, object_ids):
+        """ Supprime du cache toutes les réponses d'une liste d'objets.
+
+        :param kind: type des objets ("collection", "image")
+        :type kind: str
+        :param object_ids: ID des objets
+        :type object_ids: iterable
+        """
+
+        object_ids = list(object_ids)
+        if not object_ids:
+            return
+
+        with self._lock:
+            for object_id in object_ids:
+                for key in self._keys.pop((kind, object_id), ()):
+                    self._size -= len(self._entries.pop(key))
+                    self._metrics["invalidations"] += 1
+
+        if self.path:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.executemany(
+                        "DELETE FROM api_response WHERE kind = ? AND object_id = ?",
+                        ((kind, object_id) for object_id in object_ids)
+                    )
+            finally:
+                connection.close()
+
+    def clear(self):
+        """ Vide le cache (mémoire et disque). """
+
+        with self._lock:
+            self._entries.clear()
+            self._keys.clear()
+            self._size = 0
+        if self.path:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("DELETE FROM api_response")
+            finally:
+                connection.close()
+
+    def metrics(self):
+        """ Retourne les statistiques du cache du processus courant : nombre de réponses trouvées en mémoire,
+        sur le disque, non trouvées, mises en cache, supprimées pour libérer de la place ou invalidées,
+        ainsi que le nombre et la taille des réponses en mémoire.
+
+        :rtype: dict
+        """
+
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["entries"] = len(self._entries)
+            metrics["size"] = self._size
+        metrics["max_size"] = self.max_size
+        lookups = metrics["memory_hits"] + metrics["disk_hits"] + metrics["misses"]
+        metrics["hit_ratio"] = round((lookups - metrics["misses"]) / lookups, 4) if lookups else None
+        return metrics
+
+    def _memory_set(self, key, body):
+        """ Ajoute une réponse au cache en mémoire, puis supprime les réponses les moins récemment utilisées
+        si la taille maximale est dépassée. Doit être appelée avec le verrou.
+        """
+
+        if len(body) > self.max_size:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._size -= len(previous)
+        self._entries[key] = body
+        self._keys.setdefault(key[:2], set()).add(key)
+        self._size += len(body)
+
+        while self._size > self.max_size:
+            old_key, old_body = self._entries.popitem(last=False)
+            self._size -= len(old_body)
+            keys = self._keys[old_key[:2]]
+            keys.discard(old_key)
+            if not keys:
+                del self._keys[old_key[:2]]
+            self._metrics["evictions"] += 1
+
+    def _disk_get(self, key):
+        connection = self._connect()
+        try:
+            row = connection.execute(
+                "SELECT body FROM api_response WHERE kind = ? AND object_id = ? AND etag = ?", key
+            ).fetchone()
+            if row is None:
+                return None
+            with connection:
+                connection.execute(
+                    "UPDATE api_response SET accessed_at = ? WHERE kind = ? AND object_id = ? AND etag = ?",
+                    (time.time(),) + key
+                )
+            return bytes(row[0])
+        finally:
+            connection.close()
+
+    def _disk_set(self, key, body):
+        """ Enregistre une réponse sur le disque puis supprime les réponses les moins récemment utilisées
+        si la taille maximale du cache sur le disque est dépassée.
+        """
+
+        connection = self._connect()
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO api_response (kind, object_id, etag, body, size, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    key + (body, len(body), time.time())
+                )
+                total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM api_response").fetchone()[0]
+                if total > self.disk_max_size:
+                    excess = total - self.disk_max_size
+                    freed = 0
+                    for rowid, size in connection.execute(
+                            "SELECT rowid, size FROM api_response ORDER BY accessed_at").fetchall():
+                        if freed >= excess:
+                            break
+                        connection.execute("DELETE FROM api_response WHERE rowid = ?", (rowid,))
+                        freed += size
+        finally:
+            connection.close()
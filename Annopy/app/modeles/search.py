@@ -0,0 +1,334 @@
+import json
+import re
+
+from sqlalchemy import and_, event, func, inspect, literal_column, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import column, table
+
+from ..app import db
+from .data import Annotation, Collection, CollectionHasImages
+from .pagination import invalidate_counts
+
+# Index de recherche plein texte des collections (SQLite FTS5), en deux tables :
+# - collection_search : une ligne par collection (rowid : ID de la collection), avec son nom et sa description ;
+# - annotation_search : une ligne par annotation (rowid : ID de l'annotation), avec son texte et l'ID de son image.
+# Une modification d'annotation ne met à jour que la ligne de l'annotation : le coût ne dépend pas de la taille
+# des collections. Les annotations sont rattachées aux collections au moment de la recherche.
+SEARCH_TABLE = "collection_search"
+search_table = table(SEARCH_TABLE, column("rowid"), column("rank"), column(SEARCH_TABLE))
+ANNOTATION_SEARCH_TABLE = "annotation_search"
+annotation_search_table = table(
+    ANNOTATION_SEARCH_TABLE, column("rowid"), column("rank"), column("annotation_image_id"),
+    column(ANNOTATION_SEARCH_TABLE)
+)
+
+# Poids des colonnes de l'index des collections pour le calcul du score (nom, description),
+# et poids du meilleur score des annotations d'une collection : une annotation compte dix fois moins que le nom.
+SEARCH_WEIGHTS = (10.0, 5.0)
+ANNOTATION_SEARCH_WEIGHT = 0.1
+
+# Nombre d'annotations lues par lot lors de la reconstruction de l'index.
+SEARCH_INDEX_BATCH_SIZE = 5000
+
+# L'index n'est utilisé que si la base de données est SQLite et que FTS5 est disponible.
+# Sinon, la recherche se fait avec LIKE sur le nom et la description des collections.
+_enabled = False
+
+
+def init_search_index():
+    """ Crée l'index de recherche s'il n'existe pas, et le remplit à partir des collections existantes.
+    Doit être appelée dans le contexte de l'application.
+
+    :return: True si l'index est utilisé
+    :rtype: bool
+    """
+
+    global _enabled
+    _enabled = False
+
+    if db.engine.dialect.name != "sqlite":
+        return False
+
+    exists = db.session.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = :name", {"name": ANNOTATION_SEARCH_TABLE}
+    ).scalar()
+
+    if not exists:
+        try:
+            # remove_diacritics permet de trouver "édition" en cherchant "edition".
+            db.session.execute(
+                "CREATE VIRTUAL TABLE {0} USING fts5("
+                "collection_name, collection_description, "
+                "tokenize = 'unicode61 remove_diacritics 2')".format(SEARCH_TABLE)
+            )
+            db.session.execute(
+                "CREATE VIRTUAL TABLE {0} USING fts5("
+                "annotation_text, annotation_image_id UNINDEXED, "
+                "tokenize = 'unicode61 remove_diacritics 2')".format(ANNOTATION_SEARCH_TABLE)
+            )
+        except OperationalError:
+            # SQLite a été compilé sans FTS5.
+            db.session.rollback()
+            return False
+        # La colonne rank de l'index des collections est calculée avec les poids des colonnes.
+        db.session.execute(
+            "INSERT INTO {0} ({0}, rank) VALUES ('rank', :rank)".format(SEARCH_TABLE),
+            {"rank": "bm25({0})".format(", ".join(str(weight) for weight in SEARCH_WEIGHTS))}
+        )
+        reindex_collections(db.session.connection(), None)
+        reindex_annotations(db.session.connection(), None)
+        db.session.commit()
+
+    _enabled = True
+    return True
+
+
+def search_enabled():
+    """ Indique si l'index de recherche plein texte est utilisé.
+
+    :rtype: bool
+    """
+
+    return _enabled
+
+
+def annotation_text(annotation_json):
+    """ Extrait le texte d'une annotation au format W3C Web Annotation (commentaires, tags).
+
+    :param annotation_json: annotation, telle qu'enregistrée en base
+    :type annotation_json: str
+    :return: texte de l'annotation
+    :rtype: str
+    """
+
+    try:
+        annotation = json.loads(annotation_json)
+    except (TypeError, ValueError):
+        return ""
+
+    bodies = annotation.get("body", []) if isinstance(annotation, dict) else []
+    if isinstance(bodies, dict):
+        bodies = [bodies]
+
+    values = []
+    for body in bodies:
+        if isinstance(body, dict) and body.get("type", "TextualBody") == "TextualBody":
+            value = body.get("value")
+            if isinstance(value, str):
+                values.append(value)
+    return " ".join(values)
+
+
+def reindex_collections(connection, collection_ids):
+    """ Met à jour l'index de recherche pour une liste de collections (nom et description).
+    Les lignes des collections supprimées sont retirées de l'index.
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param collection_ids: ID des collections à réindexer, ou None pour reconstruire tout l'index des collections
+    :type collection_ids: set
+    """
+
+    collections = Collection.__table__
+    rows_query = select([
+        collections.c.collection_id, collections.c.collection_name, collections.c.collection_description
+    ])
+
+    if collection_ids is None:
+        connection.execute("DELETE FROM {0}".format(SEARCH_TABLE))
+    else:
+        collection_ids = list(collection_ids)
+        if not collection_ids:
+            return
+        connection.execute(
+            search_table.delete().where(search_table.c.rowid.in_(collection_ids))
+        )
+        rows_query = rows_query.where(collections.c.collection_id.in_(collection_ids))
+
+    values = [
+        {"rowid": collection_id, "collection_name": name, "collection_description": description}
+        for collection_id, name, description in connection.execute(rows_query)
+    ]
+    if values:
+        connection.execute(
+            "INSERT INTO {0} (rowid, collection_name, collection_description) "
+            "VALUES (:rowid, :collection_name, :collection_description)".format(SEARCH_TABLE),
+            values
+        )
+
+
+def index_annotations(connection, rows):
+    """ Ajoute des annotations à l'index de recherche. Les annotations sans texte ne sont pas indexées.
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param rows: tuples (ID de l'annotation, ID de l'image, JSON de l'annotation)
+    :type rows: iterable
+    """
+
+    values = []
+    for annotation_id, image_id, annotation_json in rows:
+        text = annotation_text(annotation_json)
+        if text and image_id is not None:
+            values.append({"rowid": annotation_id, "annotation_text": text, "annotation_image_id": image_id})
+    if values:
+        connection.execute(
+            "INSERT INTO {0} (rowid, annotation_text, annotation_image_id) "
+            "VALUES (:rowid, :annotation_text, :annotation_image_id)".format(ANNOTATION_SEARCH_TABLE),
+            values
+        )
+
+
+def reindex_annotations(connection, annotation_ids):
+    """ Met à jour l'index de recherche pour une liste d'annotations.
+    Les lignes des annotations supprimées sont retirées de l'index.
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param annotation_ids: ID des annotations à réindexer, ou None pour reconstruire tout l'index des annotations
+    :type annotation_ids: set
+    """
+
+    annotations = Annotation.__table__
+    query = select([annotations.c.annotation_id, annotations.c.annotation_image_id, annotations.c.annotation_json])
+
+    if annotation_ids is None:
+        connection.execute("DELETE FROM {0}".format(ANNOTATION_SEARCH_TABLE))
+    else:
+        annotation_ids = list(annotation_ids)
+        if not annotation_ids:
+            return
+        connection.execute(
+            annotation_search_table.delete().where(annotation_search_table.c.rowid.in_(annotation_ids))
+        )
+        query = query.where(annotations.c.annotation_id.in_(annotation_ids))
+
+    # Les annotations sont lues par lots : la reconstruction de l'index ne les charge pas toutes en mémoire.
+    result = connection.execute(query)
+    while True:
+        rows = result.fetchmany(SEARCH_INDEX_BATCH_SIZE)
+        if not rows:
+            break
+        index_annotations(connection, rows)
+
+
+def match_terms(keyword):
+    """ Transforme les termes saisis par l'utilisateur-ice en termes de requête FTS5.
+    Chaque mot est recherché comme préfixe.
+
+    :param keyword: termes de la recherche
+    :type keyword: str
+    :return: liste des termes FTS5 (vide si la recherche ne contient aucun mot)
+    :rtype: list
+    """
+
+    # Les mots sont entre guillemets : les opérateurs FTS5 (AND, NEAR, etc.) saisis sont traités comme du texte.
+    return ['"{0}"*'.format(word) for word in re.findall(r"\w+", keyword)]
+
+
+def search_collections(keyword):
+    """ Construit la requête de recherche des collections.
+    Avec l'index plein texte, la requête porte sur le nom, la description et les annotations des collections :
+    chaque mot doit être présent dans le nom, la description ou l'une des annotations de la collection.
+    Elle retourne aussi l'expression du score des résultats (les meilleurs résultats ont le score le plus bas) :
+    score du nom et de la description, plus celui de la meilleure annotation de la collection.
+    Sinon, la recherche porte sur le nom et la description avec LIKE, et le score vaut None.
+
+    :param keyword: termes de la recherche
+    :type keyword: str
+    :return: tuple (requête, score)
+    :rtype: tuple
+    """
+
+    terms = match_terms(keyword) if _enabled else []
+
+    if not terms:
+        pattern = "%{}%".format(keyword)
+        query = Collection.query.filter(
+            Collection.collection_name.like(pattern) | Collection.collection_description.like(pattern)
+        )
+        return query, None
+
+    links = CollectionHasImages.__table__
+    annotations_join = annotation_search_table.join(
+        links, links.c.collection_has_images_image_id == annotation_search_table.c.annotation_image_id
+    )
+
+    def collection_matches(expression):
+        return select([search_table.c.rowid]).where(literal_column(SEARCH_TABLE).op("MATCH")(expression))
+
+    def annotation_matches(expression):
+        return select([links.c.collection_has_images_collection_id]).select_from(annotations_join).where(
+            literal_column(ANNOTATION_SEARCH_TABLE).op("MATCH")(expression)
+        )
+
+    # Chaque mot est cherché séparément : les mots peuvent se trouver dans des annotations différentes.
+    conditions = [
+        Collection.collection_id.in_(collection_matches(term)) | Collection.collection_id.in_(annotation_matches(term))
+        for term in terms
+    ]
+
+    # Le score est calculé sur l'ensemble des mots, une fois par collection trouvée.
+    any_term = " OR ".join(terms)
+    collection_rank = select([
+        search_table.c.rowid.label("collection_id"), search_table.c.rank.label("rank")
+    ]).where(literal_column(SEARCH_TABLE).op("MATCH")(any_term)).alias("collection_rank")
+    annotation_rank = select([
+        links.c.collection_has_images_collection_id.label("collection_id"),
+        func.min(annotation_search_table.c.rank).label("rank")
+    ]).select_from(annotations_join).where(
+        literal_column(ANNOTATION_SEARCH_TABLE).op("MATCH")(any_term)
+    ).group_by(links.c.collection_has_images_collection_id).alias("annotation_rank")
+
+    query = Collection.query.outerjoin(
+        collection_rank, collection_rank.c.collection_id == Collection.collection_id
+    ).outerjoin(
+        annotation_rank, annotation_rank.c.collection_id == Collection.collection_id
+    ).filter(and_(*conditions))
+    rank = func.coalesce(collection_rank.c.rank, 0) + func.coalesce(annotation_rank.c.rank, 0) * ANNOTATION_SEARCH_WEIGHT
+    return query, rank
+
+
+def _rows_to_reindex(session):
+    """ Retourne les ID des collections et des annotations dont le texte indexé a pu changer lors du flush en cours. """
+
+    collection_ids = set()
+    annotation_ids = set()
+
+    for instance in list(session.new) + list(session.deleted):
+        if isinstance(instance, Collection):
+            collection_ids.add(instance.collection_id)
+        elif isinstance(instance, Annotation):
+            annotation_ids.add(instance.annotation_id)
+
+    for instance in session.dirty:
+        state = inspect(instance)
+        if isinstance(instance, Collection):
+            if state.attrs.collection_name.history.has_changes() \
+                    or state.attrs.collection_description.history.has_changes():
+                collection_ids.add(instance.collection_id)
+        elif isinstance(instance, Annotation):
+            if state.attrs.annotation_json.history.has_changes() \
+                    or state.attrs.annotation_image_id.history.has_changes():
+                annotation_ids.add(instance.annotation_id)
+
+    annotation_ids.discard(None)
+    collection_ids.discard(None)
+    return collection_ids, annotation_ids
+
+
+@event.listens_for(db.session, "after_flush")
+def _sync_search_index(session, flush_context):
+    """ Met à jour l'index de recherche dans la transaction du flush, pour les collections et annotations
+    ajoutées, modifiées ou supprimées. Seules les lignes de ces collections et annotations sont réécrites.
+    """
+
+    if not _enabled:
+        return
+
+    collection_ids, annotation_ids = _rows_to_reindex(session)
+    if not collection_ids and not annotation_ids:
+        return
+
+    connection = session.connection()
+    reindex_collections(connection, collection_ids)
+    reindex_annotations(connection, annotation_ids)
+    # Les résultats des recherches ont pu changer : on vide le cache de leur nombre.
+    invalidate_counts({Collection.__tablename__})
@@ -0,0 +1,154 @@
+import datetime
+
+from sqlalchemy import event, inspect, select
+
+from ..app import db, response_cache
+from .data import (
+    Annotation, AuthorshipAnnotation, AuthorshipCollection, Collection, CollectionHasCategories,
+    CollectionHasImages, Image
+)
+
+
+def bump_versions(connection, image_ids=(), collection_ids=()):
+    """ Incrémente la version des images et des collections modifiées, et met à jour leur date de modification.
+    Les collections qui contiennent les images sont également incrémentées.
+
+    :param connection: connexion à la base de données (celle de la transaction en cours)
+    :param image_ids: ID des images modifiées
+    :type image_ids: iterable
+    :param collection_ids: ID des collections modifiées
+    :type collection_ids: iterable
+    :return: tuple (ID des images incrémentées, ID des collections incrémentées)
+    :rtype: tuple
+    """
+
+    image_ids = [image_id for image_id in set(image_ids) if image_id is not None]
+    collection_ids = {collection_id for collection_id in collection_ids if collection_id is not None}
+    now = datetime.datetime.utcnow()
+
+    if image_ids:
+        images = Image.__table__
+        connection.execute(
+            images.update()
+            .where(images.c.image_id.in_(image_ids))
+            .values(image_version=images.c.image_version + 1, image_modified=now)
+        )
+        links = CollectionHasImages.__table__
+        collection_ids.update(
+            collection_id for collection_id, in connection.execute(
+                select([links.c.collection_has_images_collection_id])
+                .where(links.c.collection_has_images_image_id.in_(image_ids))
+                .distinct()
+            )
+        )
+
+    if collection_ids:
+        collections = Collection.__table__
+        connection.execute(
+            collections.update()
+            .where(collections.c.collection_id.in_(list(collection_ids)))
+            .values(collection_version=collections.c.collection_version + 1, collection_modified=now)
+        )
+
+    return set(image_ids), collection_ids
+
+
+def bump_session_versions(session, image_ids=(), collection_ids=()):
+    """ Incrémente la version des images et des collections modifiées dans la transaction d'une session.
+    Leurs réponses sont supprimées du cache de l'API après le commit de la transaction.
+    À utiliser pour les écritures qui ne passent pas par le flush de la session (insertions en masse).
+
+    :param session: session de la base de données
+    :param image_ids: ID des images modifiées
+    :type image_ids: iterable
+    :param collection_ids: ID des collections modifiées
+    :type collection_ids: iterable
+    :return: tuple (ID des images incrémentées, ID des collections incrémentées)
+    :rtype: tuple
+    """
+
+    image_ids, collection_ids = bump_versions(session.connection(), image_ids, collection_ids)
+    pending = session.info.setdefault("modified_versions", (set(), set()))
+    pending[0].update(image_ids)
+    pending[1].update(collection_ids)
+    return image_ids, collection_ids
+
+
+def _changed(instance, *attributes):
+    """ Indique si l'un des attributs d'un objet a été modifié. """
+
+    state = inspect(instance)
+    return any(state.attrs[attribute].history.has_changes() for attribute in attributes)
+
+
+def _modified_objects(session):
+    """ Retourne les ID des images et des collections dont les données renvoyées par l'API ont changé
+    lors du flush en cours.
+    """
+
+    image_ids = set()
+    collection_ids = set()
+    annotation_ids = set()
+
+    added_or_deleted = list(session.new) + list(session.deleted)
+    for instance in added_or_deleted:
+        if isinstance(instance, Annotation):
+            image_ids.add(instance.annotation_image_id)
+        elif isinstance(instance, AuthorshipAnnotation):
+            annotation_ids.add(instance.authorship_annotation_annotation_id)
+        elif isinstance(instance, CollectionHasImages):
+            collection_ids.add(instance.collection_has_images_collection_id)
+        elif isinstance(instance, CollectionHasCategories):
+            collection_ids.add(instance.collection_id)
+        elif isinstance(instance, AuthorshipCollection):
+            collection_ids.add(instance.authorship_collection_collection_id)
+
+    for instance in session.dirty:
+        if isinstance(instance, Annotation) and _changed(instance, "annotation_json", "annotation_image_id"):
+            image_ids.update(inspect(instance).attrs.annotation_image_id.history.sum())
+        elif isinstance(instance, Collection) and _changed(
+                instance, "collection_name", "collection_description", "collection_source"):
+            collection_ids.add(instance.collection_id)
+
+    # Les collections créées ont déjà la version 1, et celles supprimées n'ont plus de version.
+    for instance in added_or_deleted:
+        if isinstance(instance, Collection):
+            collection_ids.discard(instance.collection_id)
+
+    return image_ids, collection_ids, annotation_ids
+
+
+@event.listens_for(db.session, "after_flush")
+def _bump_versions(session, flush_context):
+    """ Incrémente, dans la transaction du flush, la version des images et des collections modifiées. """
+
+    image_ids, collection_ids, annotation_ids = _modified_objects(session)
+    annotation_ids.discard(None)
+    if not image_ids and not collection_ids and not annotation_ids:
+        return
+
+    if annotation_ids:
+        # Une édition (authorship) ajoutée à une annotation modifie les données de son image.
+        annotations = Annotation.__table__
+        image_ids.update(
+            image_id for image_id, in session.connection().execute(
+                select([annotations.c.annotation_image_id]).where(annotations.c.annotation_id.in_(list(annotation_ids)))
+            )
+        )
+    bump_session_versions(session, image_ids, collection_ids)
+
+
+@event.listens_for(db.session, "after_commit")
+def _invalidate_responses(session):
+    """ Supprime du cache de l'API les réponses des images et des collections modifiées par la transaction. """
+
+    image_ids, collection_ids = session.info.pop("modified_versions", (set(), set()))
+    response_cache.invalidate("image", image_ids)
+    response_cache.invalidate("collection", collection_ids)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _forget_versions(session):
+    """ Les versions incrémentées par une transaction annulée n'ont pas été enregistrées. """
+
+    session.info.pop("modified_versions", None)
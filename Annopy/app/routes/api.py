@@ -1,16 +1,38 @@
-from flask_login import login_required
-from flask import request, jsonify
+from flask_login import current_user, login_required
+from flask import request, Response, stream_with_context
+import datetime
+from hashlib import sha1
+import os
+import tempfile
 from urllib.parse import urlencode
 
-from ..app import app
+from ..app import app, db, response_cache
 from ..constantes import API_ROUTE
+from ..modeles.changes import CHANGE_FEED_DIALECTS
 from ..modeles.data import *
+from ..modeles.export import EXPORT_COMPRESSIONS, EXPORT_FORMATS, check_compression, iter_corpus_rows, \
+    iter_encoded, iter_export_lines
+from ..modeles.jobs import submit_annotation_import_job
+from ..modeles.json_export import LazyList, iter_json, jsonify_options, api_jsonify, api_json_backend
+from ..modeles.pagination import keyset_paginate, cached_count
+from ..modeles.regions import find_regions
+from ..modeles.search import search_collections
 
 """
 Routes pour l'API, dans l'ordre:
 /api/collection/<int:collection_id>
 /api/image/<int:image_id>
 /api/collections
+/api/jobs/<int:job_id>
+/api/cache
+/api/changes
+/api/image/<int:image_id>/regions
+/api/collection/<int:collection_id>/regions
+/api/export
+/api/annotation/<int:annotation_id> (GET, PUT, DELETE)
+/api/image/<int:image_id>/annotations (POST)
+/api/image/<int:image_id>/annotations/bulk (POST)
+/api/collection/<int:collection_id>/annotations/import (POST)
 """
 
 
@@ -20,11 +42,113 @@ def json_404():
     :return: HTTP response
     """
 
-    response = jsonify({"erreur": "Unable to perform the query"})
+    response = api_jsonify({"erreur": "Unable to perform the query"})
     response.status_code = 404
     return response
 
 
+def json_errors(errors, status_code=400):
+    """ Renvoie une liste d'erreurs au format JSON.
+
+    :param errors: messages d'erreur
+    :type errors: list
+    :param status_code: code HTTP de la réponse
+    :type status_code: int
+    :return: HTTP response
+    """
+
+    response = api_jsonify({"erreurs": errors})
+    response.status_code = status_code
+    return response
+
+
+def representation_etag(*parts):
+    """ Construit l'ETag d'une réponse de l'API à partir de l'identité et de la version des données renvoyées.
+    Les options de formatage du JSON (indentation, backend) font partie de l'ETag : deux représentations
+    différentes des mêmes données n'ont pas le même ETag. L'adresse de l'application (schéma et nom d'hôte) en fait
+    aussi partie : les liens des réponses sont des URL absolues.
+
+    :param parts: éléments identifiant les données (type, ID, version, etc.)
+    :return: ETag (sans guillemets)
+    :rtype: str
+    """
+
+    options = jsonify_options()
+    parts = parts + (request.host_url,) + tuple(sorted((key, repr(value)) for key, value in options.items()))
+    return sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def not_modified(etag, last_modified):
+    """ Vérifie les en-têtes de requête conditionnelle (If-None-Match, If-Modified-Since).
+    If-Modified-Since n'est utilisé qu'en l'absence de If-None-Match.
+
+    :param etag: ETag des données
+    :type etag: str
+    :param last_modified: date de dernière modification des données (UTC)
+    :type last_modified: datetime
+    :return: réponse HTTP 304 si le client a déjà la version courante des données, None sinon
+    """
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since and last_modified is not None:
+        # Les dates HTTP sont à la seconde près.
+        fresh = last_modified.replace(microsecond=0) <= request.if_modified_since
+    else:
+        fresh = False
+
+    if not fresh:
+        return None
+    return cache_headers(Response(status=304), etag, last_modified)
+
+
+def cached_response(kind, object_id, etag, serialize):
+    """ Renvoie une réponse de l'API depuis le cache des réponses, ou la sérialise et la met en cache.
+
+    :param kind: type de l'objet ("collection", "image")
+    :type kind: str
+    :param object_id: ID de l'objet
+    :type object_id: int
+    :param etag: ETag de la réponse, qui contient la version de l'objet
+    :type etag: str
+    :param serialize: fonction sans argument qui renvoie la réponse HTTP
+    :type serialize: callable
+    :return: HTTP response
+    """
+
+    body = response_cache.get(kind, object_id, etag)
+    if body is not None:
+        response = Response(body, mimetype=app.config["JSONIFY_MIMETYPE"])
+        response.headers["X-Cache"] = "HIT"
+        return response
+
+    response = serialize()
+    if response.status_code == 200 and not response.is_streamed:
+        response_cache.set(kind, object_id, etag, response.get_data())
+    response.headers["X-Cache"] = "MISS"
+    return response
+
+
+def cache_headers(response, etag, last_modified):
+    """ Ajoute à une réponse les en-têtes de validation du cache HTTP.
+    Les données de l'API demandent une authentification : elles ne sont gardées que par le navigateur,
+    qui les revalide à chaque requête (no-cache).
+
+    :param response: réponse HTTP
+    :param etag: ETag des données
+    :type etag: str
+    :param last_modified: date de dernière modification des données (UTC)
+    :type last_modified: datetime
+    :return: réponse HTTP
+    """
+
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 @app.route(API_ROUTE+"/collection/<int:collection_id>")
 @login_required
 def api_collection_data(collection_id):
@@ -35,22 +159,70 @@ def api_collection_data(collection_id):
     - Les images
     - Les annotations des images
 
+    Avec le paramètre stream (/api/collection/<id>?stream=1), la réponse est écrite en flux : les images sont
+    chargées et sérialisées par lots, et la mémoire utilisée ne dépend pas de la taille de la collection.
+    Le JSON produit est identique à celui de la réponse classique.
+
     :param collection_id: ID de la collection recherchée
     :type collection_id: int
     :return: données au format JSON
     """
 
-    try:
-        # On fait une query à la base de données pour récupérer une collection selon son ID.
-        # L'objet récupéré est stocké dans la variable query.
-        query = Collection.query.get(collection_id)
-        # On exécute la fonction to_json_api() définie dans data.py pour la class Collection à query.
-        # On convertit la réponse de la fonction au format JSON avec la fonction jsonify().
-        return jsonify((query.to_json_api()))
-    except:
-        # S'il y a une erreur, si la collection n'existe pas, on lance une erreur HTTP 404.
+    # On fait une query à la base de données pour récupérer une collection selon son ID.
+    # L'objet récupéré est stocké dans la variable query.
+    query = Collection.query.get(collection_id)
+
+    # S'il y a une erreur, si la collection n'existe pas, on lance une erreur HTTP 404.
+    if query is None:
         return json_404()
 
+    # Si le client a déjà la version courante de la collection, on ne la sérialise pas.
+    etag = representation_etag("collection", query.collection_id, query.collection_version)
+    response = not_modified(etag, query.collection_modified)
+    if response is not None:
+        return response
+
+    def serialize():
+        if request.args.get("stream"):
+            return stream_collection_data(query)
+        # On charge en quelques requêtes les images, annotations et authorships de la collection,
+        # plutôt qu'une requête par relation et par objet lors de la sérialisation.
+        Collection.preload_for_api([query])
+        # On exécute la fonction to_json_api() définie dans data.py pour la class Collection à query.
+        # On convertit la réponse de la fonction au format JSON avec la fonction api_jsonify().
+        return api_jsonify(query.to_json_api())
+
+    # La réponse est lue dans le cache si possible. Les réponses écrites en flux ne sont pas mises en cache,
+    # mais une réponse en cache est renvoyée en une fois : le JSON est le même.
+    response = cached_response("collection", query.collection_id, etag, serialize)
+    return cache_headers(response, etag, query.collection_modified)
+
+
+def stream_collection_data(collection):
+    """ Écrit en flux les données d'une collection au format JSON.
+    Les images sont lues par lots avec Collection.iter_images_for_api().
+
+    :param collection: collection
+    :type collection: Collection
+    :return: HTTP response
+    """
+
+    # On charge les catégories et l'authorship de la collection. Les images seront chargées pendant l'écriture.
+    Collection.preload_for_api([collection], with_images=False)
+    data = collection.to_json_api(
+        images=LazyList(collection.iter_images_for_api(app.config["API_STREAM_CHUNK_SIZE"]))
+    )
+    options = jsonify_options()
+
+    def generate():
+        for chunk in iter_json(data, **options):
+            yield chunk
+        # jsonify() termine ses réponses par un retour à la ligne.
+        yield "\n"
+
+    # stream_with_context garde la requête (et la session de base de données) ouverte pendant l'écriture.
+    return Response(stream_with_context(generate()), mimetype=app.config["JSONIFY_MIMETYPE"])
+
 
 @app.route(API_ROUTE+"/image/<int:image_id>")
 @login_required
@@ -66,76 +238,659 @@ def api_image_data(image_id):
     :return: données au format JSON
     """
 
-    try:
-        # On fait une query à la base de données pour récupérer une image selon son ID.
-        # L'objet récupéré est stocké dans la variable query.
-        query = Image.query.get(image_id)
-        # On exécute la fonction to_json_api() définie dans data.py pour la class Image à query.
-        # On convertit la réponse de la fonction au format JSON avec la fonction jsonify().
-        return jsonify((query.to_json_api()))
-    except:
-        # S'il y a une erreur, si l'image n'existe pas, on lance une erreur HTTP 404.
+    # On fait une query à la base de données pour récupérer une image selon son ID.
+    # L'objet récupéré est stocké dans la variable query.
+    query = Image.query.get(image_id)
+
+    # S'il y a une erreur, si l'image n'existe pas, on lance une erreur HTTP 404.
+    if query is None:
         return json_404()
 
+    # Si le client a déjà la version courante de l'image, on ne la sérialise pas.
+    etag = representation_etag("image", query.image_id, query.image_version)
+    response = not_modified(etag, query.image_modified)
+    if response is not None:
+        return response
+
+    def serialize():
+        # On charge les annotations de l'image et leurs authorships en deux requêtes.
+        Image.preload_for_api([query])
+        # On exécute la fonction to_json_api() définie dans data.py pour la class Image à query.
+        # On convertit la réponse de la fonction au format JSON avec la fonction api_jsonify().
+        return api_jsonify(query.to_json_api())
+
+    response = cached_response("image", query.image_id, etag, serialize)
+    return cache_headers(response, etag, query.image_modified)
+
+
+# Tris des collections par statistique (paramètre sort de /api/collections, préfixé par "-" pour l'ordre décroissant).
+# Les collections jamais annotées ont une date de dernière annotation au 1er janvier 1970.
+COLLECTION_SORTS = {
+    "annotations": Collection.collection_annotation_count,
+    "annotators": Collection.collection_annotator_count,
+    "annotated_images": Collection.collection_annotated_image_count,
+    "last_annotated": db.func.coalesce(
+        Collection.collection_last_annotated, db.literal(datetime.datetime(1970, 1, 1), db.DateTime)
+    )
+}
+
+# Filtres des collections par statistique (paramètres de /api/collections).
+COLLECTION_FILTERS = {
+    "min_annotations": lambda value: Collection.collection_annotation_count >= value,
+    "max_annotations": lambda value: Collection.collection_annotation_count <= value,
+    "min_annotators": lambda value: Collection.collection_annotator_count >= value,
+    "min_annotated_images": lambda value: Collection.collection_annotated_image_count >= value,
+    "annotated_since": lambda value: Collection.collection_last_annotated >= value
+}
+
+
+def collection_statistics_parameters(query):
+    """ Applique à une requête de collections les filtres par statistique de la requête HTTP, et lit le tri demandé.
+
+    :param query: requête des collections
+    :type query: BaseQuery
+    :return: tuple (requête filtrée, expression du tri ou None, True si le tri est décroissant), ou liste d'erreurs
+    :rtype: tuple
+    """
+
+    errors = []
+    for name, condition in COLLECTION_FILTERS.items():
+        value = request.args.get(name, None)
+        if value is None:
+            continue
+        if name == "annotated_since":
+            try:
+                value = datetime.datetime.fromisoformat(value)
+            except ValueError:
+                errors.append("Le paramètre annotated_since doit être une date (AAAA-MM-JJ).")
+                continue
+        elif value.isdigit():
+            value = int(value)
+        else:
+            errors.append("Le paramètre {0} doit être un entier positif.".format(name))
+            continue
+        query = query.filter(condition(value))
+
+    sort = request.args.get("sort", None)
+    rank, descending = None, False
+    if sort is not None:
+        descending = sort.startswith("-")
+        rank = COLLECTION_SORTS.get(sort.lstrip("-"))
+        if rank is None:
+            errors.append("Le paramètre sort doit valoir {0}, précédé de \"-\" pour l'ordre décroissant.".format(
+                ", ".join(COLLECTION_SORTS)
+            ))
+
+    if errors:
+        return errors
+    return query, rank, descending
+
 
 @app.route(API_ROUTE+"/collections")
 @login_required
 def api_collections_browse():
-    """ Route permettant d'avoir le résultat d'une recherche dans les collections via l'API
+    """ Route permettant d'avoir le résultat d'une recherche dans les collections via l'API.
+    Les résultats sont paginés par curseur : les liens next et prev contiennent un paramètre cursor opaque.
+    Avec q, les collections sont recherchées dans l'index plein texte (nom, description, annotations)
+    et triées par pertinence.
+    Avec total=1, le nombre total de résultats (mis en cache) est ajouté dans meta.
+    Le paramètre page (pagination par numéro de page) reste accepté.
+    Les collections peuvent être triées par statistique avec sort (annotations, annotators, annotated_images,
+    last_annotated ; -annotations pour l'ordre décroissant), à la place de la pertinence, et filtrées avec
+    min_annotations, max_annotations, min_annotators, min_annotated_images et annotated_since (AAAA-MM-JJ).
+    Les statistiques sont des colonnes indexées de la table collection : les annotations ne sont pas lues.
 
     :return: données au format JSON
     """
 
     # q est ici utilisé comme paramètre pour la recherche.
     keyword = request.args.get("q", None)
-    page = request.args.get("page", 1)
-
-    if isinstance(page, str) and page.isdigit():
-        page = int(page)
-    else:
-        page = 1
+    cursor = request.args.get("cursor", None)
+    page = request.args.get("page", None)
 
+    rank = None
     if keyword:
-        query = Collection.query.filter(
-            Collection.collection_name.like("%{}%".format(keyword))
-        )
+        query, rank = search_collections(keyword)
     else:
         # S'il n'y a pas de mot-clé pour la recherche, on renvoie toutes les collections présentes en base.
         query = Collection.query
 
+    parameters = collection_statistics_parameters(query)
+    if isinstance(parameters, list):
+        return json_errors(parameters)
+    query, sort_rank, descending = parameters
+    if sort_rank is not None:
+        rank = sort_rank
+
     try:
-        resultats = query.paginate(page=page, per_page=5)
+        if page is not None and not cursor:
+            # Pagination par numéro de page (OFFSET), conservée pour les liens existants.
+            page = int(page) if page.isdigit() else 1
+            if rank is not None:
+                query = query.order_by(rank.desc() if descending else rank, Collection.collection_id)
+            resultats = query.paginate(page=page, per_page=5, error_out=False)
+            next_arguments = {"page": resultats.next_num} if resultats.has_next else None
+            prev_arguments = {"page": resultats.prev_num} if resultats.has_prev else None
+        else:
+            # Pagination par curseur : la page est lue à partir de l'ID de la dernière collection de la page
+            # précédente, sans OFFSET ni COUNT(*).
+            resultats = keyset_paginate(
+                query, Collection.collection_id, cursor=cursor, per_page=5, rank=rank, rank_descending=descending
+            )
+            next_arguments = {"cursor": resultats.next_cursor} if resultats.has_next else None
+            prev_arguments = {"cursor": resultats.prev_cursor} if resultats.has_prev else None
     except Exception:
         return json_404()
 
+    # On construit les liens de pagination.
+    links = {"self": request.url}
+    # Les liens gardent la recherche, le tri et les filtres.
+    kept_arguments = {
+        name: request.args[name] for name in ("q", "sort") + tuple(COLLECTION_FILTERS) if request.args.get(name)
+    }
+    for link, arguments in (("next", next_arguments), ("prev", prev_arguments)):
+        if arguments:
+            arguments.update(kept_arguments)
+            links[link] = url_for("api_collections_browse", _external=True)+"?"+urlencode(arguments)
+
+    # Le nombre total de résultats n'est calculé que s'il est demandé.
+    # Avec des filtres par statistique, il peut avoir jusqu'à PAGINATION_COUNT_TTL secondes de retard.
+    total = None
+    if request.args.get("total") == "1":
+        filters = sorted((name, value) for name, value in kept_arguments.items() if name in COLLECTION_FILTERS)
+        count_key = repr((keyword, filters)) if filters else keyword
+        total = cached_count(query, "collection", count_key, app.config["PAGINATION_COUNT_TTL"])
+
+    # L'ETag de la page dépend des collections qu'elle contient et de leur version.
+    # Si le client a déjà la page, les données des collections ne sont ni chargées ni sérialisées.
+    etag = representation_etag(
+        "collections",
+        tuple((collection.collection_id, collection.collection_version) for collection in resultats.items),
+        tuple(sorted(links.items())),
+        total
+    )
+    last_modified = max(
+        (collection.collection_modified for collection in resultats.items if collection.collection_modified),
+        default=None
+    )
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+
+    # On charge en quelques requêtes les données de toutes les collections de la page.
+    Collection.preload_for_api(resultats.items)
+
     # On formate les données récupérées.
     dict_resultats = {
-        "links": {
-            "self": request.url
-        },
+        "links": links,
         "data": [
             collection.to_json_api()
             for collection in resultats.items
         ]
     }
-
-    # On pagine la recherche.
-    if resultats.has_next:
-        arguments = {
-            "page": resultats.next_num
-        }
-        if keyword:
-            arguments["q"] = keyword
-        dict_resultats["links"]["next"] = url_for("api_collections_browse", _external=True)+"?"+urlencode(arguments)
-
-    if resultats.has_prev:
-        arguments = {
-            "page": resultats.prev_num
-        }
-        if keyword:
-            arguments["q"] = keyword
-        dict_resultats["links"]["prev"] = url_for("api_collections_browse", _external=True)+"?"+urlencode(arguments)
+    if total is not None:
+        dict_resultats["meta"] = {"total": total}
 
     # On convertit les données formatées en JSON.
-    response = jsonify(dict_resultats)
+    response = api_jsonify(dict_resultats)
+    return cache_headers(response, etag, last_modified)
+
+
+@app.route(API_ROUTE+"/jobs/<int:job_id>")
+@login_required
+def api_job(job_id):
+    """ Route permettant de suivre l'avancement de l'import des images d'une collection.
+    Renvoie l'étape de l'import, le nombre d'images enregistrées et le débit (images par seconde).
+
+    :param job_id: ID de l'import
+    :type job_id: int
+    :return: données au format JSON
+    """
+
+    job = ImportJob.query.get(job_id)
+
+    # Si l'import n'existe pas, on lance une erreur HTTP 404.
+    if job is None:
+        return json_404()
+
+    return api_jsonify(job.to_json_api())
+
+
+@app.route(API_ROUTE+"/cache")
+@login_required
+def api_cache():
+    """ Route permettant de suivre l'utilisation du cache des réponses de l'API par le processus courant :
+    réponses trouvées en mémoire ou sur le disque, non trouvées, mises en cache, supprimées, taille du cache.
+
+    :return: données au format JSON
+    """
+
+    return api_jsonify(response_cache.metrics())
+
+
+@app.route(API_ROUTE+"/changes")
+@login_required
+def api_changes():
+    """ Route permettant de récupérer les annotations créées, modifiées ou supprimées depuis une synchronisation.
+    Chaque modification a un numéro de séquence croissant. Paramètres :
+    - since : numéro de séquence de la dernière modification reçue (0, par défaut, pour recevoir tout le journal) ;
+    - limit : nombre de modifications par page ;
+    - collection : ID d'une collection, pour ne recevoir que les modifications de ses annotations ;
+    - stream=1 : toutes les modifications sont écrites en flux, sans pagination.
+    Chaque annotation est renvoyée dans son état actuel, avec sa dernière modification.
+    meta.last_sequence est la valeur de since à utiliser lors de la synchronisation suivante.
+    Le journal n'est disponible que sur SQLite et PostgreSQL (voir record_changes) : sur une autre base,
+    une synchronisation pourrait manquer des modifications, et la route renvoie une erreur 501.
+
+    :return: données au format JSON
+    """
+
+    if db.engine.dialect.name not in CHANGE_FEED_DIALECTS:
+        return json_errors(["Le journal des modifications n'est pas disponible sur cette base de données."], 501)
+
+    since = request.args.get("since", "0")
+    limit = request.args.get("limit", str(app.config["API_CHANGES_PAGE_SIZE"]))
+    collection_id = request.args.get("collection", None)
+
+    if not since.isdigit() or not limit.isdigit() or int(limit) < 1 \
+            or (collection_id is not None and not collection_id.isdigit()):
+        return json_errors(["Les paramètres since, limit et collection doivent être des entiers positifs."])
+    since = int(since)
+    limit = min(int(limit), app.config["API_CHANGES_MAX_PAGE_SIZE"])
+    collection_id = int(collection_id) if collection_id is not None else None
+
+    def changes_url(sequence):
+        arguments = {"since": sequence}
+        if collection_id is not None:
+            arguments["collection"] = collection_id
+        return url_for("api_changes", _external=True)+"?"+urlencode(arguments)
+
+    if request.args.get("stream"):
+        return stream_changes(since, collection_id, changes_url)
+
+    changes, last_sequence, has_more = AnnotationChange.since(since, limit, collection_id)
+
+    return api_jsonify({
+        "links": {
+            "self": request.url,
+            "next": changes_url(last_sequence)
+        },
+        "meta": {
+            "since": since,
+            "last_sequence": last_sequence,
+            "has_more": has_more
+        },
+        "data": [change.to_json_api() for change in changes]
+    })
+
+
+def stream_changes(since, collection_id, changes_url):
+    """ Écrit en flux toutes les modifications d'annotations postérieures à since, jusqu'à la dernière modification
+    enregistrée au début de la requête. Les modifications sont lues par lots de API_STREAM_CHUNK_SIZE.
+
+    :param since: numéro de séquence de la dernière modification reçue
+    :type since: int
+    :param collection_id: ID de la collection, ou None pour toutes les modifications
+    :type collection_id: int
+    :param changes_url: fonction qui renvoie l'URL du journal à partir d'un numéro de séquence
+    :type changes_url: callable
+    :return: HTTP response
+    """
+
+    # Les modifications enregistrées pendant l'écriture seront envoyées lors de la synchronisation suivante.
+    last_sequence = max(db.session.query(db.func.max(AnnotationChange.annotation_change_id)).scalar() or 0, since)
+    chunk_size = app.config["API_STREAM_CHUNK_SIZE"]
+
+    def iter_changes():
+        sequence = since
+        while sequence < last_sequence:
+            changes, sequence, has_more = AnnotationChange.since(sequence, chunk_size, collection_id)
+            for change in changes:
+                if change.annotation_change_id > last_sequence:
+                    return
+                yield change.to_json_api()
+            if not has_more:
+                return
+
+    data = {
+        "links": {
+            "self": request.url,
+            "next": changes_url(last_sequence)
+        },
+        "meta": {
+            "since": since,
+            "last_sequence": last_sequence,
+            "has_more": False
+        },
+        "data": LazyList(iter_changes())
+    }
+    options = jsonify_options()
+
+    def generate():
+        for chunk in iter_json(data, **options):
+            yield chunk
+        # jsonify() termine ses réponses par un retour à la ligne.
+        yield "\n"
+
+    # stream_with_context garde la requête (et la session de base de données) ouverte pendant l'écriture.
+    return Response(stream_with_context(generate()), mimetype=app.config["JSONIFY_MIMETYPE"])
+
+
+def region_parameters():
+    """ Lit les paramètres d'une recherche de régions : bbox=x,y,largeur,hauteur ou point=x,y (en pixels),
+    limit et after.
+
+    :return: tuple (rectangle (min_x, min_y, max_x, max_y), after, limit), ou liste d'erreurs
+    :rtype: tuple
+    """
+
+    bbox = request.args.get("bbox", None)
+    point = request.args.get("point", None)
+    after = request.args.get("after", "0")
+    limit = request.args.get("limit", str(app.config["API_REGIONS_PAGE_SIZE"]))
+
+    errors = []
+    rectangle = None
+    try:
+        if (bbox is None) == (point is None):
+            errors.append("Un des paramètres bbox (x,y,largeur,hauteur) ou point (x,y) est requis.")
+        elif bbox is not None:
+            x, y, width, height = (float(value) for value in bbox.split(","))
+            if width < 0 or height < 0:
+                errors.append("La largeur et la hauteur de bbox doivent être positives.")
+            rectangle = (x, y, x + width, y + height)
+        else:
+            x, y = (float(value) for value in point.split(","))
+            rectangle = (x, y, x, y)
+    except ValueError:
+        errors.append("Les paramètres bbox (x,y,largeur,hauteur) et point (x,y) doivent être des nombres.")
+    if not after.isdigit() or not limit.isdigit() or int(limit) < 1:
+        errors.append("Les paramètres after et limit doivent être des entiers positifs.")
+
+    if errors:
+        return errors
+    return rectangle, int(after), min(int(limit), app.config["API_REGIONS_MAX_PAGE_SIZE"])
+
+
+def regions_response(endpoint, image_id=None, collection_id=None):
+    """ Renvoie une page de résultats d'une recherche de régions, sur une image ou sur une collection.
+
+    :param endpoint: nom de la route, pour le lien vers la page suivante
+    :type endpoint: str
+    :param image_id: ID de l'image
+    :type image_id: int
+    :param collection_id: ID de la collection (si image_id n'est pas renseigné)
+    :type collection_id: int
+    :return: HTTP response
+    """
+
+    parameters = region_parameters()
+    if isinstance(parameters, list):
+        return json_errors(parameters)
+    rectangle, after, limit = parameters
+
+    annotations, has_more = find_regions(rectangle, image_id, collection_id, after, limit)
+
+    links = {"self": request.url}
+    if has_more:
+        arguments = {key: value for key, value in request.args.items() if key != "after"}
+        arguments["after"] = annotations[-1].annotation_id
+        view_arguments = {"image_id": image_id} if image_id is not None else {"collection_id": collection_id}
+        links["next"] = url_for(endpoint, _external=True, **view_arguments)+"?"+urlencode(arguments)
+
+    return api_jsonify({
+        "links": links,
+        "meta": {
+            "xywh": [rectangle[0], rectangle[1], rectangle[2] - rectangle[0], rectangle[3] - rectangle[1]],
+            "has_more": has_more
+        },
+        "data": [annotation.region_to_json_api() for annotation in annotations]
+    })
+
+
+@app.route(API_ROUTE+"/image/<int:image_id>/regions")
+@login_required
+def api_image_regions(image_id):
+    """ Route permettant de rechercher les annotations d'une image dont la région croise un rectangle
+    (bbox=x,y,largeur,hauteur) ou contient un point (point=x,y), en pixels. Les résultats sont triés par ID
+    d'annotation et paginés : le lien next contient le paramètre after, ID de la dernière annotation de la page.
+
+    :param image_id: ID de l'image
+    :type image_id: int
+    :return: données au format JSON
+    """
+
+    if Image.query.get(image_id) is None:
+        return json_404()
+    return regions_response("api_image_regions", image_id=image_id)
+
+
+@app.route(API_ROUTE+"/collection/<int:collection_id>/regions")
+@login_required
+def api_collection_regions(collection_id):
+    """ Route permettant de rechercher, sur toutes les images d'une collection, les annotations dont la région croise
+    un rectangle (bbox=x,y,largeur,hauteur) ou contient un point (point=x,y), en pixels. Les paramètres et la
+    pagination sont ceux de /api/image/<id>/regions ; chaque résultat indique l'ID de son image.
+
+    :param collection_id: ID de la collection
+    :type collection_id: int
+    :return: données au format JSON
+    """
+
+    if Collection.query.get(collection_id) is None:
+        return json_404()
+    return regions_response("api_collection_regions", collection_id=collection_id)
+
+
+@app.route(API_ROUTE+"/export")
+@login_required
+def api_export():
+    """ Route permettant de télécharger en flux toutes les annotations du corpus, en JSON-Lines.
+    Paramètres :
+    - format : "jsonl" (une annotation par ligne, par défaut) ou "w3c" (une AnnotationPage par ligne) ;
+    - compression : "gzip" ou "zstd" (si zstandard est installé) ;
+    - from, to : intervalle d'ID des collections exportées.
+    Les annotations sont lues par lots avec un curseur côté serveur, sur la base de lecture si elle est configurée.
+    Les annotations dont le JSON enregistré est invalide ne sont pas exportées (voir export_json).
+
+    :return: HTTP response
+    """
+
+    export_format = request.args.get("format", "jsonl")
+    compression = request.args.get("compression", None) or None
+    bounds = [request.args.get(name, None) for name in ("from", "to")]
+
+    erreurs = []
+    if export_format not in EXPORT_FORMATS:
+        erreurs.append("Le format doit être jsonl ou w3c.")
+    erreur = check_compression(compression)
+    if erreur:
+        erreurs.append(erreur)
+    if any(bound is not None and not bound.isdigit() for bound in bounds):
+        erreurs.append("Les paramètres from et to doivent être des ID de collections.")
+    if erreurs:
+        return json_errors(erreurs)
+    first_collection_id, last_collection_id = [int(bound) if bound is not None else None for bound in bounds]
+
+    engine = db.get_read_engine(app) or db.engine
+    base_url = request.url_root.rstrip("/")
+    backend = api_json_backend()
+
+    def generate():
+        with engine.connect() as connection:
+            rows = iter_corpus_rows(connection, first_collection_id, last_collection_id, app.config["EXPORT_CHUNK_SIZE"])
+            lines = iter_export_lines(rows, export_format, base_url, app.config["EXPORT_PAGE_SIZE"], backend)
+            for data in iter_encoded(lines, compression):
+                yield data
+
+    mimetypes = {None: "application/x-ndjson", "gzip": "application/gzip", "zstd": "application/zstd"}
+    response = Response(stream_with_context(generate()), mimetype=mimetypes[compression])
+    response.headers["Content-Disposition"] = "attachment; filename=annotations.jsonl{0}".format(
+        EXPORT_COMPRESSIONS[compression]
+    )
+    return response
+
+
+@app.route(API_ROUTE+"/annotation/<int:annotation_id>", methods=["GET", "PUT", "DELETE"])
+@login_required
+def api_annotation(annotation_id):
+    """ Route permettant de lire, modifier ou supprimer une annotation.
+    - GET renvoie l'annotation.
+    - PUT remplace l'annotation par l'annotation W3C Web Annotation envoyée (objet JSON).
+    - DELETE supprime l'annotation.
+    Seul-e un-e auteur-ice de l'annotation peut la modifier ou la supprimer.
+
+    :param annotation_id: ID de l'annotation
+    :type annotation_id: int
+    :return: données au format JSON
+    """
+
+    annotation = Annotation.query.get(annotation_id)
+
+    # Si l'annotation n'existe pas, on lance une erreur HTTP 404.
+    if annotation is None:
+        return json_404()
+
+    if request.method == "GET":
+        return api_jsonify(annotation.to_json_api())
+
+    if not annotation.is_edited_by(current_user):
+        return json_errors(["L'annotation n'a pas été créée par l'utilisateur-ice."], 403)
+
+    if request.method == "PUT":
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return json_errors(["L'annotation doit être un objet JSON."])
+        status, result = Annotation.apply_batch(
+            annotation.image, current_user, update=[{"id": annotation_id, "annotation": data}]
+        )
+        if status is False:
+            return json_errors(result)
+        return api_jsonify(Annotation.query.get(annotation_id).to_json_api())
+
+    status, result = Annotation.apply_batch(annotation.image, current_user, delete=[annotation_id])
+    if status is False:
+        return json_errors(result)
+    return api_jsonify(result)
+
+
+@app.route(API_ROUTE+"/image/<int:image_id>/annotations", methods=["POST"])
+@login_required
+def api_annotation_create(image_id):
+    """ Route permettant de créer une annotation sur une image.
+    Le corps de la requête est l'annotation, au format W3C Web Annotation (objet JSON).
+
+    :param image_id: ID de l'image annotée
+    :type image_id: int
+    :return: données au format JSON
+    """
+
+    image = Image.query.get(image_id)
+
+    # Si l'image n'existe pas, on lance une erreur HTTP 404.
+    if image is None:
+        return json_404()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return json_errors(["L'annotation doit être un objet JSON."])
+
+    status, result = Annotation.create_batch(image, current_user, [data])
+    if status is False:
+        return json_errors(result)
+
+    response = api_jsonify(Annotation.query.get(result[0]).to_json_api())
+    response.status_code = 201
+    response.headers["Location"] = url_for("api_annotation", annotation_id=result[0], _external=True)
+    return response
+
+
+@app.route(API_ROUTE+"/image/<int:image_id>/annotations/bulk", methods=["POST"])
+@login_required
+def api_annotations_bulk(image_id):
+    """ Route permettant d'envoyer en une requête les modifications des annotations d'une image.
+    Le corps de la requête est un objet JSON :
+    {"create": [annotation, ...], "update": [{"id": ID, "annotation": annotation}, ...], "delete": [ID, ...]}
+    Toutes les modifications sont enregistrées dans une seule transaction : si l'une échoue, aucune n'est appliquée.
+    Renvoie les ID des annotations créées, modifiées et supprimées.
+
+    :param image_id: ID de l'image annotée
+    :type image_id: int
+    :return: données au format JSON
+    """
+
+    image = Image.query.get(image_id)
+
+    # Si l'image n'existe pas, on lance une erreur HTTP 404.
+    if image is None:
+        return json_404()
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return json_errors(["Les modifications doivent être un objet JSON."])
+
+    status, result = Annotation.apply_batch(
+        image, current_user,
+        create=data.get("create"),
+        update=data.get("update"),
+        delete=data.get("delete")
+    )
+    if status is False:
+        return json_errors(result)
+    return api_jsonify(result)
+
+
+@app.route(API_ROUTE+"/collection/<int:collection_id>/annotations/import", methods=["POST"])
+@login_required
+def api_annotations_import(collection_id):
+    """ Route permettant d'importer un fichier d'annotations W3C Web Annotation sur les images d'une collection.
+    Le corps de la requête est le fichier : JSON-Lines (Content-Type application/x-ndjson, une annotation ou une
+    AnnotationPage par ligne) ou document AnnotationPage / AnnotationCollection (application/json).
+    Le paramètre format ("jsonl" ou "w3c") remplace le Content-Type ; le fichier peut être compressé
+    (Content-Encoding: gzip).
+    Le fichier est enregistré puis importé en arrière-plan : la réponse (202) renvoie l'import, dont l'avancement
+    est disponible sur /api/jobs/<id>.
+
+    :param collection_id: ID de la collection
+    :type collection_id: int
+    :return: données au format JSON
+    """
+
+    collection = Collection.query.get(collection_id)
+
+    # Si la collection n'existe pas, on lance une erreur HTTP 404.
+    if collection is None:
+        return json_404()
+
+    import_format = request.args.get("format") or ("jsonl" if request.mimetype in (
+        "application/x-ndjson", "application/jsonl", "application/x-jsonlines") else "w3c")
+    if import_format not in ("jsonl", "w3c"):
+        return json_errors(["Le format doit être jsonl ou w3c."])
+
+    # La taille du fichier envoyé (compressé ou non) est limitée : elle est vérifiée avec l'en-tête Content-Length,
+    # puis pendant la copie, si l'en-tête est absent ou faux.
+    max_size = app.config["ANNOTATION_IMPORT_MAX_UPLOAD_SIZE"]
+    too_large = ["Le fichier dépasse la taille maximale autorisée ({0} octets).".format(max_size)]
+    if request.content_length is not None and request.content_length > max_size:
+        return json_errors(too_large, 413)
+
+    # Le fichier est copié par blocs sur le disque, sans être chargé en mémoire.
+    suffix = ".gz" if request.headers.get("Content-Encoding") == "gzip" else ""
+    size = 0
+    with tempfile.NamedTemporaryFile(prefix="annopy-import-", suffix=suffix, delete=False) as f:
+        for block in iter(lambda: request.stream.read(1024 * 1024), b""):
+            size += len(block)
+            if size > max_size:
+                break
+            f.write(block)
+        path = f.name
+    if size > max_size:
+        os.remove(path)
+        return json_errors(too_large, 413)
+
+    job = submit_annotation_import_job(collection, current_user, path, import_format)
+
+    response = api_jsonify(job.to_json_api())
+    response.status_code = 202
+    response.headers["Location"] = url_for("api_job", job_id=job.import_job_id, _external=True)
     return response
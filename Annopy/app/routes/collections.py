@@ -1,9 +1,12 @@
-from flask import render_template, request, flash, redirect, json
+from flask import render_template, request, flash, redirect, jsonify, url_for
 from flask_login import current_user, login_required
 
-from ..app import app
+from ..app import app, http_cache
 from ..modeles.data import *
-from ..img_extractors.flickr_api_extractor import photoset_flickr_query
+from ..modeles.jobs import submit_import_job
+from ..modeles.pagination import keyset_paginate, cached_count
+from ..modeles.search import search_collections
+from ..img_extractors.flickr_api_extractor import photoset_flickr_stream, photoset_flickr_url
 from ..img_extractors.iiif_extractor import iiif_query
 
 """
@@ -36,6 +39,45 @@ def create_collection():
     return render_template("pages/create_collection.html")
 
 
+def start_import(collection, category, source, producer):
+    """ Associe une collection nouvellement créée à son auteur-ice et à sa catégorie,
+    puis lance l'import de ses images en arrière-plan.
+    L'utilisateur-ice est redirigé-e vers la collection sans attendre la fin de l'import.
+
+    :param collection: collection nouvellement créée
+    :type collection: Collection
+    :param category: catégorie choisie par l'utilisateur-ice
+    :type category: Category
+    :param source: source des images ("iiif" ou "flickr")
+    :type source: str
+    :param producer: fonction qui récupère les URL des images, exécutée par l'import
+    :type producer: callable
+    :return: redirection vers la collection
+    :rtype: response object
+    """
+
+    # On associe l'utilisateur-ice à la collection qu'il/elle vient de créer avec la table AuthorshipCollection.
+    db.session.add(AuthorshipCollection(
+        collection=collection,
+        user=current_user
+    ))
+
+    # On associe la collection à la catégorie choisie par l'utilisateur.ice.
+    db.session.add(CollectionHasCategories(
+        collection=collection,
+        category=category
+    ))
+
+    # On crée l'import (le commit enregistre aussi l'authorship et la catégorie) et on le place dans la file d'attente.
+    job = submit_import_job(collection, current_user, source, producer)
+
+    flash("Collection créée avec succès. L'import des images est en cours (tâche n°{0}), "
+          "son avancement est disponible ici : {1}".format(
+              job.import_job_id, url_for("api_job", job_id=job.import_job_id, _external=True)
+          ), "success")
+    return redirect(url_for("collection", collection_id=collection.collection_id))
+
+
 @app.route("/create_collection_flickr_api", methods=["POST", "GET"])
 @login_required
 def create_collection_with_flickr():
@@ -74,87 +116,51 @@ def create_collection_with_flickr():
             flash("Il manque des informations pour récupérer les images depuis Flickr.", "error")
             return redirect("/create_collection_flickr_api")
 
-        # Si tous les paramètres nécessaires à la fonction photoset_flickr_query sont présents,
-        # on stocke la liste d'URL dans imgs_url, et le lien de l'album dans url_query.
-        url_query, imgs_url = photoset_flickr_query(api_key, album_id, flickr_user_id)
-
-        # Il est possible qu'il y ait une erreur lors de la récupération des images.
-        # (API key erronée, user ID inexistant, etc.). Dans ce cas, on envoie un message d'erreur avec flash() et
-        # on redirige l'utilisateur-ice vers un nouveau formulaire de création.
-        if not imgs_url:
-            flash(
-                "Il y a eu une erreur dans la récupération des images via l'API Flickr, vérifiez les informations fournies.",
-                "error")
-            return redirect("/create_collection_flickr_api")
+        # On stocke le lien de l'album dans url_query.
+        url_query = photoset_flickr_url(api_key, album_id, flickr_user_id)
 
         # On fait une recherche filtrée pour récupérer la catégorie choisie par l'utilisateur-ice.
         # ("%" + chosen_category + "%") permet de donner de la souplesse à ce système en le rendant insensible
         # à la casse.
-        category_check = Category.query.filter(Category.name.like("%" + chosen_category + "%")).count()
+        category = Category.query.filter(Category.name.like("%" + chosen_category + "%")).first()
 
-        # Si la requête n'a pas compté de catégorie semblable, cela signifie que la catégorie n'existe pas.
+        # Si la requête n'a pas renvoyé de catégorie semblable, cela signifie que la catégorie n'existe pas.
         # La création de collection est impossible.
         # On envoie un message au template avec flash() pour informer l'utilisateur-ice.
-        if category_check == 0:
+        if category is None:
             flash("Vous n'avez pas entré de catégorie ou celle-ci n'existe pas.", "error")
             return redirect("/create_collection_flickr_api")
 
-        # S'il y a au moins un résultat, on fait une nouvelle requête et on stocke le premier objet donné par la
-        # requête dans category.
-        else:
-            category = Category.query.filter(Category.name.like("%" + chosen_category + "%")).first()
-
-            # On lance la création de la nouvelle collection avec la méthode .create()
-            status, data = Collection.create(
-                collection_name=request.form.get("collection_name", None),
-                collection_description=request.form.get("collection_description", None),
-                collection_source=url_query
-            )
-
-            # On arrête le processus de création de collection si la méthode a retourné False.
-            if status is False:
-                flash("Erreur : " + ", ".join(data), "error")
-                return render_template("pages/create_collection_with_flickr.html", categories=categories)
-
-            # On récupère la dernière collection en base, celle qui vient d'être créée.
-            collection = Collection.query.order_by(Collection.collection_id.desc()).limit(1).first()
+        # On lance la création de la nouvelle collection avec la méthode .create()
+        status, data = Collection.create(
+            collection_name=request.form.get("collection_name", None),
+            collection_description=request.form.get("collection_description", None),
+            collection_source=url_query
+        )
 
-            # On associe l'utilisateur-ice à la collection qu'il/elle vient de créer avec la table AuthorshipCollection.
-            authorship = AuthorshipCollection(
-                collection=collection,
-                user=current_user
-            )
-            db.session.add(authorship)
-            db.session.commit()
+        # On arrête le processus de création de collection si la méthode a retourné False.
+        if status is False:
+            flash("Erreur : " + ", ".join(data), "error")
+            return render_template("pages/create_collection_with_flickr.html", categories=categories)
 
-            # On associe la collection à la catégorie choisie par l'utilisateur.ice.
-            collection_has_categories = CollectionHasCategories(
-                collection=collection,
-                category=category
+        # Les images sont récupérées en arrière-plan avec la fonction photoset_flickr_stream.
+        # Les URL des images sont lues en flux, pendant leur enregistrement en base.
+        # Il est possible qu'il y ait une erreur lors de la récupération des images
+        # (API key erronée, user ID inexistant, page de l'album indisponible, etc.) :
+        # l'erreur est alors enregistrée dans l'import, et la collection est supprimée.
+        max_workers = app.config["URL_VALIDATION_WORKERS"]
+        timeout = app.config["URL_VALIDATION_TIMEOUT"]
+
+        def producer():
+            flickr_data = photoset_flickr_stream(
+                api_key, album_id, flickr_user_id, max_workers=max_workers, timeout=timeout, cache=http_cache
             )
-            db.session.add(collection_has_categories)
-            db.session.commit()
-
-            # On itère sur les URL contenues dans imgs_url pour les stocker en base.
-            # Cela servira à les afficher lorsqu'il sera question de les annoter.
-            for url in imgs_url:
-                Image.create(
-                    image_url=url
-                )
-
-                img = Image.query.order_by(Image.image_id.desc()).limit(1).first()
-
-                collection_has_images = CollectionHasImages(
-                    collection=collection,
-                    image=img
-                )
-
-                db.session.add(collection_has_images)
-                db.session.commit()
+            if not flickr_data:
+                return False
+            url_query, imgs_url, total = flickr_data
+            return imgs_url, total
 
-            if status is True:
-                flash("Collection créée avec succès, vous pouvez dès à présent commencer l'annotation", "success")
-                return redirect("/")
+        return start_import(data, category, "flickr", producer)
     return render_template("pages/create_collection_with_flickr.html", categories=categories)
 
 
@@ -197,88 +203,56 @@ def create_collection_with_iiif():
             flash("Il manque des informations pour récupérer les images.")
             return redirect("/create_collection_iiif", "error")
 
-        # Si tous les paramètres nécessaires à la fonction iiif_query sont présents,
-        # on stocke la liste d'URL dans imgs_url
-        imgs_url = iiif_query(manifest_iiif, from_f, to_f)
-
-        # Il est possible qu'il y ait une erreur lors de la récupération des images
-        # (lien invalide, serveur iiif indisponible, manifest non libre de droits, pas d'entiers pour l'intervalle).
-        # Dans ce cas, on envoie un message d'erreur avec flash() et
+        # Les bornes de l'intervalle doivent être des entiers.
+        # Le cas contraire, on envoie un message d'erreur avec flash() et
         # on redirige l'utilisateur-ice vers un nouveau formulaire de création.
-        if not imgs_url:
-            flash(
-                "Il y a eu une erreur dans la récupération des images. Il se peut que votre lien soit invalide, que le serveur que vous essayez de consulter est indisponible, que le manifest IIIF n'est pas libre de droits, ou que vous n'ayez pas entré d'entiers pour l'intervalle.",
-                "error")
+        try:
+            int(from_f)
+            int(to_f)
+        except ValueError:
+            flash("Vous n'avez pas entré d'entiers pour l'intervalle.", "error")
             return redirect("/create_collection_iiif")
 
         # On fait une recherche filtrée pour récupérer la catégorie choisie par l'utilisateur-ice.
         # ("%" + chosen_category + "%") permet de donner de la souplesse à ce système en le rendant insensible
         # à la casse.
-        category_check = Category.query.filter(Category.name.like("%" + chosen_category + "%")).count()
+        category = Category.query.filter(Category.name.like("%" + chosen_category + "%")).first()
 
-        # Si la requête n'a pas compté de catégorie semblable, cela signifie que la catégorie n'existe pas.
+        # Si la requête n'a pas renvoyé de catégorie semblable, cela signifie que la catégorie n'existe pas.
         # La création de collection est impossible.
         # On envoie un message au template avec flash() pour informer l'utilisateur-ice.
-        if category_check == 0:
+        if category is None:
             flash("Vous n'avez pas entré de catégorie ou celle-ci n'existe pas.", "error")
             return redirect("/create_collection_iiif")
 
-        # S'il y a au moins un résultat, on fait une nouvelle requête et on stocke le premier objet donné par la
-        # requête dans category.
-        else:
-            category = Category.query.filter(Category.name.like("%" + chosen_category + "%")).first()
-
-            # On lance la création de la nouvelle collection avec la méthode .create()
-            status, data = Collection.create(
-                collection_name=request.form.get("collection_name", None),
-                collection_description=request.form.get("collection_description", None),
-                collection_source=manifest_iiif
-            )
-
-            # On arrête le processus de création de collection si la méthode a retourné False.
-            if status is False:
-                flash("Erreur : " + ", ".join(data), "error")
-                return render_template("pages/create_collection_with_iiif.html", categories=categories)
-
-            # On récupère la dernière collection en base, celle qui vient d'être créée.
-            collection = Collection.query.order_by(Collection.collection_id.desc()).limit(1).first()
+        # On lance la création de la nouvelle collection avec la méthode .create()
+        status, data = Collection.create(
+            collection_name=request.form.get("collection_name", None),
+            collection_description=request.form.get("collection_description", None),
+            collection_source=manifest_iiif
+        )
 
-            # On associe l'utilisateur à la collection qu'il vient de créer avec la table AuthorshipCollection.
-            authorship = AuthorshipCollection(
-                collection=collection,
-                user=current_user
-            )
-            db.session.add(authorship)
-            db.session.commit()
+        # On arrête le processus de création de collection si la méthode a retourné False.
+        if status is False:
+            flash("Erreur : " + ", ".join(data), "error")
+            return render_template("pages/create_collection_with_iiif.html", categories=categories)
 
-            # On associe la collection à la catégorie choisie par l'utilisateur.ice.
-            collection_has_categories = CollectionHasCategories(
-                collection=collection,
-                category=category
+        # Les images sont récupérées en arrière-plan avec la fonction iiif_query.
+        # Il est possible qu'il y ait une erreur lors de la récupération des images
+        # (lien invalide, serveur iiif indisponible, manifest non libre de droits) :
+        # l'erreur est alors enregistrée dans l'import, et la collection est supprimée.
+        # Les dimensions et le service IIIF des images décrits par le manifest sont enregistrés avec les images.
+        def producer():
+            metadata = {}
+            imgs_url = iiif_query(
+                manifest_iiif, from_f, to_f, cache=http_cache, metadata=metadata,
+                timeout=app.config["IIIF_MANIFEST_TIMEOUT"]
             )
-            db.session.add(collection_has_categories)
-            db.session.commit()
-
-            # On itère sur les URL contenues dans imgs_url pour les stocker en base.
-            # Cela servira à les afficher lorsqu'il sera question de les annoter.
-            for url in imgs_url:
-                Image.create(
-                    image_url=url
-                )
+            if not imgs_url:
+                return False
+            return imgs_url, len(imgs_url), metadata
 
-                img = Image.query.order_by(Image.image_id.desc()).limit(1).first()
-
-                collection_has_images = CollectionHasImages(
-                    collection=collection,
-                    image=img
-                )
-
-                db.session.add(collection_has_images)
-                db.session.commit()
-
-            if status is True:
-                flash("Collection créée avec succès, vous pouvez dès à présent commencer l'annotation", "success")
-                return redirect("/")
+        return start_import(data, category, "iiif", producer)
     return render_template("pages/create_collection_with_iiif.html", categories=categories)
 
 
@@ -390,24 +364,23 @@ def search():
 
     # On récupère le mot-clé envoyé par l'utilisateur-ice avec la méthode HTTP GET via le template.
     keyword = request.args.get("keyword", None)
-    page = request.args.get("page", 1)
-
-    if isinstance(page, str) and page.isdigit():
-        page = int(page)
-    else:
-        page = 1
+    # cursor est le curseur de la page demandée (voir modeles/pagination.py).
+    cursor = request.args.get("cursor", None)
 
     results = []
 
-    # Si l'utilisateur-ice a entré un terme de recherche, on exécute une requête filtrée par ledit terme.
+    # Si l'utilisateur-ice a entré un terme de recherche, on recherche ledit terme dans l'index plein texte
+    # (nom, description et annotations des collections). Les résultats sont triés par pertinence.
     if keyword:
-        # On pagine la requête
-        results = Collection.query.filter(
-            Collection.collection_name.like("%{}%".format(keyword))
-        ).paginate(page=page, per_page=5)
+        query, rank = search_collections(keyword)
+        # On pagine la requête par curseur, et on récupère le nombre total de résultats depuis le cache.
+        results = keyset_paginate(
+            query, Collection.collection_id, cursor=cursor, per_page=5, fallback=True, rank=rank
+        )
+        results.total = cached_count(query, "collection", keyword, app.config["PAGINATION_COUNT_TTL"])
         titre = "Résultat pour la recherche `" + keyword + "`"
 
-        return render_template("pages/search.html", results=results, titre=titre)
+        return render_template("pages/search.html", results=results, titre=titre, keyword=keyword)
 
     # Autrement, on redirige l'utilisateur-ice vers l'accueil en l'informant qu'il n'y avait rien à rechercher.
     else:
@@ -423,15 +396,12 @@ def browse_collections():
     :rtype: template
     """
 
-    page = request.args.get("page", 1)
+    cursor = request.args.get("cursor", None)
 
-    if isinstance(page, str) and page.isdigit():
-        page = int(page)
-    else:
-        page = 1
-
-    # On pagine les objets présents en table Collection.
-    resultats = Collection.query.paginate(page=page, per_page=5)
+    # On pagine les objets présents en table Collection par curseur : la page est lue à partir de l'ID
+    # de la dernière collection de la page précédente. Le nombre total de collections est gardé en cache.
+    resultats = keyset_paginate(Collection.query, Collection.collection_id, cursor=cursor, per_page=5, fallback=True)
+    resultats.total = cached_count(Collection.query, "collection", ttl=app.config["PAGINATION_COUNT_TTL"])
 
     return render_template("pages/browse_collections.html", resultats=resultats)
 
@@ -459,19 +429,43 @@ def collection(collection_id):
     if collection is None:
         return render_template("errors/404.html"), 404
 
-    # On récupère l'association entre User et la Collection
-    authorships = Collection.query.get(collection_id).collection_authorship
-    # On récupère l'association entre Category et Collection
-    categories = Collection.query.get(collection_id).has_categories
-    # On récupère l'association entre Collection et Image
-    imgs = Collection.query.get(collection_id).has_images
+    # On récupère l'association entre User et la Collection, avec les utilisateur-ices, en une requête.
+    authorships = AuthorshipCollection.query.options(db.joinedload(AuthorshipCollection.user)).filter(
+        AuthorshipCollection.authorship_collection_collection_id == collection_id
+    ).all()
+    # On récupère l'association entre Category et Collection, avec les catégories, en une requête.
+    categories = CollectionHasCategories.query.options(db.joinedload(CollectionHasCategories.category)).filter(
+        CollectionHasCategories.collection_id == collection_id
+    ).all()
+    # On récupère l'association entre Collection et Image, avec les images, en une requête.
+    imgs = CollectionHasImages.query.options(db.joinedload(CollectionHasImages.image)).filter(
+        CollectionHasImages.collection_has_images_collection_id == collection_id
+    ).order_by(CollectionHasImages.collection_has_images_id).all()
+
+    # Les images de la collection qui ont au moins une annotation sont connues par leur nombre d'annotations,
+    # et les images que l'utilisateur-ice courant-e a déjà annotées sont lues en une requête dans la table
+    # image_annotator : le template n'a pas besoin d'interroger la base, et les annotations ne sont pas lues.
+    images_with_annotations = set()
+    annotated_image_ids = set()
 
     # On informe l'utilisateur-ice non connecté-e qu'il/elle ne peut pas interagir avec les images en étant déconnecté-é
     if current_user.is_authenticated is not True:
         flash("Vous devez vous connecter pour pouvoir voir et annoter les images de cette collection.", 'info')
+    else:
+        images_with_annotations = {img.image.image_id for img in imgs if img.image.image_annotation_count > 0}
+        annotated_image_ids = {
+            image_id for image_id, in db.session.query(ImageAnnotator.image_annotator_image_id).join(
+                CollectionHasImages,
+                CollectionHasImages.collection_has_images_image_id == ImageAnnotator.image_annotator_image_id
+            ).filter(
+                CollectionHasImages.collection_has_images_collection_id == collection_id,
+                ImageAnnotator.image_annotator_user_id == current_user.user_id
+            )
+        }
 
     return render_template("pages/collection.html", collection=collection, authorships=authorships,
-                           categories=categories, imgs=imgs, Annotation=Annotation, AuthorshipAnnotation=AuthorshipAnnotation, db=db)
+                           categories=categories, imgs=imgs, images_with_annotations=images_with_annotations,
+                           annotated_image_ids=annotated_image_ids)
 
 
 @app.route("/viewer/collection/<int:collection_id>/image/<int:image_id>", methods=['POST', 'GET'])
@@ -486,25 +480,22 @@ def viewer(collection_id, image_id):
     :rtype: template
     """
 
-    # On récupère les annotations de l'image que l'utilisateur-ice souhaite annoter, s'il y en a déjà
-    imgs_annotations = Image.query.get(image_id).annotation
-
-    # Si des annotations ont été récupérées, on vérifie que l'utilisateur-ice courrant-e n'est pas à l'origine
-    # de ces annotations.
-    if imgs_annotations:
-        for annotation in imgs_annotations:
-            check = AuthorshipAnnotation.query.filter(db.and_(
-                AuthorshipAnnotation.authorship_annotation_annotation_id == annotation.annotation_id,
-                AuthorshipAnnotation.authorship_annotation_user_id == current_user.user_id)
-                ).first()
-
-            # Si la requete précédente a renvoyé un objet, alors l'utilisateur-ice a déjà annoté l'image.
-            # la variable check, dans ce cas, est True.
-            # On redirige l'utilisateur-ice vers la collection en lui indiquant qu'il/elle a déjà annoté l'image
-            if check:
-                flash("Vous avez déjà annoté l'image que vous essayez de consulter.", 'info')
-                return redirect("/collection/" + str(collection_id))
-            # Avec ce système, une utilisateur-ice ne peut annoter une image qu'une seule fois
+    # On vérifie, en une requête, que l'utilisateur-ice courrant-e n'est pas à l'origine d'une des annotations
+    # de l'image qu'il/elle souhaite annoter.
+    check = AuthorshipAnnotation.query.join(
+        Annotation, AuthorshipAnnotation.authorship_annotation_annotation_id == Annotation.annotation_id
+    ).filter(
+        Annotation.annotation_image_id == image_id,
+        AuthorshipAnnotation.authorship_annotation_user_id == current_user.user_id
+    ).first()
+
+    # Si la requete précédente a renvoyé un objet, alors l'utilisateur-ice a déjà annoté l'image.
+    # la variable check, dans ce cas, est True.
+    # On redirige l'utilisateur-ice vers la collection en lui indiquant qu'il/elle a déjà annoté l'image
+    if check:
+        flash("Vous avez déjà annoté l'image que vous essayez de consulter.", 'info')
+        return redirect("/collection/" + str(collection_id))
+    # Avec ce système, une utilisateur-ice ne peut annoter une image qu'une seule fois
 
     # On récupère l'image qui va être annotée avec son ID.
     img = Image.query.get(image_id)
@@ -524,45 +515,31 @@ def viewer(collection_id, image_id):
     # Si la méthode HTTP est POST, alors l'utilisateur-ice a envoyé ses annotations et la requête AJAX a été lancée.
     if request.method == 'POST':
         # on récupère les annotations envoyées avec la requete AJAX.
-        annotations = request.json
-        # On vérifie qu'il y a un objet à traiter.
-        if annotations:
-            # La requête AJAX envoie une liste de valeurs, chaque index étant une annotation.
-            # Pour enregistrer chaque index dans la liste, on itère dessus.
-            for annotation in annotations:
-                # On crée l'annotation en lui associant l'image
-                annotation_to_be_added = Annotation(
-                    # On transforme le dictionnaire annotation en une chaine de caractère formatée JSON.
-                    annotation_json=json.dumps(annotation),
-                    image=img
-                )
-
-                # On ajoute l'annotation pour le transport vers la base de données
-                db.session.add(annotation_to_be_added)
-                # On commit
-                db.session.commit()
-
-                # On récupère la dernière annotation créée en base
-                new_annotation = Annotation.query.order_by(Annotation.annotation_id.desc()).limit(1).first()
-
-                # On l'associe pour l'authorship avec l'utilisateur-ice courant-e
-                authorship_annotation = AuthorshipAnnotation(
-                    user=current_user,
-                    annotation=new_annotation
-                )
-
-                # On ajoute l'authorship pour le transport vers la base de données
-                db.session.add(authorship_annotation)
-                # On commit
-                db.session.commit()
-
-        # On envoie un message au template avec flash(), indiquant que l'annotation a été enregistrée.
-        # Ce système possède un bug, non gênant dans le fonctionnement de l'application :
-        # le message envoyé avec flash() apparaît quand l'utilisateur-ice a envoyé des annotations au serveur
-        # et apparaît également si aucune annotation n'a été envoyée (donc aucun enregistrement en base).
-        # La mise en place d'un if côté JavaScript n'a pas fonctionné. Après des recherches, il est possible que cela
-        # soit causé par la nature asynchrone de la requête AJAX.
-        flash("l'annotation a bien été enregistrée !", "success")
-        return redirect("/collection/" + str(collection_id))
+        annotations = request.get_json(silent=True)
+
+        # Sans données JSON (formulaire envoyé sans JavaScript), on redirige vers la collection.
+        if annotations is None:
+            return redirect("/collection/" + str(collection_id))
+
+        # La requête AJAX envoie une liste de valeurs, chaque index étant une annotation.
+        # Toutes les annotations et leurs authorships sont enregistrées en une seule transaction.
+        status, data = Annotation.create_batch(img, current_user, annotations)
+
+        if status is False:
+            response = jsonify({"erreurs": data})
+            response.status_code = 400
+            return response
+
+        # On envoie un message au template avec flash(), indiquant que les annotations ont été enregistrées.
+        # Le message s'affiche sur la page de la collection, vers laquelle le JavaScript redirige
+        # l'utilisateur-ice avec l'URL renvoyée.
+        if data:
+            flash("l'annotation a bien été enregistrée !", "success")
+        response = jsonify({
+            "annotations": data,
+            "redirect": url_for("collection", collection_id=collection_id)
+        })
+        response.status_code = 201
+        return response
 
     return render_template("pages/viewer_annotations.html", img=img, collection_id=collection_id)
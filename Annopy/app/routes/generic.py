@@ -4,6 +4,7 @@ from flask_login import current_user, login_user, logout_user, login_required
 from ..app import app, login
 from ..modeles.data import *
 from ..modeles.users import User
+from ..modeles.pagination import keyset_paginate, cached_count
 
 """
 Routes gérant les aspects utilisateur de l'app:
@@ -206,17 +207,13 @@ def community():
     :rtype: template
     """
 
-    page = request.args.get("page", 1)
+    cursor = request.args.get("cursor", None)
 
-    if isinstance(page, str) and page.isdigit():
-        page = int(page)
-    else:
-        page = 1
-
-    # .paginate() permet de paginer le résultat de la requête selon les deux paramètres page et per_page.
-    # page étant le numéro de la page.
+    # keyset_paginate() permet de paginer le résultat de la requête selon les deux paramètres cursor et per_page.
+    # cursor étant le curseur de la page demandée (None pour la première page).
     # per_page étant le nombre de résultats par page.
-    resultats = User.query.paginate(page=page, per_page=8)
+    resultats = keyset_paginate(User.query, User.user_id, cursor=cursor, per_page=8, fallback=True)
+    resultats.total = cached_count(User.query, "user", ttl=app.config["PAGINATION_COUNT_TTL"])
 
     return render_template("pages/community.html", resultats=resultats)
 
@@ -0,0 +1,54 @@
+from flask import redirect, render_template, request, send_file
+from flask_login import login_required
+
+from ..app import app, derivative_cache
+from ..img_extractors.derivative_cache import derivative_url
+from ..modeles.data import Image
+
+"""
+Routes servant les images des collections depuis le cache local des dérivés :
+/image/<int:image_id>/thumbnail
+/image/<int:image_id>/viewer
+"""
+
+
+@app.route("/image/<int:image_id>/<rendition>")
+@login_required
+def image_derivative(image_id, rendition):
+    """ Route renvoyant une image depuis le cache local des dérivés : une vignette (thumbnail), demandée à la source
+    en taille réduite, ou l'image de la visionneuse (viewer).
+    L'image de la visionneuse garde les dimensions de l'image d'origine : les coordonnées des annotations
+    sont exprimées dans ces dimensions.
+    Si le dérivé ne peut pas être mis en cache (source injoignable, image trop lourde, cache désactivé),
+    l'utilisateur-ice est redirigé-e vers la source du dérivé.
+
+    :param image_id: ID de l'image
+    :type image_id: int
+    :param rendition: "thumbnail" ou "viewer"
+    :type rendition: str
+    :return: image, ou redirection vers la source du dérivé
+    :rtype: response object
+    """
+
+    widths = {"thumbnail": app.config["DERIVATIVE_THUMBNAIL_WIDTH"], "viewer": None}
+    image = Image.query.get(image_id) if rendition in widths else None
+    if image is None:
+        return render_template("errors/404.html"), 404
+
+    url = derivative_url(image.image_url, widths[rendition], image.image_service, image.image_width)
+    cached = derivative_cache.get(url)
+    if cached is None:
+        return redirect(url)
+
+    # L'URL d'un dérivé renvoie toujours le même contenu : il peut être gardé longtemps par le navigateur,
+    # mais pas par un cache partagé, les images n'étant visibles que par les utilisateur-ices connecté-es.
+    # L'ETag est l'empreinte du contenu.
+    digest, path, content_type = cached
+    response = send_file(
+        path, mimetype=content_type or "image/jpeg", add_etags=False,
+        cache_timeout=app.config["DERIVATIVE_CACHE_MAX_AGE"]
+    )
+    response.set_etag(digest)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response.make_conditional(request)
@@ -0,0 +1,99 @@
+""" Mesure du temps de sérialisation des annotations renvoyées par l'API.
+
+Compare, sur des annotations générées au format Annotorious :
+- json.loads() puis json.dumps() de chaque annotation (ancien fonctionnement de Annotation.to_json_api()) ;
+- l'insertion telle quelle des annotations stockées (RawJSON) avec dumps_api() ;
+- le même export avec orjson, s'il est installé.
+
+Utilisation, depuis le dossier Annopy :
+    python benchmarks/bench_annotation_json.py [nombre d'annotations] [nombre de répétitions]
+"""
+
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.modeles.json_export import RawJSON, dumps_api, orjson
+
+
+def make_annotation(number):
+    """ Génère une annotation au format Web Annotation, comme celles produites par Annotorious.
+
+    :param number: numéro de l'annotation
+    :type number: int
+    :return: annotation
+    :rtype: dict
+    """
+
+    return {
+        "type": "Annotation",
+        "body": [
+            {"type": "TextualBody", "value": "Annotation n°{0}".format(number), "purpose": "commenting"},
+            {"type": "TextualBody", "value": "étiquette", "purpose": "tagging"}
+        ],
+        "target": {
+            "source": "https://live.staticflickr.com/65535/{0}_b.jpg".format(number),
+            "selector": {
+                "type": "FragmentSelector",
+                "conformsTo": "http://www.w3.org/TR/media-frags/",
+                "value": "xywh=pixel:{0},{1},120,80".format(number % 800, number % 600)
+            }
+        },
+        "@context": "http://www.w3.org/ns/anno.jsonld",
+        "id": "#{0:032x}".format(number)
+    }
+
+
+def make_payload(stored, wrap):
+    """ Construit une réponse de l'API semblable à celle d'une collection, à partir des annotations stockées.
+
+    :param stored: annotations, telles qu'enregistrées en base (chaînes de caractères)
+    :type stored: list
+    :param wrap: fonction appliquée à chaque annotation stockée (json.loads ou RawJSON)
+    :type wrap: callable
+    :return: données à sérialiser
+    :rtype: dict
+    """
+
+    return {
+        "type": "collection",
+        "images": [
+            {
+                "type": "annotation",
+                "attributes": {"id": number, "annotation_json": [wrap(text)]}
+            }
+            for number, text in enumerate(stored)
+        ]
+    }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    stored = [json.dumps(make_annotation(number), separators=(",", ":")) for number in range(count)]
+
+    cases = [
+        ("json.loads + json.dumps", lambda: json.dumps(make_payload(stored, json.loads), separators=(",", ":"))),
+        ("RawJSON + dumps_api (json)", lambda: dumps_api(make_payload(stored, RawJSON))),
+    ]
+    if orjson is not None:
+        cases.append(("RawJSON + dumps_api (orjson)", lambda: dumps_api(make_payload(stored, RawJSON), backend="orjson")))
+    else:
+        print("orjson n'est pas installé : le cas orjson est ignoré.")
+
+    # On vérifie que toutes les méthodes produisent le même JSON.
+    reference = json.loads(cases[0][1]())
+    for name, function in cases[1:]:
+        assert json.loads(function()) == reference, name
+
+    print("{0} annotations, meilleur temps sur {1} répétitions :".format(count, repeat))
+    for name, function in cases:
+        best = min(timeit.repeat(function, number=1, repeat=repeat))
+        print("  {0:<32} {1:8.1f} ms  {2:10.0f} annotations/s".format(name, best * 1000, count / best))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+""" Mesure du temps des recherches par clé étrangère, avant et après la migration des index.
+
+Une base SQLite temporaire est remplie avec des annotations, leurs authorships, des images et leurs associations
+aux collections. Les requêtes utilisées par les pages collection et viewer sont chronométrées sans index,
+puis après create_missing_indexes() (migration 1).
+
+Utilisation, depuis le dossier Annopy :
+    python benchmarks/bench_indexes.py [nombre d'annotations] [nombre de requêtes]
+"""
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.app import db
+from app.modeles.data import AuthorshipAnnotation, CollectionHasImages
+from app.modeles.migrations import create_missing_indexes
+
+# Nombre d'annotations par image, d'images par collection et d'utilisateur-ices.
+ANNOTATIONS_PER_IMAGE = 10
+IMAGES_PER_COLLECTION = 1000
+USERS = 100
+
+
+def fill(path, count):
+    """ Remplit la base avec count annotations et les lignes associées.
+
+    :param path: chemin de la base SQLite
+    :type path: str
+    :param count: nombre d'annotations
+    :type count: int
+    """
+
+    images = max(count // ANNOTATIONS_PER_IMAGE, 1)
+    connection = sqlite3.connect(path)
+    connection.executemany(
+        "INSERT INTO image (image_id, image_url) VALUES (?, ?)",
+        ((image_id, "https://example.org/{0}.jpg".format(image_id)) for image_id in range(1, images + 1))
+    )
+    connection.executemany(
+        "INSERT INTO {0} (collection_has_images_collection_id, collection_has_images_image_id) VALUES (?, ?)".format(
+            CollectionHasImages.__tablename__
+        ),
+        ((image_id // IMAGES_PER_COLLECTION + 1, image_id) for image_id in range(1, images + 1))
+    )
+    connection.executemany(
+        "INSERT INTO annotation (annotation_id, annotation_json, annotation_image_id) VALUES (?, ?, ?)",
+        ((annotation_id, '{"type":"Annotation"}', annotation_id % images + 1) for annotation_id in range(1, count + 1))
+    )
+    connection.executemany(
+        "INSERT INTO {0} (authorship_annotation_user_id, authorship_annotation_annotation_id) VALUES (?, ?)".format(
+            AuthorshipAnnotation.__tablename__
+        ),
+        ((annotation_id % USERS + 1, annotation_id) for annotation_id in range(1, count + 1))
+    )
+    connection.commit()
+    connection.close()
+
+
+def lookups(path, count, queries):
+    """ Chronomètre les requêtes de recherche par clé étrangère.
+
+    :param path: chemin de la base SQLite
+    :type path: str
+    :param count: nombre d'annotations de la base
+    :type count: int
+    :param queries: nombre de requêtes par cas
+    :type queries: int
+    :return: durée moyenne (en millisecondes) de chaque cas
+    :rtype: dict
+    """
+
+    images = max(count // ANNOTATIONS_PER_IMAGE, 1)
+    collections = images // IMAGES_PER_COLLECTION + 1
+    cases = {
+        "authorship d'une annotation": (
+            "SELECT 1 FROM {0} WHERE authorship_annotation_annotation_id = ? "
+            "AND authorship_annotation_user_id = ?".format(AuthorshipAnnotation.__tablename__),
+            lambda: (random.randint(1, count), random.randint(1, USERS))
+        ),
+        "annotations d'une image": (
+            "SELECT annotation_id FROM annotation WHERE annotation_image_id = ?",
+            lambda: (random.randint(1, images),)
+        ),
+        "images d'une collection": (
+            "SELECT collection_has_images_image_id FROM {0} "
+            "WHERE collection_has_images_collection_id = ?".format(CollectionHasImages.__tablename__),
+            lambda: (random.randint(1, collections),)
+        ),
+        "collection d'une image": (
+            "SELECT collection_has_images_collection_id FROM {0} "
+            "WHERE collection_has_images_image_id = ?".format(CollectionHasImages.__tablename__),
+            lambda: (random.randint(1, images),)
+        ),
+    }
+
+    connection = sqlite3.connect(path)
+    results = {}
+    for name, (statement, parameters) in cases.items():
+        random.seed(0)
+        start = time.perf_counter()
+        for _ in range(queries):
+            connection.execute(statement, parameters()).fetchall()
+        results[name] = (time.perf_counter() - start) * 1000 / queries
+    connection.close()
+    return results
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    queries = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "bench_indexes.sqlite")
+    engine = create_engine("sqlite:///" + path)
+
+    # On crée les tables, puis on supprime les index : la base est alors dans l'état des bases existantes.
+    db.metadata.create_all(engine)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(engine)
+
+    start = time.perf_counter()
+    fill(path, count)
+    print("{0} annotations insérées en {1:.1f} s".format(count, time.perf_counter() - start))
+
+    before = lookups(path, count, queries)
+
+    start = time.perf_counter()
+    with engine.connect() as connection:
+        create_missing_indexes(connection)
+    print("Index créés en {0:.1f} s".format(time.perf_counter() - start))
+
+    after = lookups(path, count, queries)
+
+    print("Durée moyenne d'une requête ({0} requêtes par cas) :".format(queries))
+    for name in before:
+        print("  {0:<30} {1:9.3f} ms -> {2:7.3f} ms  (x{3:.0f})".format(
+            name, before[name], after[name], before[name] / max(after[name], 1e-6)
+        ))
+
+    engine.dispose()
+    os.remove(path)
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
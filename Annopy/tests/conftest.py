@@ -0,0 +1,107 @@
+import itertools
+import os
+import sys
+import tempfile
+import warnings
+
+import pytest
+from sqlalchemy import event
+
+# L'application résout les chemins relatifs (base de données, caches) depuis le dossier courant au moment
+# de son import : les tests utilisent une base de développement vide, dans un dossier temporaire.
+os.chdir(tempfile.mkdtemp(prefix="annopy-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+with warnings.catch_warnings():
+    # Le secret par défaut n'a pas à être changé pour les tests.
+    warnings.simplefilter("ignore")
+    from app.app import config_app, db, response_cache
+
+from app.modeles.data import AuthorshipAnnotation, Annotation, Collection, CollectionHasImages, Image
+from app.modeles.users import User
+
+
+# Les noms des collections sont uniques.
+_collection_numbers = itertools.count(1)
+
+
+@pytest.fixture(scope="session")
+def app():
+    """ Application configurée pour le développement, avec une base vide. """
+
+    application = config_app("dev")
+    with application.app_context():
+        yield application
+
+
+@pytest.fixture
+def client(app, user):
+    """ Client de test connecté. Le cache des réponses de l'API est vidé : chaque réponse est sérialisée. """
+
+    response_cache.clear()
+    test_client = app.test_client()
+    response = test_client.post("/sign_in", data={"login": "test", "password": "motdepasse"})
+    assert response.status_code == 302
+    return test_client
+
+
+@pytest.fixture(scope="session")
+def user_id(app):
+    """ ID de l'utilisateur-ice auteur-ice des annotations des tests. """
+
+    status, data = User.create("Test", "Test", "test", "test@example.org", "motdepasse")
+    assert status, data
+    return data.user_id
+
+
+@pytest.fixture
+def user(app, user_id):
+    """ Utilisateur-ice auteur-ice des annotations des tests, rechargé-e à chaque test : la session de la base
+    est fermée à la fin de chaque contexte d'application (commandes flask, par exemple).
+    """
+
+    return User.query.get(user_id)
+
+
+@pytest.fixture
+def make_collection(app, user):
+    """ Crée une collection de n_images images, chacune avec n_annotations annotations. """
+
+    def make(n_images, n_annotations):
+        status, collection = Collection.create(
+            "Collection {0}".format(next(_collection_numbers)), "Description", "https://example.org/manifest.json"
+        )
+        assert status, collection
+        for image_number in range(n_images):
+            image = Image(image_url="https://example.org/{0}/{1}.jpg".format(collection.collection_id, image_number))
+            db.session.add(CollectionHasImages(collection=collection, image=image))
+            for annotation_number in range(n_annotations):
+                annotation = Annotation(image=image, annotation_json=annotation_json(annotation_number))
+                db.session.add(AuthorshipAnnotation(annotation=annotation, user=user))
+        db.session.commit()
+        return collection
+
+    return make
+
+
+@pytest.fixture
+def queries(app):
+    """ Liste des requêtes SQL exécutées pendant le test. """
+
+    executed = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    yield executed
+    event.remove(db.engine, "before_cursor_execute", count)
+
+
+def annotation_json(number):
+    """ JSON d'une annotation W3C rectangulaire. """
+
+    return (
+        '{{"type":"Annotation","body":[{{"type":"TextualBody","value":"note {0}"}}],'
+        '"target":{{"selector":{{"type":"FragmentSelector","value":"xywh=pixel:{0},{0},10,10"}}}}}}'
+    ).format(number)
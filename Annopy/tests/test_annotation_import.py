@@ -0,0 +1,83 @@
+import io
+import json
+import os
+import tempfile
+
+from sqlalchemy import event
+
+from app.app import db
+from app.modeles.annotation_import import import_annotations, iter_units
+from app.modeles.data import Annotation, AuthorshipAnnotation
+
+from conftest import annotation_json
+
+
+def jsonl(image_urls):
+    """ Fichier JSON-Lines d'une annotation par image. """
+
+    lines = []
+    for number, image_url in enumerate(image_urls):
+        annotation = json.loads(annotation_json(number))
+        annotation["target"]["source"] = image_url
+        lines.append(json.dumps(annotation))
+    return io.BytesIO("\n".join(lines).encode("utf-8"))
+
+
+def test_import_with_concurrent_annotation_write(make_collection, user):
+    collection = make_collection(5, 0)
+    image_urls = [link.image.image_url for link in collection.has_images]
+    image_id = collection.has_images[0].collection_has_images_image_id
+    user_id = user.user_id
+
+    # Une annotation est créée par une autre connexion juste avant la première insertion de l'import,
+    # quand l'import n'a pas encore le verrou d'écriture.
+    done = []
+
+    def concurrent_write(conn, cursor, statement, parameters, context, executemany):
+        if not done and statement.startswith("INSERT INTO annotation "):
+            done.append(True)
+            with db.engine.begin() as connection:
+                annotation_id = connection.execute(Annotation.__table__.insert().values(
+                    annotation_image_id=image_id, annotation_json=annotation_json(99)
+                )).inserted_primary_key[0]
+                connection.execute(AuthorshipAnnotation.__table__.insert().values(
+                    authorship_annotation_annotation_id=annotation_id, authorship_annotation_user_id=user_id
+                ))
+
+    event.listen(db.engine, "before_cursor_execute", concurrent_write)
+    try:
+        status, state = import_annotations(
+            iter_units(jsonl(image_urls), "jsonl"), user, collection.collection_id, batch_size=100
+        )
+    finally:
+        event.remove(db.engine, "before_cursor_execute", concurrent_write)
+
+    assert done
+    assert status, state
+    assert state["imported"] == 5
+    # Chaque annotation importée a son authorship.
+    imported = AuthorshipAnnotation.query.join(Annotation).filter(
+        Annotation.annotation_image_id.in_([link.collection_has_images_image_id for link in collection.has_images])
+    ).count()
+    assert imported == 6
+
+
+def import_files():
+    return {name for name in os.listdir(tempfile.gettempdir()) if name.startswith("annopy-import-")}
+
+
+def test_import_upload_size_is_limited(app, client, make_collection):
+    collection = make_collection(1, 0)
+    before = import_files()
+    max_size = app.config["ANNOTATION_IMPORT_MAX_UPLOAD_SIZE"]
+    app.config["ANNOTATION_IMPORT_MAX_UPLOAD_SIZE"] = 100
+    try:
+        response = client.post(
+            "/api/collection/{0}/annotations/import?format=jsonl".format(collection.collection_id),
+            data=b"x" * 101, content_type="application/x-ndjson"
+        )
+    finally:
+        app.config["ANNOTATION_IMPORT_MAX_UPLOAD_SIZE"] = max_size
+
+    assert response.status_code == 413
+    assert import_files() == before
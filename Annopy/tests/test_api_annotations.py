@@ -0,0 +1,114 @@
+import pytest
+
+from app.modeles.data import Annotation
+from app.modeles.users import User
+
+
+ANNOTATION = {"type": "Annotation", "body": [{"type": "TextualBody", "value": "note"}]}
+
+
+@pytest.fixture(scope="module")
+def other_user(app):
+    status, data = User.create("Autre", "Autre", "autre", "autre@example.org", "motdepasse")
+    assert status, data
+    return data.user_id
+
+
+@pytest.fixture
+def other_client(app, other_user):
+    """ Client connecté avec un-e autre utilisateur-ice, qui n'est pas auteur-ice des annotations des tests. """
+
+    test_client = app.test_client()
+    assert test_client.post("/sign_in", data={"login": "autre", "password": "motdepasse"}).status_code == 302
+    return test_client
+
+
+def image_id(collection):
+    return collection.has_images[0].collection_has_images_image_id
+
+
+def test_create_read_update_delete(client, make_collection):
+    collection = make_collection(1, 0)
+
+    response = client.post("/api/image/{0}/annotations".format(image_id(collection)), json=ANNOTATION)
+    assert response.status_code == 201
+    annotation_id = response.get_json()["attributes"]["id"]
+    assert response.headers["Location"].endswith("/api/annotation/{0}".format(annotation_id))
+
+    response = client.get("/api/annotation/{0}".format(annotation_id))
+    assert response.get_json()["attributes"]["annotation_json"] == [ANNOTATION]
+
+    updated = dict(ANNOTATION, body=[{"type": "TextualBody", "value": "modifiée"}])
+    response = client.put("/api/annotation/{0}".format(annotation_id), json=updated)
+    assert response.status_code == 200
+    attributes = response.get_json()["attributes"]
+    assert attributes["annotation_json"] == [updated]
+    # La modification ajoute une édition.
+    assert len(attributes["relationships"]["editions"]) == 2
+
+    response = client.delete("/api/annotation/{0}".format(annotation_id))
+    assert response.get_json() == {"created": [], "updated": [], "deleted": [annotation_id]}
+    assert Annotation.query.get(annotation_id) is None
+    assert client.get("/api/annotation/{0}".format(annotation_id)).status_code == 404
+
+
+def test_bulk_changes(client, make_collection):
+    collection = make_collection(1, 2)
+    first, second = [annotation.annotation_id for annotation in collection.has_images[0].image.annotation]
+
+    response = client.post("/api/image/{0}/annotations/bulk".format(image_id(collection)), json={
+        "create": [ANNOTATION, ANNOTATION],
+        "update": [{"id": first, "annotation": ANNOTATION}],
+        "delete": [second]
+    })
+
+    result = response.get_json()
+    assert response.status_code == 200
+    assert len(result["created"]) == 2
+    assert (result["updated"], result["deleted"]) == ([first], [second])
+    assert Annotation.query.filter_by(annotation_image_id=image_id(collection)).count() == 3
+
+
+def test_invalid_requests(client, make_collection):
+    collection = make_collection(1, 1)
+    annotation_id = collection.has_images[0].image.annotation[0].annotation_id
+    bulk_url = "/api/image/{0}/annotations/bulk".format(image_id(collection))
+
+    assert client.post("/api/image/0/annotations", json=ANNOTATION).status_code == 404
+    assert client.post("/api/image/{0}/annotations".format(image_id(collection)), json=[ANNOTATION]).status_code == 400
+    assert client.put("/api/annotation/{0}".format(annotation_id), data="{").status_code == 400
+    assert client.put("/api/annotation/0", json=ANNOTATION).status_code == 404
+    assert client.post(bulk_url, json={"create": ["texte"]}).status_code == 400
+    assert client.post(bulk_url, json={"delete": [annotation_id], "update": [
+        {"id": annotation_id, "annotation": ANNOTATION}
+    ]}).status_code == 400
+
+    # Une annotation d'une autre image ne peut pas être modifiée depuis cette image ; rien n'est appliqué.
+    other = make_collection(1, 1)
+    other_id = other.has_images[0].image.annotation[0].annotation_id
+    response = client.post(bulk_url, json={"create": [ANNOTATION], "delete": [other_id]})
+    assert response.status_code == 400
+    assert response.get_json()["erreurs"] == ["L'annotation {0} n'existe pas sur cette image.".format(other_id)]
+    assert Annotation.query.filter_by(annotation_image_id=image_id(collection)).count() == 1
+
+
+def test_only_authors_change_annotations(other_client, make_collection):
+    collection = make_collection(1, 1)
+    annotation_id = collection.has_images[0].image.annotation[0].annotation_id
+
+    assert other_client.get("/api/annotation/{0}".format(annotation_id)).status_code == 200
+    assert other_client.put("/api/annotation/{0}".format(annotation_id), json=ANNOTATION).status_code == 403
+    assert other_client.delete("/api/annotation/{0}".format(annotation_id)).status_code == 403
+    response = other_client.post(
+        "/api/image/{0}/annotations/bulk".format(image_id(collection)), json={"delete": [annotation_id]}
+    )
+    assert response.status_code == 400
+    assert Annotation.query.get(annotation_id) is not None
+
+
+def test_login_required(app, make_collection):
+    collection = make_collection(1, 0)
+
+    response = app.test_client().post("/api/image/{0}/annotations".format(image_id(collection)), json=ANNOTATION)
+
+    assert response.status_code == 302
@@ -0,0 +1,59 @@
+from app.app import db
+from app.modeles.data import Annotation, AuthorshipAnnotation
+
+from conftest import annotation_json
+
+
+def collection_url(collection):
+    return "/api/collection/{0}".format(collection.collection_id)
+
+
+def test_cached_response_is_served(client, make_collection):
+    collection = make_collection(2, 1)
+
+    first = client.get(collection_url(collection))
+    second = client.get(collection_url(collection))
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.get_data() == first.get_data()
+
+
+def test_current_version_is_not_modified(client, make_collection):
+    collection = make_collection(2, 1)
+    etag = client.get(collection_url(collection)).headers["ETag"]
+
+    response = client.get(collection_url(collection), headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_annotation_commit_invalidates_response(client, make_collection, user):
+    collection = make_collection(2, 1)
+    first = client.get(collection_url(collection))
+
+    image = collection.has_images[0].image
+    annotation = Annotation(image=image, annotation_json=annotation_json(42))
+    db.session.add(AuthorshipAnnotation(annotation=annotation, user=user))
+    db.session.commit()
+
+    response = client.get(collection_url(collection), headers={"If-None-Match": first.headers["ETag"]})
+
+    assert response.status_code == 200
+    assert response.headers["X-Cache"] == "MISS"
+    assert response.headers["ETag"] != first.headers["ETag"]
+    assert b"note 42" in response.get_data()
+
+
+def test_responses_depend_on_host(client, make_collection):
+    collection = make_collection(1, 1)
+    first = client.get(collection_url(collection))
+
+    # Les liens de la réponse sont des URL absolues : une autre adresse a sa propre réponse.
+    other = client.get(collection_url(collection), base_url="https://annopy.example.org/")
+
+    assert other.headers["X-Cache"] == "MISS"
+    assert other.headers["ETag"] != first.headers["ETag"]
+    assert b"https://annopy.example.org/" in other.get_data()
+    assert b"https://annopy.example.org/" not in first.get_data()
@@ -0,0 +1,112 @@
+from sqlalchemy import event
+
+from app.app import db, response_cache
+from app.modeles.data import Annotation, AuthorshipAnnotation, CollectionHasImages, Image
+
+from conftest import annotation_json
+
+
+def collection_queries(client, queries, collection):
+    """ Renvoie le nombre de requêtes SQL exécutées par /api/collection/<id>, sans le cache des réponses. """
+
+    # La collection créée par le test est rechargée par la requête, comme dans une nouvelle session.
+    url = "/api/collection/{0}".format(collection.collection_id)
+    db.session.expire(collection)
+    response_cache.clear()
+    del queries[:]
+    response = client.get(url)
+    assert response.status_code == 200
+    return len(queries), response.get_json()
+
+
+def test_collection_query_count_does_not_grow(client, queries, make_collection):
+    small = make_collection(2, 2)
+    large = make_collection(40, 5)
+
+    # La première requête charge aussi l'utilisateur-ice connecté-e.
+    collection_queries(client, queries, small)
+    small_count, _ = collection_queries(client, queries, small)
+    large_count, data = collection_queries(client, queries, large)
+
+    assert large_count == small_count
+    # Collection, catégories, authorship, images, annotations et authorships des annotations.
+    assert large_count == 6
+    images = data["images"]
+    assert len(images) == 40
+    assert all(len(image["image"]["attributes"]["annotations"]) == 5 for image in images)
+
+
+def test_image_query_count(client, queries, make_collection):
+    collection = make_collection(1, 20)
+    image_id = collection.has_images[0].collection_has_images_image_id
+
+    del queries[:]
+    response = client.get("/api/image/{0}".format(image_id))
+    assert response.status_code == 200
+    assert len(response.get_json()["attributes"]["annotations"]) == 20
+    assert len(queries) <= 6
+
+
+def write_once(table, write):
+    """ Exécute write, sur une autre connexion, juste avant la première requête qui lit table :
+    la même situation qu'une écriture commitée par un autre processus entre deux requêtes de préchargement.
+    """
+
+    def listener(conn, cursor, statement, parameters, context, executemany):
+        if not done and statement.lstrip().startswith("SELECT") and "FROM {0}".format(table) in statement:
+            done.append(True)
+            with db.engine.begin() as connection:
+                write(connection)
+
+    done = []
+    event.listen(db.engine, "before_cursor_execute", listener)
+    return lambda: event.remove(db.engine, "before_cursor_execute", listener)
+
+
+def add_annotation(connection, image_id, user_id):
+    annotation_id = connection.execute(Annotation.__table__.insert().values(
+        annotation_image_id=image_id, annotation_json=annotation_json(99)
+    )).inserted_primary_key[0]
+    connection.execute(AuthorshipAnnotation.__table__.insert().values(
+        authorship_annotation_annotation_id=annotation_id, authorship_annotation_user_id=user_id
+    ))
+
+
+def test_annotation_committed_between_preload_queries(client, make_collection, user):
+    collection = make_collection(3, 2)
+    image_id = collection.has_images[0].collection_has_images_image_id
+    user_id = user.user_id
+
+    # Une annotation est créée après la lecture des annotations, avant celle des authorships.
+    remove = write_once(AuthorshipAnnotation.__tablename__, lambda connection: add_annotation(
+        connection, image_id, user_id
+    ))
+    try:
+        response = client.get("/api/collection/{0}".format(collection.collection_id))
+    finally:
+        remove()
+    assert response.status_code == 200
+
+
+def test_image_linked_between_preload_queries(client, make_collection, user):
+    collection = make_collection(3, 2)
+    collection_id = collection.collection_id
+    user_id = user.user_id
+
+    # Une image est ajoutée à la collection, avec une annotation, après la lecture des images.
+    def add_image(connection):
+        image_id = connection.execute(Image.__table__.insert().values(
+            image_url="https://example.org/nouvelle.jpg"
+        )).inserted_primary_key[0]
+        connection.execute(CollectionHasImages.__table__.insert().values(
+            collection_has_images_collection_id=collection_id, collection_has_images_image_id=image_id
+        ))
+        add_annotation(connection, image_id, user_id)
+
+    remove = write_once(Annotation.__tablename__, add_image)
+    try:
+        response = client.get("/api/collection/{0}".format(collection_id))
+    finally:
+        remove()
+    assert response.status_code == 200
+    assert len(response.get_json()["images"]) == 3
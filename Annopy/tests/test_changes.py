@@ -0,0 +1,38 @@
+from types import SimpleNamespace
+
+from app.app import db
+from app.modeles.changes import record_changes
+
+
+class RecordingConnection:
+    """ Connexion qui enregistre les requêtes exécutées, sans base de données. """
+
+    def __init__(self, dialect):
+        self.dialect = SimpleNamespace(name=dialect)
+        self.statements = []
+
+    def execute(self, statement, *parameters):
+        self.statements.append(str(statement))
+
+
+def test_postgresql_changes_are_committed_in_sequence_order():
+    connection = RecordingConnection("postgresql")
+    record_changes(connection, [(1, 1, "created")])
+
+    # Le verrou est pris avant l'attribution du numéro de séquence, et gardé jusqu'au commit.
+    assert connection.statements[0] == "LOCK TABLE annotation_change IN EXCLUSIVE MODE"
+    assert connection.statements[1].startswith("INSERT INTO annotation_change")
+
+
+def test_sqlite_changes_are_not_locked():
+    connection = RecordingConnection("sqlite")
+    record_changes(connection, [(1, 1, "created")])
+
+    assert len(connection.statements) == 1
+
+
+def test_feed_is_refused_on_other_databases(client, monkeypatch):
+    assert client.get("/api/changes").status_code == 200
+    monkeypatch.setattr(db.engine.dialect, "name", "mysql")
+
+    assert client.get("/api/changes").status_code == 501
@@ -0,0 +1,79 @@
+from app.app import db
+from app.modeles.annotation_import import import_annotations, iter_units
+from app.modeles.counters import refresh_counters
+from app.modeles.data import Annotation, AuthorshipAnnotation, ImageAnnotator
+
+from conftest import annotation_json
+from test_annotation_import import jsonl
+
+
+def statistics(collection):
+    """ Statistiques de la collection et de ses images, relues en base. """
+
+    db.session.expire_all()
+    return (
+        (
+            collection.collection_image_count, collection.collection_annotated_image_count,
+            collection.collection_annotation_count, collection.collection_annotator_count
+        ),
+        [
+            (link.image.image_annotation_count, link.image.image_annotator_count)
+            for link in sorted(collection.has_images, key=lambda link: link.collection_has_images_image_id)
+        ]
+    )
+
+
+def annotate(image, user):
+    annotation = Annotation(image=image, annotation_json=annotation_json(0))
+    db.session.add(AuthorshipAnnotation(annotation=annotation, user=user))
+    db.session.commit()
+
+
+def test_create_and_delete(make_collection, user):
+    collection = make_collection(3, 2)
+    assert statistics(collection) == ((3, 3, 6, 1), [(2, 1), (2, 1), (2, 1)])
+    image = collection.has_images[0].image
+
+    annotate(image, user)
+    assert statistics(collection) == ((3, 3, 7, 1), [(3, 1), (2, 1), (2, 1)])
+    assert collection.collection_last_annotated == image.image_last_annotated
+    assert ImageAnnotator.query.filter_by(image_annotator_image_id=image.image_id).one().image_annotator_count == 3
+
+    for annotation in list(image.annotation):
+        db.session.delete(annotation)
+    db.session.commit()
+    assert statistics(collection) == ((3, 2, 4, 1), [(0, 0), (2, 1), (2, 1)])
+    assert image.image_last_annotated is None
+    assert ImageAnnotator.query.filter_by(image_annotator_image_id=image.image_id).count() == 0
+
+
+def test_move_annotation(make_collection):
+    source = make_collection(1, 1)
+    target = make_collection(1, 0)
+    annotation = source.has_images[0].image.annotation[0]
+
+    annotation.image = target.has_images[0].image
+    db.session.commit()
+
+    assert statistics(source) == ((1, 0, 0, 0), [(0, 0)])
+    assert statistics(target) == ((1, 1, 1, 1), [(1, 1)])
+
+
+def test_bulk_import(make_collection, user):
+    collection = make_collection(4, 1)
+    image_urls = [link.image.image_url for link in collection.has_images]
+
+    status, state = import_annotations(
+        iter_units(jsonl(image_urls[:3] * 2), "jsonl"), user, collection.collection_id, batch_size=4
+    )
+
+    assert status, state
+    assert state["imported"] == 6
+    # Les images sont triées par ID, donc dans l'ordre de leur création.
+    assert statistics(collection) == ((4, 4, 10, 1), [(3, 1), (3, 1), (3, 1), (1, 1)])
+    # Les compteurs ajoutés pendant l'import sont ceux d'un recalcul complet.
+    expected = statistics(collection)
+    image_ids = [link.collection_has_images_image_id for link in collection.has_images]
+    with db.engine.begin() as connection:
+        refresh_counters(connection, image_ids, [collection.collection_id])
+    assert statistics(collection) == expected
@@ -0,0 +1,101 @@
+import gzip
+import io
+import json
+
+from app.app import db
+from app.modeles.data import Annotation
+from app.modeles.export import export_corpus, export_partitions, partition_collections
+
+
+def add_raw_annotation(collection, annotation_json):
+    """ Enregistre une annotation telle quelle, comme un ancien client qui n'envoyait pas de JSON compact. """
+
+    image_id = collection.has_images[0].collection_has_images_image_id
+    with db.engine.begin() as connection:
+        return connection.execute(Annotation.__table__.insert().values(
+            annotation_image_id=image_id, annotation_json=annotation_json
+        )).inserted_primary_key[0]
+
+
+def export_lines(collection, export_format="jsonl", compression=None, invalid=None):
+    output = io.BytesIO()
+    status, count = export_corpus(
+        db.engine, output, export_format, compression, collection.collection_id, collection.collection_id,
+        invalid=invalid
+    )
+    assert status, count
+    data = output.getvalue()
+    if compression == "gzip":
+        data = gzip.decompress(data)
+    return count, [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+
+def test_jsonl_round_trip(make_collection):
+    collection = make_collection(2, 2)
+    pretty = add_raw_annotation(collection, json.dumps({"type": "Annotation", "body": []}, indent=2))
+    broken = add_raw_annotation(collection, '{"type": "Annotation",')
+    invalid = []
+
+    count, lines = export_lines(collection, invalid=invalid)
+
+    assert count == 5
+    assert len(lines) == 5
+    assert invalid == [broken]
+    assert {line["annotation_id"] for line in lines if line["annotation"] == {"type": "Annotation", "body": []}} \
+        == {pretty}
+
+
+def test_w3c_round_trip(make_collection):
+    collection = make_collection(3, 1)
+    add_raw_annotation(collection, '{\n"type":"Annotation"\n}')
+
+    count, pages = export_lines(collection, "w3c", "gzip")
+
+    assert count == 4
+    assert [len(page["items"]) for page in pages] == [4]
+    assert pages[0]["partOf"]["label"] == collection.collection_name
+
+
+def test_partitions(make_collection, tmp_path):
+    collections = [make_collection(1, n) for n in (4, 1, 1, 2)]
+    first, last = collections[0].collection_id, collections[-1].collection_id
+
+    ranges = partition_collections(db.engine, 2, first, last)
+    assert ranges == [(first, first), (collections[1].collection_id, last)]
+
+    invalid = []
+    status, count = export_partitions(
+        db.engine, str(tmp_path), 2, 2, first_collection_id=first, last_collection_id=last, invalid=invalid
+    )
+    assert (status, count, invalid) == (True, 8, [])
+    lines = [
+        json.loads(line) for path in sorted(tmp_path.iterdir()) for line in path.read_text("utf-8").splitlines()
+    ]
+    assert len(lines) == 8
+
+
+def test_export_endpoint(client, make_collection):
+    collection = make_collection(2, 3)
+    add_raw_annotation(collection, "pas du JSON")
+
+    response = client.get("/api/export?from={0}&to={0}".format(collection.collection_id))
+
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(lines) == 6
+    assert client.get("/api/export?format=csv").status_code == 400
+
+
+def test_export_command(app, make_collection, tmp_path):
+    collection = make_collection(1, 2)
+    broken = add_raw_annotation(collection, "[1, 2")
+    path = tmp_path / "corpus.jsonl.gz"
+
+    result = app.test_cli_runner(mix_stderr=False).invoke(args=[
+        "export-annotations", str(path), "--from", str(collection.collection_id), "--to", str(collection.collection_id)
+    ])
+
+    assert result.exit_code == 0, result.output
+    assert "2 annotations exportées" in result.stderr
+    assert str(broken) in result.stderr
+    assert len(gzip.decompress(path.read_bytes()).splitlines()) == 2
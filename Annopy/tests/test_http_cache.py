@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from app.img_extractors.flickr_api_extractor import FlickrQueryError, _photoset_page
+from app.img_extractors.http_cache import HttpCache
+
+
+class StubResponse:
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {}
+
+
+class StubSession:
+    """ Session HTTP qui renvoie les réponses données, dans l'ordre. """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+
+def flickr_page(stat):
+    data = {"stat": stat, "message": "Rate limit exceeded"}
+    if stat == "ok":
+        data["photoset"] = {"page": 1, "pages": 1, "photo": []}
+    return StubResponse(json.dumps(data).encode("utf-8"))
+
+
+def test_responses_are_cached(tmp_path):
+    cache = HttpCache(path=str(tmp_path / "cache.sqlite"))
+    session = StubSession(StubResponse(b"manifest"))
+
+    assert cache.get("https://example.org/manifest.json", session=session) == (200, b"manifest")
+    assert cache.get("https://example.org/manifest.json", session=session) == (200, b"manifest")
+    assert len(session.urls) == 1
+
+
+def test_flickr_errors_are_not_cached(tmp_path):
+    cache = HttpCache(path=str(tmp_path / "cache.sqlite"))
+    session = StubSession(flickr_page("fail"), flickr_page("ok"))
+
+    with pytest.raises(FlickrQueryError):
+        _photoset_page(session, "https://api.flickr.com/?method=flickr.photosets.getPhotos", 1, 10, cache)
+    # L'erreur n'a pas été gardée : la page est redemandée à l'API, puis servie depuis le cache.
+    assert _photoset_page(session, "https://api.flickr.com/?method=flickr.photosets.getPhotos", 1, 10, cache)
+    assert _photoset_page(session, "https://api.flickr.com/?method=flickr.photosets.getPhotos", 1, 10, cache)
+    assert len(session.urls) == 2
@@ -0,0 +1,18 @@
+import socket
+import time
+
+from app.img_extractors.iiif_extractor import iiif_query
+
+
+def test_manifest_fetch_times_out():
+    # Serveur qui accepte la connexion mais ne répond jamais.
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    try:
+        url = "http://127.0.0.1:{0}/manifest.json".format(server.getsockname()[1])
+        start = time.monotonic()
+        assert iiif_query(url, 1, 10, timeout=0.5) is False
+        assert time.monotonic() - start < 5
+    finally:
+        server.close()
@@ -0,0 +1,122 @@
+import json
+
+import requests
+
+from app.img_extractors.http_cache import HttpCache
+from app.img_extractors.image_info import fetch_image_info, prefetch_image_info, sniff_dimensions, sniff_image
+
+
+class StubResponse:
+    """ Réponse HTTP lue en flux : les morceaux lus et la fermeture sont enregistrés. """
+
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.read = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            self.read += len(self.content[start:start + chunk_size])
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class StubSession:
+    """ Session HTTP qui renvoie une réponse par URL, ou lève ConnectionError pour une URL inconnue. """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, headers=None, timeout=None, **kwargs):
+        self.requests.append((url, headers))
+        if url not in self.responses:
+            raise requests.ConnectionError(url)
+        return self.responses[url]
+
+
+def jpeg(width, height, padding=0):
+    """ Début d'un JPEG : SOI, un segment APP0 de padding octets, puis le segment SOF0. """
+
+    app0 = b"\xff\xe0" + (padding + 2).to_bytes(2, "big") + b"\x00" * padding
+    sof0 = b"\xff\xc0\x00\x11\x08" + height.to_bytes(2, "big") + width.to_bytes(2, "big") + b"\x03" + b"\x00" * 9
+    return b"\xff\xd8" + app0 + sof0 + b"\xff\xda" + b"\x00" * 100_000
+
+
+def info_json(**info):
+    return StubResponse(json.dumps(info).encode("utf-8"))
+
+
+def test_sniff_dimensions():
+    assert sniff_dimensions(jpeg(640, 480)) == ("image/jpeg", 640, 480)
+    # Le segment SOF n'est pas encore lu.
+    assert sniff_dimensions(jpeg(640, 480, padding=100)[:50]) == ("image/jpeg", None, None)
+    png = b"\x89PNG\r\n\x1a\n" + b"\x00\x00\x00\rIHDR" + (800).to_bytes(4, "big") + (600).to_bytes(4, "big")
+    assert sniff_dimensions(png) == ("image/png", 800, 600)
+    assert sniff_dimensions(b"GIF89a" + (20).to_bytes(2, "little") + (10).to_bytes(2, "little")) == (
+        "image/gif", 20, 10
+    )
+    assert sniff_dimensions(b"<html>") == (None, None, None)
+
+
+def test_sniff_image_reads_only_the_header():
+    url = "https://live.staticflickr.com/1/2_3_b.jpg"
+    response = StubResponse(jpeg(1024, 768, padding=20_000), status_code=206)
+    session = StubSession({url: response})
+
+    assert sniff_image(session, url) == {"width": 1024, "height": 768, "format": "image/jpeg", "service": None}
+    assert session.requests == [(url, {"Range": "bytes=0-65535"})]
+    # La lecture s'arrête au morceau qui contient le segment SOF, et la réponse est fermée.
+    assert response.read == 3 * 8 * 1024
+    assert response.closed
+
+
+def test_sniff_image_without_dimensions():
+    url = "https://example.org/image.webp"
+    session = StubSession({
+        url: StubResponse(b"RIFF\x00\x00\x00\x00WEBP" + b"\x00" * 100, headers={"Content-Type": "image/webp"})
+    })
+
+    assert sniff_image(session, url) == {"width": None, "height": None, "format": "image/webp", "service": None}
+    assert sniff_image(StubSession({url: StubResponse(b"", status_code=404)}), url) is None
+
+
+def test_iiif_info(tmp_path):
+    service = "https://iiif.example.org/iiif/2/image"
+    url = service + "/full/full/0/default.jpg"
+    session = StubSession({service + "/info.json": info_json(**{"@id": service + "/", "width": 4000, "height": 3000})})
+    cache = HttpCache(path=str(tmp_path / "cache.sqlite"))
+
+    expected = {"width": 4000, "height": 3000, "format": "image/jpeg", "service": service}
+    assert fetch_image_info(session, url, cache=cache) == expected
+    # info.json est lu depuis le cache ; l'image n'est jamais demandée.
+    assert fetch_image_info(session, url, cache=cache) == expected
+    assert [requested for requested, _ in session.requests] == [service + "/info.json"]
+
+
+def test_iiif_info_fallback():
+    service = "https://iiif.example.org/iiif/3/image"
+    url = "https://example.org/image.jpg"
+    session = StubSession({
+        service + "/info.json": info_json(id=service, type="ImageService3"),
+        url: StubResponse(jpeg(300, 200))
+    })
+
+    # Un info.json sans dimensions : le début de l'image est lu.
+    assert fetch_image_info(session, url, service=service) == {
+        "width": 300, "height": 200, "format": "image/jpeg", "service": None
+    }
+
+
+def test_prefetch_image_info():
+    urls = ["https://example.org/{0}.jpg".format(number) for number in range(5)]
+    session = StubSession({url: StubResponse(jpeg(number + 1, 10)) for number, url in enumerate(urls[:4])})
+
+    result = prefetch_image_info([(url, None) for url in urls], max_workers=3, session=session)
+
+    # Les résultats sont dans l'ordre des images ; une image injoignable n'a pas de métadonnées.
+    assert [info and info["width"] for info in result] == [1, 2, 3, 4, None]
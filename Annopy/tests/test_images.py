@@ -0,0 +1,27 @@
+from app.app import derivative_cache
+
+
+def test_derivatives_require_login(app, make_collection):
+    collection = make_collection(1, 0)
+    image_id = collection.has_images[0].collection_has_images_image_id
+
+    response = app.test_client().get("/image/{0}/thumbnail".format(image_id))
+
+    # Redirection vers la page de connexion.
+
+    assert response.status_code == 302
+
+
+def test_derivatives_are_private(client, make_collection, monkeypatch, tmp_path):
+    collection = make_collection(1, 0)
+    image_id = collection.has_images[0].collection_has_images_image_id
+    path = tmp_path / "derivative"
+    path.write_bytes(b"\xff\xd8\xff")
+    monkeypatch.setattr(derivative_cache, "get", lambda url: ("empreinte", str(path), "image/jpeg"))
+
+    response = client.get("/image/{0}/viewer".format(image_id))
+
+    assert response.status_code == 200
+    assert response.cache_control.private
+    assert not response.cache_control.public
+    assert client.get("/image/{0}/viewer".format(image_id), headers={"If-None-Match": '"empreinte"'}).status_code == 304
@@ -0,0 +1,83 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+
+from app.app import db
+from app.modeles.data import Collection, ImportJob
+from app.modeles.jobs import reconcile_import_jobs, run_annotation_import_job
+
+
+def dead_owner():
+    """ Identifiant d'un processus de cette machine qui n'existe plus. """
+
+    process = subprocess.Popen([sys.executable, "-c", "pass"])
+    process.wait()
+    return "{0}:{1}".format(socket.gethostname(), process.pid)
+
+
+def make_job(collection, user, source, phase, owner, path=None):
+    job = ImportJob(
+        import_job_collection_id=collection.collection_id,
+        import_job_user_id=user.user_id,
+        import_job_source=source,
+        import_job_phase=phase,
+        import_job_owner=owner,
+        import_job_path=path
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job.import_job_id
+
+
+def test_interrupted_jobs_are_finished(make_collection, user):
+    owner = dead_owner()
+    inserting = make_collection(2, 0)
+    metadata = make_collection(2, 0)
+    annotations = make_collection(2, 0)
+    with tempfile.NamedTemporaryFile(prefix="annopy-import-", delete=False) as f:
+        path = f.name
+
+    inserting_job = make_job(inserting, user, "iiif", "inserting", owner)
+    metadata_job = make_job(metadata, user, "flickr", "metadata", owner)
+    annotations_job = make_job(annotations, user, "annotations", "inserting", owner, path)
+    inserting_id, metadata_id = inserting.collection_id, metadata.collection_id
+
+    assert reconcile_import_jobs() == 3
+    db.session.expire_all()
+
+    # L'import d'images interrompu échoue et sa collection incomplète est supprimée.
+    assert ImportJob.query.get(inserting_job).import_job_phase == "failed"
+    assert Collection.query.get(inserting_id) is None
+    # Les images étaient enregistrées : la collection est conservée.
+    assert ImportJob.query.get(metadata_job).import_job_phase == "done"
+    assert ImportJob.query.get(metadata_job).import_job_error is not None
+    assert Collection.query.get(metadata_id) is not None
+    # Le fichier de l'import d'annotations interrompu est supprimé.
+    assert ImportJob.query.get(annotations_job).import_job_phase == "failed"
+    assert not os.path.exists(path)
+
+
+def test_jobs_of_running_process_are_kept(make_collection, user):
+    collection = make_collection(1, 0)
+    owner = "{0}:{1}".format(socket.gethostname(), os.getpid())
+    job_id = make_job(collection, user, "iiif", "inserting", owner)
+    other_host = make_job(collection, user, "iiif", "queued", "autre-machine:1")
+
+    assert reconcile_import_jobs() == 0
+    assert ImportJob.query.get(job_id).import_job_phase == "inserting"
+    assert ImportJob.query.get(other_host).import_job_phase == "queued"
+    assert Collection.query.get(collection.collection_id) is not None
+
+
+def test_annotation_job_tolerates_removed_file(make_collection, user, tmp_path):
+    collection = make_collection(1, 0)
+    path = str(tmp_path / "annotations.jsonl")
+    job_id = make_job(collection, user, "annotations", "queued", None, path)
+
+    # Le fichier a déjà été supprimé (import terminé par reconcile_import_jobs) : l'import échoue sans exception.
+    run_annotation_import_job(job_id, path, "jsonl")
+
+    db.session.expire_all()
+    assert ImportJob.query.get(job_id).import_job_phase == "failed"
@@ -0,0 +1,35 @@
+import threading
+
+from sqlalchemy import create_engine, select
+
+from app.app import db
+from app.modeles.migrations import MIGRATIONS, schema_version, upgrade
+
+
+def test_concurrent_upgrades_apply_each_migration_once(tmp_path):
+    engine = create_engine(
+        "sqlite:///{0}".format(tmp_path / "db.sqlite"), connect_args={"timeout": 30}
+    )
+    db.metadata.create_all(engine)
+    applied = []
+    errors = []
+    start = threading.Barrier(4)
+
+    def run():
+        try:
+            with engine.connect() as connection:
+                start.wait()
+                applied.extend(upgrade(connection))
+        except Exception as erreur:
+            errors.append(erreur)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert sorted(applied) == sorted((version, description) for version, description, _ in MIGRATIONS)
+    with engine.connect() as connection:
+        assert connection.execute(select([schema_version.c.version])).fetchall() == [(MIGRATIONS[-1][0],)]
@@ -0,0 +1,25 @@
+from app.modeles import pagination
+from app.modeles.data import Collection
+from app.modeles.pagination import cached_count
+
+
+def test_counts_cache_is_bounded(app, monkeypatch):
+    monkeypatch.setattr(pagination, "COUNTS_MAX_SIZE", 3)
+    pagination._counts.clear()
+
+    for keyword in ["a", "b", "c"]:
+        cached_count(Collection.query, "collection", keyword)
+    # "a" est utilisée : "b" devient la moins récemment utilisée.
+    cached_count(Collection.query, "collection", "a")
+    cached_count(Collection.query, "collection", "d")
+
+    assert list(pagination._counts) == [("collection", "c"), ("collection", "a"), ("collection", "d")]
+
+
+def test_expired_counts_are_purged_on_write(app):
+    pagination._counts.clear()
+    pagination._counts[("collection", "old")] = (1, 0)
+
+    cached_count(Collection.query, "collection", "new")
+
+    assert list(pagination._counts) == [("collection", "new")]
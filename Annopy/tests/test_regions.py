@@ -0,0 +1,102 @@
+import pytest
+
+from app.app import db
+from app.modeles import regions
+from app.modeles.regions import find_regions, selector_bbox
+
+
+@pytest.fixture(params=[True, False], ids=["rtree", "colonnes"])
+def region_index(request, app, monkeypatch):
+    """ Recherche par l'index spatial, puis sur les colonnes de la table annotation. """
+
+    if request.param and not regions.region_index_enabled():
+        pytest.skip("SQLite sans le module R*Tree")
+    monkeypatch.setattr(regions, "_enabled", request.param)
+    return request.param
+
+
+def ids(result):
+    annotations, has_more = result
+    return [annotation.annotation_id for annotation in annotations], has_more
+
+
+def test_find_regions_on_image(region_index, make_collection):
+    # Annotations de rectangles (n, n, n + 10, n + 10), n = 0 à 29.
+    collection = make_collection(2, 30)
+    image = collection.has_images[0].image
+    expected = sorted(annotation.annotation_id for annotation in image.annotation)
+
+    # Un point ne croise que les rectangles qui le contiennent, bords compris.
+    assert ids(find_regions((15, 15, 15, 15), image_id=image.image_id)) == (expected[5:16], False)
+    assert ids(find_regions((100, 100, 200, 200), image_id=image.image_id)) == ([], False)
+
+    first, has_more = ids(find_regions((0, 0, 1000, 1000), image_id=image.image_id, limit=20))
+    assert (first, has_more) == (expected[:20], True)
+    assert ids(find_regions((0, 0, 1000, 1000), image_id=image.image_id, after=first[-1], limit=20)) == (
+        expected[20:], False
+    )
+
+
+def test_find_regions_on_collection(region_index, make_collection):
+    collection = make_collection(3, 5)
+    make_collection(1, 5)
+    expected = sorted(
+        annotation.annotation_id for link in collection.has_images for annotation in link.image.annotation
+        if annotation.annotation_min_x <= 2
+    )
+
+    assert ids(find_regions((0, 0, 2, 2), collection_id=collection.collection_id)) == (expected, False)
+    assert len(expected) == 9
+
+
+def test_moved_region(region_index, make_collection):
+    collection = make_collection(1, 1)
+    annotation = collection.has_images[0].image.annotation[0]
+    annotation.annotation_json = (
+        '{"type":"Annotation","target":{"selector":{"type":"FragmentSelector","value":"xywh=500,500,10,10"}}}'
+    )
+    db.session.commit()
+
+    assert ids(find_regions((0, 0, 20, 20), image_id=annotation.annotation_image_id)) == ([], False)
+    assert ids(find_regions((505, 505, 505, 505), image_id=annotation.annotation_image_id)) == (
+        [annotation.annotation_id], False
+    )
+
+
+def test_fragment_selector():
+    assert selector_bbox({"target": {"selector": {"type": "FragmentSelector", "value": "xywh=pixel:10,20,30,40"}}}) == (
+        10, 20, 40, 60
+    )
+    assert selector_bbox({"target": "https://example.org/image.jpg#xywh=1,2,3,4"}) == (1, 2, 4, 6)
+    # Les coordonnées en pourcentage ne sont pas retenues.
+    assert selector_bbox({"target": {"selector": {"type": "FragmentSelector", "value": "xywh=percent:1,2,3,4"}}}) is None
+    assert selector_bbox({"target": {"selector": {"type": "FragmentSelector", "value": "xywh=1,2,-3,4"}}}) is None
+
+
+def test_svg_selector():
+    def svg(shape):
+        return {"target": {"selector": {
+            "type": "SvgSelector", "value": '<svg xmlns="http://www.w3.org/2000/svg">{0}</svg>'.format(shape)
+        }}}
+
+    assert selector_bbox(svg('<rect x="10" y="20" width="30" height="40"/>')) == (10, 20, 40, 60)
+    assert selector_bbox(svg('<circle cx="50" cy="50" r="10"/>')) == (40, 40, 60, 60)
+    assert selector_bbox(svg('<polygon points="0,10 20,5 15,30"/>')) == (0, 5, 20, 30)
+    # Chemin relatif : m puis l, h et v en coordonnées relatives.
+    assert selector_bbox(svg('<path d="m10 10 l5 5 h10 v-20 z"/>')) == (10, -5, 25, 15)
+    assert selector_bbox(svg("<g></g>")) is None
+    assert selector_bbox(svg("<rect")) is None
+
+
+def test_multiple_selectors():
+    annotation = {"target": [
+        {"selector": [
+            {"type": "FragmentSelector", "value": "xywh=0,0,10,10"},
+            {"type": "SvgSelector", "value": '<svg><rect x="50" y="5" width="10" height="10"/></svg>'}
+        ]},
+        "https://example.org/image.jpg#xywh=5,100,1,1",
+        {"selector": {"type": "TextQuoteSelector", "exact": "texte"}}
+    ]}
+
+    assert selector_bbox(annotation) == (0, 0, 60, 101)
+    assert selector_bbox([annotation]) is None
@@ -0,0 +1,84 @@
+import json
+
+from app.app import db
+from app.modeles.data import Annotation, AuthorshipAnnotation
+from app.modeles.search import search_collections
+
+
+def annotation_with_text(text):
+    return json.dumps({"type": "Annotation", "body": [{"type": "TextualBody", "value": text}]})
+
+
+def annotate(collection, user, text):
+    annotation = Annotation(image=collection.has_images[0].image, annotation_json=annotation_with_text(text))
+    db.session.add(AuthorshipAnnotation(annotation=annotation, user=user))
+    db.session.commit()
+    return annotation
+
+
+def found(keyword):
+    query, rank = search_collections(keyword)
+    return [collection.collection_id for collection in query.order_by(rank).all()]
+
+
+def test_annotation_text_finds_collection(make_collection, user):
+    collection = make_collection(2, 0)
+    annotate(collection, user, "Enluminure du bréviaire")
+
+    assert found("breviaire") == [collection.collection_id]
+    # Les mots peuvent se trouver dans le nom de la collection et dans ses annotations.
+    assert found("{0} enlumin".format(collection.collection_name.split()[1])) == [collection.collection_id]
+    assert found("breviaire absent") == []
+
+
+def test_updated_and_deleted_annotations_leave_results(make_collection, user):
+    collection = make_collection(1, 0)
+    annotation = annotate(collection, user, "gargouille")
+
+    annotation.annotation_json = annotation_with_text("chimère")
+    db.session.commit()
+    assert found("gargouille") == []
+    assert found("chimere") == [collection.collection_id]
+
+    db.session.delete(annotation)
+    db.session.commit()
+    assert found("chimere") == []
+
+
+def test_name_ranks_above_annotations(make_collection, user):
+    by_annotation = make_collection(1, 0)
+    annotate(by_annotation, user, "lettrine")
+    by_name = make_collection(1, 0)
+    by_name.collection_name = "Lettrine ornée {0}".format(by_name.collection_id)
+    db.session.commit()
+
+    assert found("lettrine") == [by_name.collection_id, by_annotation.collection_id]
+
+
+def test_saving_an_annotation_does_not_read_the_collection(make_collection, user, queries):
+    small = make_collection(1, 2)
+    large = make_collection(1, 300)
+
+    counts = []
+    for collection in (small, large):
+        annotation = collection.has_images[0].image.annotation[0]
+        del queries[:]
+        annotation.annotation_json = annotation_with_text("modifiée")
+        db.session.commit()
+        counts.append(len(queries))
+        assert not any("FROM annotation JOIN collection_has_images" in statement for statement in queries)
+
+    assert counts[0] == counts[1]
+
+
+def test_search_api_pages_by_rank(client, make_collection, user):
+    ids = set()
+    for _ in range(7):
+        collection = make_collection(1, 0)
+        annotate(collection, user, "marginalia")
+        ids.add(collection.collection_id)
+
+    first = client.get("/api/collections?q=marginalia").get_json()
+    second = client.get(first["links"]["next"]).get_json()
+
+    assert {item["id"] for item in first["data"] + second["data"]} == ids